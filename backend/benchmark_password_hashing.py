@@ -0,0 +1,72 @@
+"""
+Password Hashing Benchmark for SUNSTORE KOLHAPUR CRM
+Simulates a login burst against bcrypt verification and reports throughput
+and how long the event loop was stalled, comparing:
+  inline   - pwd_context.verify on the event loop (the old login handler)
+  executor - verify_and_update_password on the bcrypt thread pool
+
+Usage: python benchmark_password_hashing.py [--logins 40] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import server
+
+PASSWORD = "benchmark-password"
+
+
+async def probe_loop(lags: list, stop: asyncio.Event, interval: float = 0.01):
+    # Stand-in for every other API call: how late does a 10 ms timer fire?
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(loop.time() - expected, 0.0) * 1000)
+
+
+async def login_burst(mode: str, hashed: str, logins: int, concurrency: int) -> dict:
+    limit = asyncio.Semaphore(concurrency)
+
+    async def login_once():
+        async with limit:
+            if mode == "inline":
+                return server.pwd_context.verify(PASSWORD, hashed)
+            valid, _ = await server.verify_and_update_password(PASSWORD, hashed)
+            return valid
+
+    lags = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_loop(lags, stop))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(login_once() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    assert all(results)
+    return {
+        "per_second": logins / elapsed,
+        "lag_p50": statistics.median(lags) if lags else 0.0,
+        "lag_max": max(lags) if lags else elapsed * 1000
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    hashed = server.pwd_context.hash(PASSWORD)
+    print(f"🔐 bcrypt rounds={server.BCRYPT_ROUNDS}, {server.PASSWORD_HASH_WORKERS} hashing threads, "
+          f"{args.logins} logins, {args.concurrency} concurrent")
+    for mode in ("inline", "executor"):
+        result = await login_burst(mode, hashed, args.logins, args.concurrency)
+        print(f"  {mode:8}: {result['per_second']:6.1f} logins/s   "
+              f"loop lag p50 {result['lag_p50']:7.1f} ms   max {result['lag_max']:7.1f} ms")
+    server.password_executor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
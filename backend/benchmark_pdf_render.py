@@ -0,0 +1,106 @@
+"""
+PDF Render Benchmark for SUNSTORE KOLHAPUR CRM
+Compares a cold render (fresh fonts and stylesheet, as every request used to do)
+with a warm render through the shared PdfRenderer, for a 50-line quotation.
+
+Usage: python benchmark_pdf_render.py [--lines 50] [--runs 10]
+"""
+import argparse
+import statistics
+import time
+
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+
+import pdf_render
+
+
+def build_quotation_html(lines: int) -> str:
+    items = []
+    for i in range(lines):
+        taxable = 2 * 1250.0
+        tax_type = "CGST+SGST" if i % 2 else "IGST"
+        items.append({
+            "item_id": f"ITM{i + 1:04d}",
+            "item_name": f"Item {i + 1}",
+            "hsn": f"8504{i % 5}",
+            "description": "Three phase energy meter with RS485 port",
+            "uom": "Nos",
+            "qty": 2,
+            "rate": 1250.0,
+            "discount_percent": 5 if i % 4 == 0 else 0,
+            "taxable_amount": taxable,
+            "tax_type": tax_type,
+            "tax_amount": taxable * 0.18,
+            "total_amount": taxable * 1.18
+        })
+    party = {
+        "party_name": "ABC Engineering Works",
+        "address": "Plot 12, MIDC Shiroli",
+        "city": "Kolhapur",
+        "state": "Maharashtra",
+        "pincode": "416122",
+        "GST_number": "27AABCA1234A1Z1",
+        "contact_person": "Ramesh Patil",
+        "mobile": "9876543210"
+    }
+    return pdf_render.generate_document_html(
+        doc_type="QUOTATION",
+        doc_no="QTN0001/BENC",
+        doc_date="2026-04-01T00:00:00+00:00",
+        party=party,
+        items=items,
+        totals={
+            "subtotal": sum(i["taxable_amount"] for i in items),
+            "tax_total": sum(i["tax_amount"] for i in items),
+            "grand_total": sum(i["total_amount"] for i in items),
+            "cgst": 0, "sgst": 0, "igst": sum(i["tax_amount"] for i in items)
+        },
+        hsn_summary=[],
+        remarks="Benchmark",
+        is_quotation=True,
+        letterhead_src=pdf_render.letterheads.src_for()
+    )
+
+
+def render_cold(html_content: str) -> bytes:
+    # What each request paid before: font discovery, CSS parse and image decode
+    font_config = FontConfiguration()
+    stylesheet = CSS(filename=str(pdf_render.DOCUMENT_STYLESHEET_PATH), font_config=font_config)
+    return HTML(string=html_content, url_fetcher=pdf_render.letterheads.url_fetcher).write_pdf(
+        stylesheets=[stylesheet],
+        font_config=font_config
+    )
+
+
+def timed(fn, html_content: str, runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn(html_content)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    html_content = build_quotation_html(args.lines)
+    print(f"📄 {args.lines}-line quotation, {len(html_content) / 1024:.0f} KB of HTML, {args.runs} runs each")
+
+    cold = timed(render_cold, html_content, args.runs)
+
+    renderer = pdf_render.PdfRenderer(pdf_render.DOCUMENT_STYLESHEET_PATH, pdf_render.letterheads)
+    renderer.warm_up()
+    warm = timed(renderer.render, html_content, args.runs)
+
+    for label, timings in (("cold", cold), ("warm", warm)):
+        print(f"  {label}: median {statistics.median(timings):7.1f} ms   min {min(timings):7.1f} ms   max {max(timings):7.1f} ms")
+    print(f"✓ Warm renders are {statistics.median(cold) / statistics.median(warm):.2f}x faster")
+
+
+if __name__ == "__main__":
+    main()
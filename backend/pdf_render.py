@@ -0,0 +1,289 @@
+"""Document HTML and PDF rendering.
+
+Kept apart from server.py so PDF pool workers (spawned, not forked) import only
+Jinja2, WeasyPrint and pypdfium2, not the API, its settings and its database client.
+"""
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import pypdfium2 as pdfium
+from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from weasyprint import HTML, CSS, default_url_fetcher
+from weasyprint.text.fonts import FontConfiguration
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+logger = logging.getLogger(__name__)
+
+# ==================== DOCUMENT TEMPLATES ====================
+
+TEMPLATES_DIR = ROOT_DIR / "templates"
+DOCUMENT_STYLESHEET_PATH = TEMPLATES_DIR / "documents.css"
+# Re-read templates and the stylesheet when they change on disk (dev only)
+TEMPLATE_AUTO_RELOAD = os.environ.get("TEMPLATE_AUTO_RELOAD", "false").lower() == "true"
+
+template_env = Environment(
+    loader=FileSystemLoader(str(TEMPLATES_DIR)),
+    autoescape=select_autoescape(["html"]),
+    auto_reload=TEMPLATE_AUTO_RELOAD,
+    trim_blocks=True,
+    lstrip_blocks=True
+)
+template_env.filters["money"] = lambda value: f"{value:,.2f}"
+
+def render_template(template_name: str, **context) -> str:
+    # Compiled templates are cached by the environment after the first load
+    return template_env.get_template(template_name).render(**context)
+
+class LetterheadManager:
+    """Letterhead images held in memory and served to WeasyPrint by URL.
+
+    Templates reference ``letterhead:<file>?v=<mtime>``. The url_fetcher answers
+    those from memory, and the shared image cache keeps the decoded image between
+    renders, so a PDF render does no disk read and no base64 round trip. Files are
+    re-checked at most every ``check_interval`` seconds and reloaded when changed.
+    """
+    SCHEME = "letterhead"
+
+    def __init__(self, default_path: Path, directory: Path, check_interval: float = 5.0):
+        self.default_path = default_path
+        self.directory = directory
+        self.check_interval = check_interval
+        self.image_cache: dict = {}
+        self._assets: Dict[str, dict] = {}
+
+    def _resolve(self, file_name: str) -> Path:
+        if not file_name:
+            return self.default_path
+        return self.directory / file_name
+
+    def _asset(self, file_name: str) -> Optional[dict]:
+        asset = self._assets.get(file_name)
+        now = time.monotonic()
+        if asset and now - asset["checked_at"] < self.check_interval:
+            return asset
+        
+        path = self._resolve(file_name)
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            if file_name:
+                logger.error(f"Letterhead {path} not found, using default")
+                return self._asset("")
+            self._assets.pop(file_name, None)
+            return None
+        
+        if not asset or asset["mtime"] != mtime:
+            try:
+                data = path.read_bytes()
+            except OSError as e:
+                logger.error(f"Failed to load letterhead: {e}")
+                return asset
+            asset = {
+                "data": data,
+                "mtime": mtime,
+                "mime_type": mimetypes.guess_type(path.name)[0] or "image/png"
+            }
+            self._assets[file_name] = asset
+            # Drop decoded copies of the old image
+            self.image_cache.clear()
+        asset["checked_at"] = now
+        return asset
+
+    def src_for(self, file_name: str = "") -> str:
+        file_name = Path(file_name).name if file_name else ""
+        asset = self._asset(file_name)
+        if not asset:
+            return ""
+        return f"{self.SCHEME}:{file_name or 'default'}?v={asset['mtime']}"
+
+    def url_fetcher(self, url: str, *args, **kwargs) -> dict:
+        if url.startswith(f"{self.SCHEME}:"):
+            # Only bare file names inside the letterheads directory are allowed
+            file_name = Path(urlsplit(url).path).name
+            asset = self._asset("" if file_name == "default" else file_name)
+            if not asset:
+                raise ValueError(f"Letterhead not available: {url}")
+            return {"string": asset["data"], "mime_type": asset["mime_type"]}
+        if urlsplit(url).scheme.lower() == "data":
+            return default_url_fetcher(url, *args, **kwargs)
+        # Document fields end up in the HTML; never let them make the renderer read files or call out
+        raise ValueError(f"Blocked resource URL: {url[:100]}")
+
+letterheads = LetterheadManager(ROOT_DIR / "letterhead.png", ROOT_DIR / "letterheads")
+
+def generate_document_html(
+    doc_type: str,
+    doc_no: str,
+    doc_date: str,
+    party: dict,
+    items: List[dict],
+    totals: dict,
+    hsn_summary: List[dict],
+    remarks: str = "",
+    payment_terms: str = "",
+    delivery_terms: str = "",
+    party_confirmation_id: str = "",
+    is_soa: bool = False,
+    is_quotation: bool = False,
+    letterhead_src: str = ""
+):
+    # Check if any item has discount > 0
+    has_discount = any(item.get('discount_percent', 0) > 0 for item in items)
+    
+    # Pre-format item rows so the template loop only substitutes strings
+    rows = []
+    for item in items:
+        rate = item['rate']
+        discount = item.get('discount_percent', 0)
+        rows.append({
+            "item_name": item.get('item_name', item.get('item_id', '')),
+            "hsn": item.get('hsn', ''),
+            "description": item.get('description', ''),
+            "qty": f"{item['qty']:.1f} {item.get('uom', 'Nos')}",
+            "list_price": f"{rate / (1 - discount / 100) if discount > 0 else rate:.2f}",
+            "discount": f"{discount:.2f}",
+            "rate": f"{rate:.2f}",
+            "amount": f"{item['taxable_amount']:.2f}"
+        })
+    
+    return render_template(
+        "document.html",
+        doc_type=doc_type,
+        doc_no=doc_no,
+        doc_date=doc_date,
+        party=party,
+        rows=rows,
+        has_discount=has_discount,
+        hsn_summary=hsn_summary,
+        subtotal=totals["subtotal"],
+        tax_total=totals["tax_total"],
+        grand_total=totals["grand_total"],
+        total_sgst=totals["sgst"],
+        total_cgst=totals["cgst"],
+        total_igst=totals["igst"],
+        remarks=remarks,
+        payment_terms=payment_terms,
+        delivery_terms=delivery_terms,
+        party_confirmation_id=party_confirmation_id,
+        is_soa=is_soa,
+        is_quotation=is_quotation,
+        letterhead_src=letterhead_src
+    )
+
+# ==================== PDF RENDERER ====================
+
+class PdfRenderer:
+    """Long-lived WeasyPrint state shared by every PDF endpoint.
+
+    Font discovery (FontConfiguration) and stylesheet parsing happen once per
+    process instead of once per render; letterhead images come from the shared
+    LetterheadManager cache.
+    """
+
+    def __init__(self, stylesheet_path: Path, letterhead_manager: LetterheadManager):
+        self.stylesheet_path = stylesheet_path
+        self.letterheads = letterhead_manager
+        self.font_config = FontConfiguration()
+        self._stylesheet = None
+        self._stylesheet_mtime = None
+        self._revision = None
+
+    @property
+    def stylesheet(self) -> CSS:
+        # Re-parse on change only when template auto-reload is on (dev)
+        mtime = self.stylesheet_path.stat().st_mtime if TEMPLATE_AUTO_RELOAD else None
+        if self._stylesheet is None or mtime != self._stylesheet_mtime:
+            self._stylesheet = CSS(filename=str(self.stylesheet_path), font_config=self.font_config)
+            self._stylesheet_mtime = mtime
+        return self._stylesheet
+
+    @property
+    def revision(self) -> str:
+        """Identifies the stylesheet, the one render input that is not in the HTML."""
+        if self._revision is None or TEMPLATE_AUTO_RELOAD:
+            self._revision = hashlib.sha256(self.stylesheet_path.read_bytes()).hexdigest()[:16]
+        return self._revision
+
+    def render(self, html_content: str) -> bytes:
+        return HTML(string=html_content, url_fetcher=self.letterheads.url_fetcher).write_pdf(
+            stylesheets=[self.stylesheet],
+            font_config=self.font_config,
+            cache=self.letterheads.image_cache
+        )
+
+    def warm_up(self):
+        """Render a one-line quotation so fonts, CSS and the letterhead are loaded."""
+        started = time.perf_counter()
+        items = [{"item_id": "", "item_name": "Warm-up", "qty": 1, "rate": 1, "taxable_amount": 1,
+                  "tax_type": "IGST", "tax_amount": 0.18, "total_amount": 1.18}]
+        self.render(generate_document_html(
+            doc_type="QUOTATION",
+            doc_no="WARMUP",
+            doc_date=datetime.now(timezone.utc).isoformat(),
+            party={"party_name": "", "address": "", "city": "", "state": "", "pincode": "",
+                   "GST_number": "", "contact_person": "", "mobile": ""},
+            items=items,
+            totals={"subtotal": 1, "tax_total": 0.18, "grand_total": 1.18, "cgst": 0, "sgst": 0, "igst": 0.18},
+            hsn_summary=[{"hsn": "HSN/SAC", "tax_type": "IGST", "taxable": 1, "cgst": 0, "sgst": 0,
+                          "igst": 0.18, "igst_rate": 18.0}],
+            is_quotation=True,
+            letterhead_src=self.letterheads.src_for()
+        ))
+        logger.info(f"PDF renderer warmed up in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+pdf_renderer = PdfRenderer(DOCUMENT_STYLESHEET_PATH, letterheads)
+
+def render_pdf(html_content: str) -> bytes:
+    return pdf_renderer.render(html_content)
+
+PDF_THUMBNAIL_WIDTH = int(os.environ.get("PDF_THUMBNAIL_WIDTH", "360"))
+PDF_THUMBNAIL_MAX_BYTES = 30 * 1024
+
+def _encode_palette_png(image, colors: int) -> bytes:
+    buffer = io.BytesIO()
+    image.quantize(colors=colors).save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+def render_pdf_thumbnail(pdf: bytes, width: int = PDF_THUMBNAIL_WIDTH) -> bytes:
+    """First page as a small palette PNG; runs on the PDF pool."""
+    document = pdfium.PdfDocument(pdf)
+    try:
+        page = document[0]
+        image = page.render(scale=width / page.get_width()).to_pil()
+        page.close()
+    finally:
+        document.close()
+    
+    # Documents are mostly white with dark text, so a small palette keeps them legible
+    colors = 64
+    while True:
+        png = _encode_palette_png(image, colors)
+        if len(png) <= PDF_THUMBNAIL_MAX_BYTES or image.width <= 120:
+            return png
+        if colors > 16:
+            colors //= 2
+        else:
+            image = image.resize((int(image.width * 0.8), int(image.height * 0.8)))
+
+# ==================== PDF POOL WORKERS ====================
+
+def init_pdf_worker():
+    # Each worker process owns its own PdfRenderer; warm it before the first job
+    try:
+        pdf_renderer.warm_up()
+    except Exception as e:
+        logger.error(f"PDF worker warm-up failed: {e}")
+
+def ping_pdf_worker() -> int:
+    return os.getpid()
@@ -1,13 +1,16 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.exceptions import RequestValidationError
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import abc
 import logging
 from pathlib import Path
-from pydantic import BaseModel, EmailStr, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, EmailStr, Field, ConfigDict, ValidationError
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 from jose import JWTError, jwt
@@ -15,28 +18,406 @@ import asyncio
 import resend
 import io
 import csv
-from weasyprint import HTML, CSS
-from weasyprint.text.fonts import FontConfiguration
+import time
+import math
+import threading
+import sys
+import traceback
+from contextlib import contextmanager
+from collections import OrderedDict
+from contextvars import ContextVar
+import re
+import difflib
+import uuid
+import hashlib
+import hmac
+import zipfile
+import multiprocessing
+import random
+import smtplib
+from email.message import EmailMessage
+from email.utils import make_msgid
+from html import escape as html_escape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import mimetypes
+from pymongo import UpdateOne, ReplaceOne, DeleteOne, ReturnDocument, monitoring
+from pymongo.errors import OperationFailure, DuplicateKeyError
+from pdf_render import (
+    letterheads, pdf_renderer, render_template, generate_document_html,
+    render_pdf, render_pdf_thumbnail, init_pdf_worker, ping_pdf_worker
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ==================== METRICS ====================
+
+# Bearer token Prometheus sends to scrape /metrics. Unset means the endpoint is
+# off (404): route, user and query counters are not for anonymous callers
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """Labelled counter, gauge or histogram rendered in Prometheus text format.
+    
+    Updates take a lock because Mongo command events arrive on driver threads.
+    """
+    
+    def __init__(self, kind: str, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_LATENCY_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+            if self.kind == "histogram":
+                values = [(key, {"buckets": list(state["buckets"]), "sum": state["sum"], "count": state["count"]}) for key, state in values]
+        for key, value in values:
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+                continue
+            bucket_labels = self.labels + ("le",)
+            for bound, count in zip(self.buckets, value["buckets"]):
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels, key + (bound,))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(bucket_labels, key + ('+Inf',))} {value['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {value['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {value['count']}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+    
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Metric:
+        return self._register(Metric("counter", name, help_text, labels))
+    
+    def gauge(self, name: str, help_text: str, labels: tuple = ()) -> Metric:
+        return self._register(Metric("gauge", name, help_text, labels))
+    
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_LATENCY_BUCKETS) -> Metric:
+        return self._register(Metric("histogram", name, help_text, labels, buckets))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.counter(
+    "http_requests_total",
+    "HTTP requests by route template and status",
+    ("method", "route", "status")
+)
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds",
+    "Time from request start until the response body is fully sent",
+    ("method", "route")
+)
+HTTP_IN_FLIGHT = metrics.gauge("http_requests_in_flight", "Requests currently being handled")
+MONGO_COMMANDS = metrics.counter(
+    "mongodb_commands_total",
+    "MongoDB commands by collection and outcome",
+    ("command", "collection", "status")
+)
+MONGO_COMMAND_SECONDS = metrics.histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command round-trip time as reported by the driver",
+    ("command", "collection"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+EVENT_LOOP_LAG_SECONDS = metrics.histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke a periodic timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+EVENT_LOOP_LAG_MAX = metrics.gauge("event_loop_lag_max_seconds", "Largest event loop lag in the last sampling window")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Counts and times every command Motor sends; events fire on driver threads."""
+    
+    def __init__(self):
+        self._collections: Dict[tuple, str] = {}
+        self._lock = threading.Lock()
+    
+    def started(self, event):
+        collection = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+    
+    def _finish(self, event, status: str):
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMANDS.inc(command=event.command_name, collection=collection, status=status)
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1_000_000, command=event.command_name, collection=collection)
+    
+    def succeeded(self, event):
+        self._finish(event, "succeeded")
+    
+    def failed(self, event):
+        self._finish(event, "failed")
+
+class MetricsMiddleware:
+    """Request count, latency and in-flight gauge per route template.
+    
+    Labels use the matched route's path (`/api/quotations/{quotation_id}/pdf`)
+    so ids do not explode the series count; unmatched paths share one label.
+    Written as plain ASGI so streamed responses are timed to their last byte.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status_code = 500
+        
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status_code)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=scope["method"], route=route)
+
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("EVENT_LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+
+async def monitor_event_loop_lag():
+    # A timer that fires late means something held the loop (sync I/O, CPU work)
+    loop = asyncio.get_running_loop()
+    window_started = loop.time()
+    window_max = 0.0
+    while True:
+        expected = loop.time() + EVENT_LOOP_LAG_INTERVAL_SECONDS
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        lag = max(loop.time() - expected, 0.0)
+        EVENT_LOOP_LAG_SECONDS.observe(lag)
+        # Worst lag over a rolling minute, for alerting without a histogram query
+        window_max = max(window_max, lag)
+        EVENT_LOOP_LAG_MAX.set(window_max)
+        if loop.time() - window_started >= 60:
+            window_started = loop.time()
+            window_max = 0.0
+
+LOOP_WATCHDOG_ENABLED = os.environ.get("LOOP_WATCHDOG_ENABLED", "false").lower() == "true"
+LOOP_WATCHDOG_THRESHOLD_MS = int(os.environ.get("LOOP_WATCHDOG_THRESHOLD_MS", "100"))
+LOOP_WATCHDOG_INTERVAL_MS = int(os.environ.get("LOOP_WATCHDOG_INTERVAL_MS", "20"))
+
+EVENT_LOOP_BLOCKS = metrics.counter(
+    "event_loop_blocks_total",
+    "Times the loop watchdog saw a callback hold the event loop past its threshold",
+    ("handler",)
+)
+
+class LoopBlockWatchdog:
+    """Opt-in detector for sync work that holds the event loop.
+    
+    The loop bumps a heartbeat every interval; a daemon thread checks it and,
+    once the heartbeat is more than the threshold late, samples the loop
+    thread's stack with sys._current_frames(). Stalls are aggregated by
+    handler (route template, or the background task's function) and by the
+    last line in this module before the blocking call.
+    """
+    
+    def __init__(self, threshold_ms: int, interval_ms: int):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self._loop = None
+        self._loop_thread_id = None
+        self._heartbeat = 0.0
+        self._endpoints: Dict[Any, str] = {}
+        self._offenders: Dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+    
+    def start(self, loop, routes):
+        """Call from the event loop thread."""
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._endpoints = {
+            route.endpoint.__code__: route.path
+            for route in routes if hasattr(getattr(route, "endpoint", None), "__code__")
+        }
+        self._heartbeat = time.monotonic()
+        loop.call_soon(self._beat)
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        logger.info(f"Event loop watchdog on: threshold {self.threshold * 1000:.0f} ms")
+    
+    def stop(self):
+        self._stopped.set()
+    
+    def _beat(self):
+        self._heartbeat = time.monotonic()
+        if not self._stopped.is_set():
+            self._loop.call_later(self.interval, self._beat)
+    
+    def _sample(self) -> Optional[dict]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()  # outermost first
+        
+        here = __file__
+        own = [f for f in frames if f.f_code.co_filename == here and f.f_code.co_name not in ("__call__", "send_with_status")]
+        handler = next((self._endpoints[f.f_code] for f in frames if f.f_code in self._endpoints), None)
+        if handler is None:
+            handler = own[0].f_code.co_name if own else "unknown"
+        site = f"{Path(here).name}:{own[-1].f_lineno} in {own[-1].f_code.co_name}" if own else "unknown"
+        return {
+            "handler": handler,
+            "site": site,
+            "stack": traceback.format_list(traceback.extract_stack(frames[-1], limit=20))
+        }
+    
+    def _watch(self):
+        stall = None
+        while not self._stopped.wait(self.interval):
+            late = time.monotonic() - self._heartbeat - self.interval
+            if late >= self.threshold:
+                if stall is None:
+                    stall = self._sample()
+                if stall is not None:
+                    stall["blocked"] = late
+            elif stall is not None:
+                self._record(stall)
+                stall = None
+    
+    def _record(self, stall: dict):
+        key = (stall["handler"], stall["site"])
+        blocked_ms = stall["blocked"] * 1000
+        with self._lock:
+            offender = self._offenders.get(key)
+            first_seen = offender is None
+            if first_seen:
+                offender = self._offenders[key] = {
+                    "handler": stall["handler"],
+                    "site": stall["site"],
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "stack": stall["stack"]
+                }
+            offender["count"] += 1
+            offender["total_ms"] += blocked_ms
+            offender["max_ms"] = max(offender["max_ms"], blocked_ms)
+            offender["last_seen"] = datetime.now(timezone.utc).isoformat()
+        EVENT_LOOP_BLOCKS.inc(handler=stall["handler"])
+        message = f"Event loop blocked for {blocked_ms:.0f} ms in {stall['handler']} at {stall['site']}"
+        if first_seen:
+            message += "\n" + "".join(stall["stack"])
+        logger.warning(message)
+    
+    def report(self) -> List[dict]:
+        with self._lock:
+            offenders = [dict(offender) for offender in self._offenders.values()]
+        return sorted(offenders, key=lambda offender: offender["total_ms"], reverse=True)
+
+loop_watchdog = LoopBlockWatchdog(LOOP_WATCHDOG_THRESHOLD_MS, LOOP_WATCHDOG_INTERVAL_MS)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()])
 db = client[os.environ['DB_NAME']]
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hashes made with a different cost are flagged by verify_and_update and rehashed on login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+# bcrypt releases the GIL, so these threads hash in parallel and keep the event loop free
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+# Access tokens carry the user's claims and are checked without a database read,
+# so they are kept short; clients renew them with the longer-lived refresh token
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
+# How stale another worker's view of deactivations and revocations may get
+TOKEN_REVOCATION_REFRESH_SECONDS = float(os.environ.get("TOKEN_REVOCATION_REFRESH_SECONDS", "30"))
 
 # Email config
 RESEND_API_KEY = os.environ.get("RESEND_API_KEY", "")
 SENDER_EMAIL = os.environ.get("SENDER_EMAIL", "onboarding@resend.dev")
 if RESEND_API_KEY:
     resend.api_key = RESEND_API_KEY
+# resend, smtp or file (writes .eml files to EMAIL_FILE_DIR, for development and tests)
+EMAIL_TRANSPORT = os.environ.get("EMAIL_TRANSPORT", "resend" if RESEND_API_KEY else "file")
+EMAIL_FILE_DIR = Path(os.environ.get("EMAIL_FILE_DIR", str(ROOT_DIR / "email_outbox")))
+SMTP_HOST = os.environ.get("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_USERNAME = os.environ.get("SMTP_USERNAME", "")
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", "")
+SMTP_USE_TLS = os.environ.get("SMTP_USE_TLS", "true").lower() == "true"
+EMAIL_BATCH_SIZE = int(os.environ.get("EMAIL_BATCH_SIZE", "20"))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get("EMAIL_MAX_ATTEMPTS", "6"))
+EMAIL_RETRY_BASE_SECONDS = float(os.environ.get("EMAIL_RETRY_BASE_SECONDS", "30"))
+EMAIL_RETRY_MAX_SECONDS = float(os.environ.get("EMAIL_RETRY_MAX_SECONDS", "3600"))
+EMAIL_POLL_SECONDS = float(os.environ.get("EMAIL_POLL_SECONDS", "5"))
+# A claimed message whose sender died is retried once its lease runs out
+EMAIL_SEND_LEASE_SECONDS = int(os.environ.get("EMAIL_SEND_LEASE_SECONDS", "300"))
+# Sent and dead-lettered records are removed by a TTL index after this many days
+EMAIL_OUTBOX_RETENTION_DAYS = int(os.environ.get("EMAIL_OUTBOX_RETENTION_DAYS", "30"))
 
 security = HTTPBearer()
 
@@ -49,11 +430,13 @@ logger = logging.getLogger(__name__)
 
 # ==================== MODELS ====================
 
+USER_ROLES = ("Admin", "Sales User")
+
 class UserBase(BaseModel):
     name: str
     email: EmailStr
     mobile: str
-    role: str  # "Admin" or "Sales User"
+    role: str  # One of USER_ROLES
 
 class UserCreate(UserBase):
     password: str
@@ -66,6 +449,11 @@ class User(UserBase):
     user_id: str
     status: str = "Active"
 
+class UserUpdate(BaseModel):
+    name: Optional[str] = None
+    mobile: Optional[str] = None
+    role: Optional[str] = None
+
 class ForgotPasswordRequest(BaseModel):
     email: EmailStr
 
@@ -73,6 +461,9 @@ class ResetPasswordRequest(BaseModel):
     token: str
     new_password: str
 
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
 class PartyBase(BaseModel):
     party_name: str
     address: str
@@ -85,11 +476,16 @@ class PartyBase(BaseModel):
     email: EmailStr
 
 class PartyCreate(PartyBase):
-    pass
+    version: Optional[int] = None  # On update: the version this edit was based on
 
 class Party(PartyBase):
     party_id: str
     status: str = "Active"
+    version: int = 0
+
+class PartyMergeRequest(BaseModel):
+    keep_party_id: str
+    merge_party_ids: List[str]
 
 class ItemBase(BaseModel):
     item_code: str
@@ -120,13 +516,14 @@ class LeadBase(BaseModel):
     notes: str = ""
 
 class LeadCreate(LeadBase):
-    pass
+    version: Optional[int] = None  # On update: the version this edit was based on
 
 class Lead(LeadBase):
     lead_id: str
     created_by_user_id: str
     lead_date: str
     status: str = "Open"  # Open, Converted, Lost
+    version: int = 0
 
 class QuotationItemBase(BaseModel):
     item_id: str
@@ -153,16 +550,23 @@ class QuotationBase(BaseModel):
     delivery_terms: str = ""
     remarks: str = ""
     quotation_status: Optional[str] = None
+    branch: str = ""  # Selects the branch letterhead on PDFs
     is_locked: bool = False
     items: List[QuotationItemBase]
 
 class QuotationCreate(QuotationBase):
-    pass
+    version: Optional[int] = None  # On update: the version this edit was based on
 
 class Quotation(QuotationBase):
     quotation_id: str
     quotation_no: str
     created_by_user_id: str
+    pdf_status: Optional[str] = None  # Pre-render of a locked document: pending, rendering, ready or failed
+    archived_at: Optional[str] = None  # Set once moved to cold storage; archived documents are read-only
+    totals: Optional[Dict[str, float]] = None  # subtotal, tax_total, grand_total, cgst, sgst, igst
+    hsn_summary: Optional[List[Dict[str, Any]]] = None  # GST split per HSN code, as printed on the PDF
+    email_status: Optional[str] = None  # Last emailed copy: queued, sent or failed
+    version: int = 0  # Bumped on every write; send it back on update to detect stale edits
 
 class ProformaInvoiceBase(BaseModel):
     party_id: str
@@ -174,16 +578,23 @@ class ProformaInvoiceBase(BaseModel):
     delivery_terms: str = ""
     remarks: str = ""
     pi_status: str = "PI Submitted"
+    branch: str = ""  # Selects the branch letterhead on PDFs
     is_locked: bool = False
     items: List[QuotationItemBase]
 
 class ProformaInvoiceCreate(ProformaInvoiceBase):
-    pass
+    version: Optional[int] = None  # On update: the version this edit was based on
 
 class ProformaInvoice(ProformaInvoiceBase):
     pi_id: str
     pi_no: str
     created_by_user_id: str
+    pdf_status: Optional[str] = None  # Pre-render of a locked document: pending, rendering, ready or failed
+    archived_at: Optional[str] = None  # Set once moved to cold storage; archived documents are read-only
+    totals: Optional[Dict[str, float]] = None  # subtotal, tax_total, grand_total, cgst, sgst, igst
+    hsn_summary: Optional[List[Dict[str, Any]]] = None  # GST split per HSN code, as printed on the PDF
+    email_status: Optional[str] = None  # Last emailed copy: queued, sent or failed
+    version: int = 0  # Bumped on every write; send it back on update to detect stale edits
 
 class SOABase(BaseModel):
     party_confirmation_ID: str = ""
@@ -194,16 +605,29 @@ class SOABase(BaseModel):
     remarks: str = ""
     date: str
     soa_status: str = "In Process"
+    branch: str = ""  # Selects the branch letterhead on PDFs
     is_locked: bool = False
     items: List[QuotationItemBase]
 
 class SOACreate(SOABase):
-    pass
+    version: Optional[int] = None  # On update: the version this edit was based on
 
 class SOA(SOABase):
     soa_id: str
     soa_no: str
     created_by_user_id: str
+    pdf_status: Optional[str] = None  # Pre-render of a locked document: pending, rendering, ready or failed
+    archived_at: Optional[str] = None  # Set once moved to cold storage; archived documents are read-only
+    totals: Optional[Dict[str, float]] = None  # subtotal, tax_total, grand_total, cgst, sgst, igst
+    hsn_summary: Optional[List[Dict[str, Any]]] = None  # GST split per HSN code, as printed on the PDF
+    email_status: Optional[str] = None  # Last emailed copy: queued, sent or failed
+    version: int = 0  # Bumped on every write; send it back on update to detect stale edits
+
+DOCUMENT_CREATE_MODELS = {
+    "quotation": QuotationCreate,
+    "proforma_invoice": ProformaInvoiceCreate,
+    "soa": SOACreate
+}
 
 class SettingsBase(BaseModel):
     quotation_prefix: str = "QTN"
@@ -212,17 +636,21 @@ class SettingsBase(BaseModel):
     payment_terms: str = ""
     delivery_terms: str = ""
     terms_and_conditions: str = ""
+    branch_letterheads: Dict[str, str] = {}  # branch -> image file in letterheads/
 
 class Settings(SettingsBase):
     settings_id: str = "default"
 
 # ==================== AUTH UTILITIES ====================
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(password_executor, pwd_context.hash, password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """(valid, new_hash); new_hash is set when the stored hash uses an outdated cost."""
+    return await asyncio.get_running_loop().run_in_executor(
+        password_executor, pwd_context.verify_and_update, plain_password, hashed_password
+    )
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -234,19 +662,483 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def issue_session_tokens(user: dict) -> dict:
+    """Access and refresh tokens for a user document, in the shape login returns."""
+    generation = user.get("token_generation", 0)
+    access_token = create_access_token(
+        data={
+            "sub": user["user_id"],
+            "type": "access",
+            "name": user["name"],
+            "email": user["email"],
+            "role": user["role"],
+            "gen": generation
+        },
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = create_access_token(
+        data={"sub": user["user_id"], "type": "refresh", "gen": generation},
+        expires_delta=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        "user": {
+            "user_id": user["user_id"],
+            "name": user["name"],
+            "email": user["email"],
+            "role": user["role"]
+        }
+    }
+
+class TokenRevocations:
+    """In-memory view of which users' tokens are no longer valid.
+    
+    A token is rejected when its user is inactive or when its "gen" claim is
+    older than the user's token_generation, which is bumped on deactivation,
+    password reset and name or role changes. Changes made by this process
+    apply at once; changes made by other workers are picked up on the next
+    periodic reload.
+    """
+    
+    def __init__(self):
+        self._generations: Dict[str, int] = {}
+        self._inactive: set = set()
+    
+    async def reload(self):
+        generations = {}
+        inactive = set()
+        async for user in db.users.find({}, {"_id": 0, "user_id": 1, "status": 1, "token_generation": 1}):
+            generations[user["user_id"]] = user.get("token_generation", 0)
+            if user.get("status", "Active") != "Active":
+                inactive.add(user["user_id"])
+        # Swap whole objects so a concurrent check never sees a half-built view
+        self._generations, self._inactive = generations, inactive
+    
+    def apply(self, user_id: str, generation: int, status: str):
+        self._generations[user_id] = generation
+        if status == "Active":
+            self._inactive.discard(user_id)
+        else:
+            self._inactive.add(user_id)
+    
+    def is_revoked(self, user_id: str, generation: int) -> bool:
+        # Users created since the last reload are unknown here and start at generation 0
+        return user_id in self._inactive or generation < self._generations.get(user_id, 0)
+
+token_revocations = TokenRevocations()
+
+async def revoke_user_tokens(user_id: str, status: Optional[str] = None, changes: Optional[dict] = None) -> bool:
+    """Invalidate every token issued to a user so far, optionally changing their status or profile.
+    
+    Access tokens carry the user's name and role, so changes to either must
+    come through here or old tokens keep acting with the stale claims.
+    """
+    update = {"$inc": {"token_generation": 1}}
+    fields = dict(changes or {})
+    if status is not None:
+        fields["status"] = status
+    if fields:
+        update["$set"] = fields
+    user = await db.users.find_one_and_update(
+        {"user_id": user_id},
+        update,
+        projection={"_id": 0, "user_id": 1, "status": 1, "token_generation": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if user is None:
+        return False
+    token_revocations.apply(user_id, user["token_generation"], user.get("status", "Active"))
+    return True
+
+async def refresh_token_revocations():
+    while True:
+        await asyncio.sleep(TOKEN_REVOCATION_REFRESH_SECONDS)
+        try:
+            await token_revocations.reload()
+        except Exception as e:
+            # Keep serving from the last good view; the next reload may succeed
+            logger.error(f"Failed to reload token revocations: {e}")
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Built from the token's claims alone: no database read per request
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication")
-        user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication")
+    user_id = payload.get("sub")
+    # Refresh and password-reset tokens are signed with the same key but are not sessions
+    if user_id is None or payload.get("type") != "access":
+        raise HTTPException(status_code=401, detail="Invalid authentication")
+    if token_revocations.is_revoked(user_id, payload.get("gen", 0)):
+        raise HTTPException(status_code=401, detail="Session has been revoked")
+    return {
+        "user_id": user_id,
+        "name": payload.get("name", ""),
+        "email": payload.get("email", ""),
+        "role": payload.get("role", "")
+    }
+
+# ==================== RATE LIMITING ====================
+
+def parse_rate(spec: str) -> Tuple[int, float]:
+    """"30/60" -> burst of 30, refilling 30 tokens every 60 seconds."""
+    count, _, seconds = spec.partition("/")
+    return int(count), int(count) / float(seconds or 60)
+
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")  # memory or mongo
+# Proxies in front of the app that append to X-Forwarded-For (0 = clients connect directly).
+# Must be set for per-IP limits: guessing wrong either puts every client behind the proxy in
+# one bucket or lets clients pick their own IP, so without it only per-email limits apply.
+_trusted_proxy_hops = os.environ.get("TRUSTED_PROXY_HOPS", "").strip()
+TRUSTED_PROXY_HOPS: Optional[int] = int(_trusted_proxy_hops) if _trusted_proxy_hops else None
+if TRUSTED_PROXY_HOPS is None:
+    logger.warning("TRUSTED_PROXY_HOPS is not set; per-IP rate limits are disabled")
+RATE_LIMITS = {
+    ("login", "ip"): parse_rate(os.environ.get("LOGIN_RATE_LIMIT_PER_IP", "30/60")),
+    ("login", "email"): parse_rate(os.environ.get("LOGIN_RATE_LIMIT_PER_EMAIL", "5/300")),
+    ("forgot_password", "ip"): parse_rate(os.environ.get("FORGOT_PASSWORD_RATE_LIMIT_PER_IP", "10/3600")),
+    ("forgot_password", "email"): parse_rate(os.environ.get("FORGOT_PASSWORD_RATE_LIMIT_PER_EMAIL", "3/3600"))
+}
+
+RATE_LIMITED = metrics.counter("rate_limited_total", "Requests rejected by the rate limiter", ("endpoint", "scope"))
+
+class MemoryTokenBuckets:
+    """Per-process token buckets; no I/O, so a check costs a dict lookup.
+    
+    Least recently used keys are evicted past max_keys so a spray of
+    distinct emails cannot grow memory without bound.
+    """
+    
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        """Spend one token; returns 0 if allowed, else seconds until one is available."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return 0.0 if allowed else (1 - tokens) / rate
+    
+    async def reset(self, key: str):
+        self._buckets.pop(key, None)
+
+class MongoTokenBuckets:
+    """Token buckets shared by every worker, updated atomically in one round trip."""
+    
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        now = datetime.now(timezone.utc)
+        elapsed_seconds = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        bucket = await self.collection.find_one_and_update(
+            {"key": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed_seconds, rate]}]}]},
+                    "updated_at": now,
+                    # TTL index removes buckets once they would be full again
+                    "expires_at": now + timedelta(seconds=capacity / rate)
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return 0.0 if bucket["allowed"] else (1 - bucket["tokens"]) / rate
+    
+    async def reset(self, key: str):
+        await self.collection.delete_one({"key": key})
+
+rate_limiter = MongoTokenBuckets(db.rate_limits) if RATE_LIMIT_BACKEND == "mongo" else MemoryTokenBuckets()
+# Used while the shared limiter is unreachable; per worker, but better than no limit
+fallback_rate_limiter = MemoryTokenBuckets()
+
+def client_ip(http_request: Request) -> str:
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [hop.strip() for hop in http_request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return http_request.client.host if http_request.client else "unknown"
+
+async def enforce_rate_limits(endpoint: str, http_request: Request, email: str):
+    """Raise 429 before any DB or bcrypt work when the IP or email is over its limit."""
+    scopes = [("email", email.strip().lower())]
+    if TRUSTED_PROXY_HOPS is not None:
+        scopes.insert(0, ("ip", client_ip(http_request)))
+    for scope, value in scopes:
+        capacity, rate = RATE_LIMITS[(endpoint, scope)]
+        key = f"{endpoint}:{scope}:{value}"
+        try:
+            retry_after = await rate_limiter.take(key, capacity, rate)
+        except Exception as e:
+            # A limiter outage must neither lock everyone out nor lift the limits
+            logger.error(f"Rate limiter unavailable, limiting this worker only: {e}")
+            retry_after = await fallback_rate_limiter.take(key, capacity, rate)
+        if retry_after:
+            RATE_LIMITED.inc(endpoint=endpoint, scope=scope)
+            seconds = math.ceil(retry_after)
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many attempts, try again in {seconds} seconds",
+                headers={"Retry-After": str(seconds)}
+            )
+
+# ==================== EMAIL OUTBOX ====================
+
+EMAILS_SENT = metrics.counter("emails_total", "Outbox deliveries by outcome", ("transport", "outcome"))
+
+def build_mime_message(message: dict) -> EmailMessage:
+    mime = EmailMessage()
+    mime["From"] = message["from"]
+    mime["To"] = ", ".join(message["to"])
+    mime["Subject"] = message["subject"]
+    mime["Message-ID"] = make_msgid(domain=message["from"].rpartition("@")[2] or None)
+    mime.set_content(message.get("text") or "This message requires an HTML capable email client.")
+    mime.add_alternative(message["html"], subtype="html")
+    for attachment in message.get("attachments", []):
+        maintype, _, subtype = (mimetypes.guess_type(attachment["filename"])[0] or "application/octet-stream").partition("/")
+        mime.add_attachment(attachment["content"], maintype=maintype, subtype=subtype, filename=attachment["filename"])
+    return mime
+
+class EmailTransport(abc.ABC):
+    """Delivers outbox messages. Runs in a worker thread, never on the event loop.
+    
+    send_batch returns one entry per message: None when it was accepted,
+    otherwise the error text, so a batch can partly fail.
+    """
+    
+    name = "base"
+    
+    @abc.abstractmethod
+    def send(self, message: dict):
+        """Deliver one message, raising on failure."""
+    
+    def send_batch(self, messages: List[dict]) -> List[Optional[str]]:
+        results = []
+        for message in messages:
+            try:
+                self.send(message)
+                results.append(None)
+            except Exception as e:
+                results.append(str(e) or type(e).__name__)
+        return results
+
+class ResendTransport(EmailTransport):
+    name = "resend"
+    
+    def _params(self, message: dict) -> dict:
+        params = {"from": message["from"], "to": message["to"], "subject": message["subject"], "html": message["html"]}
+        if message.get("attachments"):
+            params["attachments"] = [
+                {"filename": a["filename"], "content": list(a["content"])} for a in message["attachments"]
+            ]
+        return params
+    
+    def send(self, message: dict):
+        resend.Emails.send(self._params(message))
+    
+    def send_batch(self, messages: List[dict]) -> List[Optional[str]]:
+        # The batch API takes up to 100 messages in one call but no attachments
+        plain = [m for m in messages if not m.get("attachments")]
+        if len(plain) < 2:
+            return super().send_batch(messages)
+        try:
+            resend.Batch.send([self._params(m) for m in plain[:100]])
+            batched = {id(m) for m in plain[:100]}
+        except Exception as e:
+            logger.warning(f"Resend batch send failed, sending one by one: {e}")
+            batched = set()
+        results = []
+        for message in messages:
+            if id(message) in batched:
+                results.append(None)
+            else:
+                results.extend(super().send_batch([message]))
+        return results
+
+class SmtpTransport(EmailTransport):
+    name = "smtp"
+    
+    def send(self, message: dict):
+        self.send_batch([message])
+    
+    def send_batch(self, messages: List[dict]) -> List[Optional[str]]:
+        # One connection and login for the whole batch
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as smtp:
+            if SMTP_USE_TLS:
+                smtp.starttls()
+            if SMTP_USERNAME:
+                smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+            results = []
+            for message in messages:
+                try:
+                    smtp.send_message(build_mime_message(message))
+                    results.append(None)
+                except smtplib.SMTPException as e:
+                    results.append(str(e))
+            return results
+
+class FileTransport(EmailTransport):
+    """Writes each message to EMAIL_FILE_DIR as an .eml file instead of sending it."""
+    
+    name = "file"
+    
+    def __init__(self, directory: Path):
+        self.directory = directory
+    
+    def send(self, message: dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        _write_file_atomic(self.directory / f"{message['email_id']}.eml", build_mime_message(message).as_bytes())
+
+def create_email_transport() -> EmailTransport:
+    if EMAIL_TRANSPORT == "resend":
+        return ResendTransport()
+    if EMAIL_TRANSPORT == "smtp":
+        return SmtpTransport()
+    if EMAIL_TRANSPORT == "file":
+        return FileTransport(EMAIL_FILE_DIR)
+    raise ValueError(f"Unknown EMAIL_TRANSPORT: {EMAIL_TRANSPORT}")
+
+email_transport = create_email_transport()
+_email_outbox_wakeup = asyncio.Event()
+
+async def enqueue_email(to: List[str], subject: str, html: str, text: str = "", **extra) -> str:
+    """Store a message in the outbox for the background sender and return its id.
+    
+    Extra fields are kept on the outbox record, e.g. to link it to a document.
+    """
+    email_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    await db.email_outbox.insert_one({
+        **extra,
+        "email_id": email_id,
+        "to": to,
+        "subject": subject,
+        "html": html,
+        "text": text,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now.isoformat()
+    })
+    _email_outbox_wakeup.set()
+    return email_id
+
+def email_retry_delay(attempts: int) -> float:
+    # Exponential backoff with jitter so a provider outage does not end in a retry stampede
+    delay = min(EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1), EMAIL_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+async def claim_outbox_batch() -> List[dict]:
+    batch = []
+    while len(batch) < EMAIL_BATCH_SIZE:
+        now = datetime.now(timezone.utc)
+        # Atomic claim, so several workers can drain the same outbox
+        message = await db.email_outbox.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "sending", "lease_expires_at": {"$lte": now}}
+            ]},
+            {"$set": {"status": "sending", "lease_expires_at": now + timedelta(seconds=EMAIL_SEND_LEASE_SECONDS)}},
+            projection={"_id": 0},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if message is None:
+            break
+        batch.append(message)
+    return batch
+
+async def resolve_email_attachments(message: dict) -> List[dict]:
+    """Outbox records name their document attachments; the PDFs are rendered at send time."""
+    attachments = []
+    for ref in message.get("attachments", []):
+        spec = PDF_DOCUMENT_TYPES[ref["doc_kind"]]
+        doc = await find_document(ref["doc_kind"], ref["doc_id"])
+        if not doc:
+            raise ValueError(spec["not_found"])
+        with pdf_render_trace(ref["doc_kind"], ref["doc_id"], source="email") as trace:
+            trace["lines"] = len(doc["items"])
+            pdf = await get_document_pdf(ref["doc_kind"], doc)
+        attachments.append({"filename": ref["filename"], "content": pdf})
+    return attachments
+
+async def deliver_outbox_batch(batch: List[dict]):
+    prepared, errors = [], {}
+    resolved = await asyncio.gather(*(resolve_email_attachments(m) for m in batch), return_exceptions=True)
+    for message, attachments in zip(batch, resolved):
+        if isinstance(attachments, Exception):
+            errors[message["email_id"]] = str(getattr(attachments, "detail", attachments)) or type(attachments).__name__
+        else:
+            prepared.append({**message, "from": SENDER_EMAIL, "attachments": attachments})
+    try:
+        results = await asyncio.to_thread(email_transport.send_batch, prepared)
+    except Exception as e:
+        # Connection-level failure: nothing in the batch went out
+        results = [str(e) or type(e).__name__] * len(prepared)
+    errors.update({m["email_id"]: error for m, error in zip(prepared, results) if error})
+    
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(days=EMAIL_OUTBOX_RETENTION_DAYS)
+    updates = []
+    for message in batch:
+        error = errors.get(message["email_id"])
+        attempts = message["attempts"] + 1
+        unset = {"lease_expires_at": ""}
+        if error is None:
+            outcome = "sent"
+            fields = {"status": "sent", "attempts": attempts, "sent_at": now.isoformat(), "last_error": None, "expires_at": expires_at}
+            # Bodies can hold password reset links; nothing needs them once delivered
+            unset.update({"html": "", "text": ""})
+        elif attempts >= EMAIL_MAX_ATTEMPTS:
+            outcome = "dead"
+            # Kept until expiry so an Admin can retry it
+            fields = {"status": "dead", "attempts": attempts, "last_error": error, "dead_at": now.isoformat(), "expires_at": expires_at}
+            logger.error(f"Email {message['email_id']} to {message['to']} dead-lettered after {attempts} attempts: {error}")
+        else:
+            outcome = "retry"
+            fields = {
+                "status": "pending",
+                "attempts": attempts,
+                "last_error": error,
+                "next_attempt_at": now + timedelta(seconds=email_retry_delay(attempts))
+            }
+        EMAILS_SENT.inc(transport=email_transport.name, outcome=outcome)
+        if message.get("doc_kind"):
+            await record_document_email_outcome(message, outcome, fields)
+        updates.append(UpdateOne(
+            {"email_id": message["email_id"]},
+            {"$set": fields, "$unset": unset}
+        ))
+    if updates:
+        await db.email_outbox.bulk_write(updates, ordered=False)
+
+async def run_email_outbox():
+    while True:
+        try:
+            batch = await claim_outbox_batch()
+            if batch:
+                await deliver_outbox_batch(batch)
+                continue
+        except Exception as e:
+            logger.error(f"Email outbox sender failed: {e}")
+        # Idle until something is enqueued here, or poll for other workers' messages and due retries
+        _email_outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(_email_outbox_wakeup.wait(), timeout=EMAIL_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
 
 # ==================== AUTH ENDPOINTS ====================
 
@@ -262,7 +1154,7 @@ async def register(user_data: UserCreate):
     user_id = f"USR{str(user_count + 1).zfill(4)}"
     
     # Hash password
-    hashed_password = hash_password(user_data.password)
+    hashed_password = await hash_password(user_data.password)
     
     # Create user
     user_dict = {
@@ -280,32 +1172,48 @@ async def register(user_data: UserCreate):
     return {"message": "User registered successfully", "user_id": user_id}
 
 @api_router.post("/auth/login")
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, http_request: Request):
+    await enforce_rate_limits("login", http_request, credentials.email)
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password_hashed"]):
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    valid, new_hash = await verify_and_update_password(credentials.password, user["password_hashed"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid email or password")
+    if new_hash:
+        # BCRYPT_ROUNDS changed since this password was set
+        await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"password_hashed": new_hash}})
+    # Failed attempts count against the email; a successful login clears them
+    await rate_limiter.reset(f"login:email:{credentials.email.strip().lower()}")
     
     if user["status"] != "Active":
         raise HTTPException(status_code=403, detail="Account is inactive")
     
-    access_token = create_access_token(
-        data={"sub": user["user_id"]},
-        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    )
+    return issue_session_tokens(user)
+
+@api_router.post("/auth/refresh")
+async def refresh_session(request: RefreshTokenRequest):
+    try:
+        payload = jwt.decode(request.refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
+    if payload.get("type") != "refresh":
+        raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
+    
+    # The one database read of a session's lifetime after login: checks
+    # revocation against Mongo directly rather than this worker's cached view
+    user = await db.users.find_one({"user_id": payload.get("sub")}, {"_id": 0, "password_hashed": 0})
+    if not user or payload.get("gen", 0) != user.get("token_generation", 0):
+        raise HTTPException(status_code=401, detail="Session has been revoked")
+    if user["status"] != "Active":
+        raise HTTPException(status_code=403, detail="Account is inactive")
     
-    return {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "user": {
-            "user_id": user["user_id"],
-            "name": user["name"],
-            "email": user["email"],
-            "role": user["role"]
-        }
-    }
+    # Rotated on every use so a leaked refresh token has a bounded lifetime
+    return issue_session_tokens(user)
 
 @api_router.post("/auth/forgot-password")
-async def forgot_password(request: ForgotPasswordRequest):
+async def forgot_password(request: ForgotPasswordRequest, http_request: Request):
+    await enforce_rate_limits("forgot_password", http_request, request.email)
     user = await db.users.find_one({"email": request.email}, {"_id": 0})
     if not user:
         # Don't reveal if email exists
@@ -317,34 +1225,29 @@ async def forgot_password(request: ForgotPasswordRequest):
         expires_delta=timedelta(hours=1)
     )
     
-    # Send email
-    if RESEND_API_KEY:
-        try:
-            html_content = f"""
-            <html>
-            <body style="font-family: Arial, sans-serif; padding: 20px;">
-                <h2>Password Reset Request</h2>
-                <p>Hello {user['name']},</p>
-                <p>You requested to reset your password. Your reset token is:</p>
-                <p style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-family: monospace; font-size: 14px;">{reset_token}</p>
-                <p>This token will expire in 1 hour.</p>
-                <p>If you didn't request this, please ignore this email.</p>
-                <br>
-                <p>Regards,<br>SUNSTORE KOLHAPUR</p>
-            </body>
-            </html>
-            """
-            
-            params = {
-                "from": SENDER_EMAIL,
-                "to": [request.email],
-                "subject": "Password Reset - SUNSTORE KOLHAPUR CRM",
-                "html": html_content
-            }
-            
-            await asyncio.to_thread(resend.Emails.send, params)
-        except Exception as e:
-            logger.error(f"Failed to send email: {str(e)}")
+    html_content = f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; padding: 20px;">
+        <h2>Password Reset Request</h2>
+        <p>Hello {user['name']},</p>
+        <p>You requested to reset your password. Your reset token is:</p>
+        <p style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-family: monospace; font-size: 14px;">{reset_token}</p>
+        <p>This token will expire in 1 hour.</p>
+        <p>If you didn't request this, please ignore this email.</p>
+        <br>
+        <p>Regards,<br>SUNSTORE KOLHAPUR</p>
+    </body>
+    </html>
+    """
+    # Delivered by the outbox sender, so a slow provider never delays this response
+    await enqueue_email(
+        [request.email],
+        "Password Reset - SUNSTORE KOLHAPUR CRM",
+        html_content,
+        text=f"Your password reset token is:\n\n{reset_token}\n\nThis token will expire in 1 hour.",
+        kind="password_reset",
+        user_id=user["user_id"]
+    )
     
     return {"message": "If email exists, reset link will be sent", "token": reset_token}
 
@@ -358,7 +1261,7 @@ async def reset_password(request: ResetPasswordRequest):
         user_id = payload.get("sub")
         
         # Update password
-        hashed_password = hash_password(request.new_password)
+        hashed_password = await hash_password(request.new_password)
         result = await db.users.update_one(
             {"user_id": user_id},
             {"$set": {"password_hashed": hashed_password}}
@@ -367,6 +1270,9 @@ async def reset_password(request: ResetPasswordRequest):
         if result.modified_count == 0:
             raise HTTPException(status_code=404, detail="User not found")
         
+        # Sign out sessions opened with the old password
+        await revoke_user_tokens(user_id)
+        
         return {"message": "Password reset successful"}
     except JWTError:
         raise HTTPException(status_code=400, detail="Invalid or expired reset token")
@@ -375,19 +1281,214 @@ async def reset_password(request: ResetPasswordRequest):
 async def get_me(current_user: dict = Depends(get_current_user)):
     return current_user
 
+# ==================== CONDITIONAL WRITES ====================
+
+def version_guard(expected_version: Optional[int]) -> dict:
+    """Filter matching only the version an edit was based on; clients that send none are not checked."""
+    if expected_version is None:
+        return {}
+    if expected_version == 0:
+        # Records written before versioning have no version field
+        return {"version": {"$in": [0, None]}}
+    return {"version": expected_version}
+
+async def raise_write_conflict(collection: str, id_field: str, doc_id: str, label: str, expected_version: Optional[int]):
+    """Explain why a guarded write matched nothing. Only runs on the failure path."""
+    current = await db[collection].find_one({id_field: doc_id}, {"_id": 0, "is_locked": 1, "version": 1})
+    if current is None:
+        archive = next((spec["archive_collection"] for spec in PDF_DOCUMENT_TYPES.values() if spec["collection"] == collection), None)
+        if archive and await db[archive].find_one({id_field: doc_id}, {"_id": 1}):
+            raise HTTPException(status_code=423, detail=f"{label} is archived and cannot be changed")
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    if current.get("is_locked"):
+        raise HTTPException(status_code=423, detail=f"{label} is locked and cannot be changed")
+    raise HTTPException(
+        status_code=409,
+        detail=f"{label} was changed by someone else (now version {current.get('version', 0)}, "
+               f"your copy is version {expected_version}). Reload and try again."
+    )
+
+# ==================== PARTY MATCHING ====================
+
+# Words that carry no identity in party names ("M/s ABC Pvt. Ltd." == "ABC")
+PARTY_NAME_NOISE_WORDS = {"ms", "the", "pvt", "private", "ltd", "limited", "llp", "co", "company", "and"}
+PARTY_DUPLICATE_THRESHOLD = 0.88
+# Fields kept on party documents for lookups only, never returned to clients
+PARTY_MATCH_KEY_FIELDS = {"gst_key": 0, "name_key": 0}
+
+def normalize_gst_number(gst_number: Optional[str]) -> str:
+    return re.sub(r"[^0-9A-Z]", "", (gst_number or "").upper())
+
+def normalize_party_name(name: Optional[str]) -> str:
+    name = re.sub(r"\bm\s*/\s*s\b", " ", (name or "").lower()).replace("&", " and ")
+    tokens = re.sub(r"[^0-9a-z]+", " ", name).split()
+    return " ".join(t for t in tokens if t not in PARTY_NAME_NOISE_WORDS)
+
+def party_match_keys(party: dict) -> dict:
+    city = re.sub(r"[^0-9a-z]+", " ", (party.get("city") or "").lower()).strip()
+    return {
+        "gst_key": normalize_gst_number(party.get("GST_number")),
+        "name_key": f"{normalize_party_name(party.get('party_name'))}|{city}"
+    }
+
+def find_duplicate_party_clusters(parties: List[dict], threshold: float = PARTY_DUPLICATE_THRESHOLD) -> List[dict]:
+    """Cluster near-duplicate parties.
+
+    Candidates are only compared inside blocks (same canonical GST, or same
+    city and name prefix) so the scan stays close to linear in the number of
+    parties. Matches are joined with union-find into clusters.
+    """
+    parent = {p["party_id"]: p["party_id"] for p in parties}
+    scores: Dict[str, float] = {}
+    
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    
+    def union(a, b, score):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[rb] = ra
+        for pid in (a, b):
+            scores[pid] = max(scores.get(pid, 0), score)
+    
+    blocks: Dict[str, List[dict]] = {}
+    for party in parties:
+        keys = party_match_keys(party)
+        name, city = keys["name_key"].split("|", 1)
+        if keys["gst_key"]:
+            blocks.setdefault(f"gst:{keys['gst_key']}", []).append(party)
+        if name:
+            blocks.setdefault(f"name:{city}:{name[:4]}", []).append(party)
+    
+    for block_key, members in blocks.items():
+        if len(members) < 2:
+            continue
+        if block_key.startswith("gst:"):
+            for other in members[1:]:
+                union(members[0]["party_id"], other["party_id"], 1.0)
+            continue
+        names = [normalize_party_name(m.get("party_name")) for m in members]
+        for i in range(len(members)):
+            for j in range(i + 1, len(members)):
+                score = difflib.SequenceMatcher(None, names[i], names[j]).ratio()
+                if score >= threshold:
+                    union(members[i]["party_id"], members[j]["party_id"], round(score, 3))
+    
+    grouped: Dict[str, List[dict]] = {}
+    for party in parties:
+        grouped.setdefault(find(party["party_id"]), []).append(party)
+    
+    clusters = []
+    for members in grouped.values():
+        if len(members) < 2:
+            continue
+        # Suggest keeping the active record with a GST number and the oldest ID
+        members.sort(key=lambda p: (p.get("status") != "Active", not p.get("GST_number"), p["party_id"]))
+        clusters.append({
+            "suggested_keep_party_id": members[0]["party_id"],
+            "score": min(scores.get(m["party_id"], 0) for m in members),
+            "parties": members
+        })
+    clusters.sort(key=lambda c: -len(c["parties"]))
+    return clusters
+
+async def backfill_party_match_keys():
+    parties = await db.parties.find(
+        {"$or": [{"gst_key": {"$exists": False}}, {"name_key": {"$exists": False}}]},
+        {"_id": 0, "party_id": 1, "party_name": 1, "city": 1, "GST_number": 1}
+    ).to_list(None)
+    if parties:
+        await db.parties.bulk_write([
+            UpdateOne({"party_id": p["party_id"]}, {"$set": party_match_keys(p)}) for p in parties
+        ])
+
+# Archived documents are re-pointed too, so they never name a merged-away party
+PARTY_DOCUMENT_COLLECTIONS = [
+    "quotations", "proforma_invoices", "soa",
+    "quotations_archive", "proforma_invoices_archive", "soa_archive"
+]
+# Merges touching more documents than this run as a background job
+PARTY_MERGE_INLINE_LIMIT = int(os.environ.get("PARTY_MERGE_INLINE_LIMIT", "500"))
+
+async def _apply_party_merge(keep_party_id: str, merge_party_ids: List[str], session=None) -> dict:
+    repointed = {}
+    for collection_name in PARTY_DOCUMENT_COLLECTIONS:
+        result = await db[collection_name].update_many(
+            {"party_id": {"$in": merge_party_ids}},
+            {"$set": {"party_id": keep_party_id}},
+            session=session
+        )
+        repointed[collection_name] = result.modified_count
+    
+    await db.parties.update_many(
+        {"party_id": {"$in": merge_party_ids}},
+        {"$set": {"status": "Inactive", "merged_into": keep_party_id}},
+        session=session
+    )
+    return repointed
+
+async def merge_party_records(keep_party_id: str, merge_party_ids: List[str], user_id: str) -> dict:
+    # Re-point all documents and retire the merged parties atomically where the
+    # deployment supports transactions (replica set); standalone servers fall back
+    # to the same writes without one.
+    async with await client.start_session() as session:
+        try:
+            # with_transaction retries TransientTransactionError and unknown commit results
+            repointed = await session.with_transaction(
+                lambda s: _apply_party_merge(keep_party_id, merge_party_ids, s)
+            )
+        except OperationFailure as e:
+            if e.code != 20:  # IllegalOperation: transactions need a replica set
+                raise
+            logger.warning("Transactions unavailable, merging parties without one")
+            repointed = await _apply_party_merge(keep_party_id, merge_party_ids)
+    
+    await log_document_action(
+        "PARTY", keep_party_id, "MERGED", user_id,
+        details={"merged_party_ids": merge_party_ids, "repointed": repointed}
+    )
+    
+    return {"keep_party_id": keep_party_id, "merged_party_ids": merge_party_ids, "repointed": repointed}
+
+async def run_party_merge_job(job_id: str, params: dict, user_id: str) -> dict:
+    return await merge_party_records(params["keep_party_id"], params["merge_party_ids"], user_id)
+
+class PartyDuplicateScanRequest(BaseModel):
+    threshold: float = PARTY_DUPLICATE_THRESHOLD
+    include_inactive: bool = False
+
+async def run_party_dedup_job(job_id: str, params: dict, user_id: str) -> dict:
+    """Cluster the parties and store the clusters for the /parties/duplicates report."""
+    query = {} if params["include_inactive"] else {"status": "Active"}
+    parties = await db.parties.find(query, {"_id": 0, **PARTY_MATCH_KEY_FIELDS}).to_list(None)
+    clusters = await asyncio.to_thread(find_duplicate_party_clusters, parties, params["threshold"])
+    if clusters:
+        await db.party_duplicate_clusters.insert_many([
+            {"job_id": job_id, "cluster_no": cluster_no, **cluster} for cluster_no, cluster in enumerate(clusters)
+        ])
+    # The report only reads the latest scan
+    await db.party_duplicate_clusters.delete_many({"job_id": {"$ne": job_id}})
+    return {"party_count": len(parties), "cluster_count": len(clusters)}
+
 # ==================== PARTY ENDPOINTS ====================
 
 @api_router.post("/parties", response_model=Party)
 async def create_party(party_data: PartyCreate, current_user: dict = Depends(get_current_user)):
-    # Check for duplicate GST
-    existing_party = await db.parties.find_one({"GST_number": party_data.GST_number}, {"_id": 0})
-    if existing_party:
-        raise HTTPException(status_code=400, detail="Party with this GST number already exists")
+    party_dict = party_data.model_dump(exclude={"version"})
+    party_dict.update(party_match_keys(party_dict))
+    
+    # Check for duplicate GST (canonical form, so spacing and case don't matter)
+    if party_dict["gst_key"]:
+        existing_party = await db.parties.find_one({"gst_key": party_dict["gst_key"]}, {"_id": 0})
+        if existing_party:
+            raise HTTPException(status_code=400, detail="Party with this GST number already exists")
     
     party_count = await db.parties.count_documents({})
     party_id = f"PTY{str(party_count + 1).zfill(4)}"
     
-    party_dict = party_data.model_dump()
     party_dict["party_id"] = party_id
     party_dict["status"] = "Active"
     
@@ -400,9 +1501,84 @@ async def create_party(party_data: PartyCreate, current_user: dict = Depends(get
 
 @api_router.get("/parties", response_model=List[Party])
 async def get_parties(current_user: dict = Depends(get_current_user)):
-    parties = await db.parties.find({}, {"_id": 0}).to_list(1000)
+    parties = await db.parties.find({}, {"_id": 0, **PARTY_MATCH_KEY_FIELDS}).to_list(1000)
     return parties
 
+@api_router.post("/parties/duplicates/scan", status_code=202)
+async def start_party_duplicate_scan(scan: PartyDuplicateScanRequest, current_user: dict = Depends(get_current_user)):
+    # One scan at a time; a second request gets the one already running
+    await fail_stale_jobs({"job_type": "party_dedup"})
+    job = await db.jobs.find_one({"job_type": "party_dedup", "status": {"$in": ["queued", "running"]}}, {"_id": 0})
+    if not job:
+        job = await start_background_job("party_dedup", scan.model_dump(), current_user["user_id"], run_party_dedup_job)
+    return {"job_id": job["job_id"], "status": job["status"]}
+
+@api_router.get("/parties/duplicates")
+async def get_party_duplicates(current_user: dict = Depends(get_current_user)):
+    """Clusters from the latest completed scan, without parties merged away since."""
+    scan = await db.jobs.find_one(
+        {"job_type": "party_dedup", "status": "completed"}, {"_id": 0}, sort=[("updated_at", -1)]
+    )
+    if not scan:
+        return {"job_id": None, "scanned_at": None, "cluster_count": 0, "clusters": []}
+    
+    stored = await db.party_duplicate_clusters.find(
+        {"job_id": scan["job_id"]}, {"_id": 0, "job_id": 0}
+    ).sort("cluster_no", 1).to_list(None)
+    party_ids = [party["party_id"] for cluster in stored for party in cluster["parties"]]
+    current = {
+        party["party_id"]: party
+        async for party in db.parties.find({"party_id": {"$in": party_ids}}, {"_id": 0, **PARTY_MATCH_KEY_FIELDS})
+    }
+    
+    clusters = []
+    for cluster in stored:
+        members = [
+            current[party["party_id"]] for party in cluster["parties"]
+            if party["party_id"] in current and not current[party["party_id"]].get("merged_into")
+        ]
+        if len(members) < 2:
+            continue
+        if cluster["suggested_keep_party_id"] not in {party["party_id"] for party in members}:
+            cluster["suggested_keep_party_id"] = members[0]["party_id"]
+        cluster["parties"] = members
+        clusters.append(cluster)
+    return {"job_id": scan["job_id"], "scanned_at": scan["updated_at"], "cluster_count": len(clusters), "clusters": clusters}
+
+@api_router.post("/parties/merge")
+async def merge_parties(merge_data: PartyMergeRequest, response: Response, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "Admin":
+        raise HTTPException(status_code=403, detail="Only Admin can merge parties")
+    
+    keep_party_id = merge_data.keep_party_id
+    merge_party_ids = [pid for pid in dict.fromkeys(merge_data.merge_party_ids) if pid != keep_party_id]
+    if not merge_party_ids:
+        raise HTTPException(status_code=400, detail="No parties to merge")
+    
+    keep_party = await db.parties.find_one({"party_id": keep_party_id}, {"_id": 0, "status": 1, "merged_into": 1})
+    found = await db.parties.count_documents({"party_id": {"$in": merge_party_ids}})
+    if keep_party is None or found != len(merge_party_ids):
+        raise HTTPException(status_code=404, detail="Party not found")
+    # Documents moved to an inactive or already merged party would disappear from the party lists
+    if keep_party.get("merged_into") or keep_party.get("status") == "Inactive":
+        raise HTTPException(status_code=400, detail="Parties can only be merged into an active party")
+    
+    document_count = 0
+    for collection_name in PARTY_DOCUMENT_COLLECTIONS:
+        document_count += await db[collection_name].count_documents({"party_id": {"$in": merge_party_ids}})
+    
+    if document_count > PARTY_MERGE_INLINE_LIMIT:
+        job = await start_background_job(
+            "PARTY_MERGE",
+            {"keep_party_id": keep_party_id, "merge_party_ids": merge_party_ids, "document_count": document_count},
+            current_user["user_id"],
+            run_party_merge_job
+        )
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Party merge started", "job_id": job["job_id"]}
+    
+    return await merge_party_records(keep_party_id, merge_party_ids, current_user["user_id"])
+
 @api_router.get("/parties/{party_id}", response_model=Party)
 async def get_party(party_id: str, current_user: dict = Depends(get_current_user)):
     party = await db.parties.find_one({"party_id": party_id}, {"_id": 0})
@@ -412,29 +1588,41 @@ async def get_party(party_id: str, current_user: dict = Depends(get_current_user
 
 @api_router.put("/parties/{party_id}", response_model=Party)
 async def update_party(party_id: str, party_data: PartyCreate, current_user: dict = Depends(get_current_user)):
-    # Check if GST is being changed and if it conflicts
-    existing_party = await db.parties.find_one({"party_id": party_id}, {"_id": 0})
-    if not existing_party:
-        raise HTTPException(status_code=404, detail="Party not found")
-    
-    if existing_party["GST_number"] != party_data.GST_number:
-        duplicate = await db.parties.find_one(
-            {"GST_number": party_data.GST_number, "party_id": {"$ne": party_id}},
-            {"_id": 0}
+    party_dict = party_data.model_dump(exclude={"version"})
+    match_keys = party_match_keys(party_dict)
+    guard = {"party_id": party_id, **version_guard(party_data.version)}
+    update = {"$set": {**party_dict, **match_keys}, "$inc": {"version": 1}}
+    
+    # Most edits keep the GST number; matching the stored gst_key saves those the uniqueness check
+    party = await db.parties.find_one_and_update(
+        {**guard, "gst_key": match_keys["gst_key"]},
+        update,
+        projection={"_id": 0, **PARTY_MATCH_KEY_FIELDS},
+        return_document=ReturnDocument.AFTER
+    )
+    if party is None:
+        current = await db.parties.find_one({"party_id": party_id}, {"_id": 0, "gst_key": 1})
+        if current is None or current.get("gst_key") == match_keys["gst_key"]:
+            # Same GST, so it was the version guard that failed
+            await raise_write_conflict("parties", "party_id", party_id, "Party", party_data.version)
+        # GST must stay unique; parties merged into this one keep their GST but do not count
+        if match_keys["gst_key"]:
+            duplicate = await db.parties.find_one(
+                {"gst_key": match_keys["gst_key"], "party_id": {"$ne": party_id}, "merged_into": {"$ne": party_id}},
+                {"_id": 0, "party_id": 1}
+            )
+            if duplicate:
+                raise HTTPException(status_code=400, detail="Party with this GST number already exists")
+        party = await db.parties.find_one_and_update(
+            guard, update, projection={"_id": 0, **PARTY_MATCH_KEY_FIELDS}, return_document=ReturnDocument.AFTER
         )
-        if duplicate:
-            raise HTTPException(status_code=400, detail="Party with this GST number already exists")
-    
-    party_dict = party_data.model_dump()
-    party_dict["status"] = existing_party.get("status", "Active")
-    
-    await db.parties.update_one({"party_id": party_id}, {"$set": party_dict})
+        if party is None:
+            await raise_write_conflict("parties", "party_id", party_id, "Party", party_data.version)
     
     # Log
     await log_document_action("PARTY", party_id, "UPDATED", current_user["user_id"])
     
-    party_dict["party_id"] = party_id
-    return party_dict
+    return party
 
 @api_router.delete("/parties/{party_id}")
 async def delete_party(party_id: str, current_user: dict = Depends(get_current_user)):
@@ -452,7 +1640,7 @@ async def delete_party(party_id: str, current_user: dict = Depends(get_current_u
 
 @api_router.post("/parties/{party_id}/duplicate")
 async def duplicate_party(party_id: str, current_user: dict = Depends(get_current_user)):
-    party = await db.parties.find_one({"party_id": party_id}, {"_id": 0})
+    party = await db.parties.find_one({"party_id": party_id}, {"_id": 0, **PARTY_MATCH_KEY_FIELDS})
     if not party:
         raise HTTPException(status_code=404, detail="Party not found")
     
@@ -463,6 +1651,7 @@ async def duplicate_party(party_id: str, current_user: dict = Depends(get_curren
     new_party["party_id"] = new_party_id
     new_party["party_name"] = f"{party['party_name']} (Copy)"
     new_party["GST_number"] = ""  # Clear GST to avoid duplicate
+    new_party.update(party_match_keys(new_party))
     
     await db.parties.insert_one(new_party)
     await log_document_action("PARTY", new_party_id, "DUPLICATED", current_user["user_id"])
@@ -471,10 +1660,10 @@ async def duplicate_party(party_id: str, current_user: dict = Depends(get_curren
 
 @api_router.get("/parties/export/csv")
 async def export_parties_csv(current_user: dict = Depends(get_current_user)):
-    parties = await db.parties.find({}, {"_id": 0}).to_list(1000)
+    parties = await db.parties.find({}, {"_id": 0, **PARTY_MATCH_KEY_FIELDS}).to_list(1000)
     
     output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=["party_id", "party_name", "address", "city", "state", "pincode", "GST_number", "contact_person", "mobile", "email", "status"])
+    writer = csv.DictWriter(output, fieldnames=["party_id", "party_name", "address", "city", "state", "pincode", "GST_number", "contact_person", "mobile", "email", "status"], extrasaction="ignore")
     writer.writeheader()
     writer.writerows(parties)
     
@@ -490,15 +1679,23 @@ async def upload_parties_csv(file: UploadFile = File(...), current_user: dict =
     added_count = 0
     skipped_count = 0
     
+    # Load the lookup keys once instead of querying per row
+    existing_keys = await db.parties.find({}, {"_id": 0, "gst_key": 1, "name_key": 1}).to_list(None)
+    known_gst_keys = {k["gst_key"] for k in existing_keys if k.get("gst_key")}
+    known_name_keys = {k["name_key"] for k in existing_keys if k.get("name_key")}
+    party_count = await db.parties.count_documents({})
+    
     for row in reader:
-        # Check if party with GST number already exists
-        existing = await db.parties.find_one({"GST_number": row.get("GST_number")}, {"_id": 0})
-        if existing:
+        # Skip if a party with the same canonical GST (or, without GST, the same name and city) exists
+        match_keys = party_match_keys(row)
+        if match_keys["gst_key"] in known_gst_keys or (
+            not match_keys["gst_key"] and match_keys["name_key"] in known_name_keys
+        ):
             skipped_count += 1
             continue
         
-        party_count = await db.parties.count_documents({})
-        party_id = f"PTY{str(party_count + 1).zfill(4)}"
+        party_count += 1
+        party_id = f"PTY{str(party_count).zfill(4)}"
         
         party_dict = {
             "party_id": party_id,
@@ -511,10 +1708,14 @@ async def upload_parties_csv(file: UploadFile = File(...), current_user: dict =
             "contact_person": row.get("contact_person", ""),
             "mobile": row.get("mobile", ""),
             "email": row.get("email", ""),
-            "status": row.get("status", "Active")
+            "status": row.get("status", "Active"),
+            **match_keys
         }
         
         await db.parties.insert_one(party_dict)
+        if match_keys["gst_key"]:
+            known_gst_keys.add(match_keys["gst_key"])
+        known_name_keys.add(match_keys["name_key"])
         
         # Log
         await log_document_action("PARTY", party_id, "CREATED", current_user["user_id"])
@@ -539,16 +1740,33 @@ async def create_item(item_data: ItemCreate, current_user: dict = Depends(get_cu
     item_dict["item_id"] = item_id
     
     await db.items.insert_one(item_dict)
+    await invalidate_item_facets()
     
     return item_dict
 
-@api_router.get("/items", response_model=List[Item])
-async def get_items(
+# Facet counts are cached per brand/category/UOM combination. Every item write through the API
+# bumps a stamp in Mongo, and each worker drops its entries when it sees a new stamp; the TTL only
+# bounds staleness after writes made outside the API (imports and scripts).
+# Free-text searches are one-offs and not cached; least recently used entries go past the limit.
+ITEM_FACET_CACHE_TTL_SECONDS = int(os.environ.get("ITEM_FACET_CACHE_TTL_SECONDS", "300"))
+ITEM_FACET_CACHE_MAX_ENTRIES = int(os.environ.get("ITEM_FACET_CACHE_MAX_ENTRIES", "256"))
+ITEM_FACET_STAMP_ID = "item_facets"
+_item_facet_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+async def invalidate_item_facets():
+    _item_facet_cache.clear()
+    await db.counters.update_one({"_id": ITEM_FACET_STAMP_ID}, {"$inc": {"seq": 1}}, upsert=True)
+
+async def item_facet_stamp() -> int:
+    stamp = await db.counters.find_one({"_id": ITEM_FACET_STAMP_ID})
+    return stamp["seq"] if stamp else 0
+
+def build_item_query(
     search: Optional[str] = None,
     brand: Optional[str] = None,
     category: Optional[str] = None,
-    current_user: dict = Depends(get_current_user)
-):
+    uom: Optional[str] = None
+) -> dict:
     query = {}
     if search:
         query["$or"] = [
@@ -559,10 +1777,75 @@ async def get_items(
         query["brand"] = {"$regex": brand, "$options": "i"}
     if category:
         query["category"] = {"$regex": category, "$options": "i"}
+    if uom:
+        query["UOM"] = uom
+    return query
+
+@api_router.get("/items", response_model=List[Item])
+async def get_items(
+    search: Optional[str] = None,
+    brand: Optional[str] = None,
+    category: Optional[str] = None,
+    uom: Optional[str] = None,
+    limit: int = 1000,
+    current_user: dict = Depends(get_current_user)
+):
+    query = build_item_query(search, brand, category, uom)
+    limit = max(1, min(limit, 1000))
     
-    items = await db.items.find(query, {"_id": 0}).to_list(1000)
+    items = await db.items.find(query, {"_id": 0}).limit(limit).to_list(limit)
     return items
 
+@api_router.get("/items/facets")
+async def get_item_facets(
+    search: Optional[str] = None,
+    brand: Optional[str] = None,
+    category: Optional[str] = None,
+    uom: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    cache_key = None if search else (brand or "", category or "", uom or "")
+    stamp = await item_facet_stamp() if cache_key else None
+    cached = _item_facet_cache.get(cache_key) if cache_key else None
+    if cached and cached[1] == stamp and time.monotonic() - cached[0] < ITEM_FACET_CACHE_TTL_SECONDS:
+        _item_facet_cache.move_to_end(cache_key)
+        return cached[2]
+    
+    def facet_on(field: str, query: dict) -> list:
+        # Each dimension is counted under every filter except its own, so the
+        # brands facet still lists the other brands once one is picked
+        return [
+            {"$match": query},
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1, "_id": 1}}
+        ]
+    
+    pipeline = [
+        {"$match": build_item_query(search)},
+        {"$facet": {
+            "brands": facet_on("brand", build_item_query(category=category, uom=uom)),
+            "categories": facet_on("category", build_item_query(brand=brand, uom=uom)),
+            "uoms": facet_on("UOM", build_item_query(brand=brand, category=category)),
+            "total": [{"$match": build_item_query(brand=brand, category=category, uom=uom)}, {"$count": "count"}]
+        }}
+    ]
+    result = await db.items.aggregate(pipeline).to_list(1)
+    buckets = result[0] if result else {}
+    
+    facets = {
+        "brands": [{"value": b["_id"] or "", "count": b["count"]} for b in buckets.get("brands", [])],
+        "categories": [{"value": c["_id"] or "", "count": c["count"]} for c in buckets.get("categories", [])],
+        "uoms": [{"value": u["_id"] or "", "count": u["count"]} for u in buckets.get("uoms", [])],
+        "total": buckets["total"][0]["count"] if buckets.get("total") else 0
+    }
+    
+    if cache_key:
+        _item_facet_cache[cache_key] = (time.monotonic(), stamp, facets)
+        _item_facet_cache.move_to_end(cache_key)
+        if len(_item_facet_cache) > ITEM_FACET_CACHE_MAX_ENTRIES:
+            _item_facet_cache.popitem(last=False)
+    return facets
+
 @api_router.get("/items/{item_id}", response_model=Item)
 async def get_item(item_id: str, current_user: dict = Depends(get_current_user)):
     item = await db.items.find_one({"item_id": item_id}, {"_id": 0})
@@ -586,15 +1869,20 @@ async def update_item(item_id: str, item_data: ItemCreate, current_user: dict =
     
     item_dict = item_data.model_dump()
     await db.items.update_one({"item_id": item_id}, {"$set": item_dict})
+    await invalidate_item_facets()
     
     item_dict["item_id"] = item_id
     return item_dict
 
 @api_router.delete("/items/{item_id}")
 async def delete_item(item_id: str, current_user: dict = Depends(get_current_user)):
+    in_use = await count_item_references([item_id])
+    if in_use:
+        raise HTTPException(status_code=409, detail=f"Item is used in {in_use[item_id]} document(s) and cannot be deleted")
     result = await db.items.delete_one({"item_id": item_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Item not found")
+    await invalidate_item_facets()
     return {"message": "Item deleted successfully"}
 
 @api_router.post("/items/{item_id}/duplicate")
@@ -612,6 +1900,7 @@ async def duplicate_item(item_id: str, current_user: dict = Depends(get_current_
     new_item["item_name"] = f"{item.get('item_name', '')} (Copy)"
     
     await db.items.insert_one(new_item)
+    await invalidate_item_facets()
     
     return {"message": "Item duplicated successfully", "item_id": new_item_id}
 
@@ -666,6 +1955,9 @@ async def upload_items_csv(file: UploadFile = File(...), current_user: dict = De
         await db.items.insert_one(item_dict)
         added_count += 1
     
+    if added_count:
+        await invalidate_item_facets()
+    
     return {"message": f"Added {added_count} items, skipped {skipped_count} duplicates"}
 
 # ==================== LEAD ENDPOINTS ====================
@@ -675,7 +1967,7 @@ async def create_lead(lead_data: LeadCreate, current_user: dict = Depends(get_cu
     lead_count = await db.leads.count_documents({})
     lead_id = f"LEAD{str(lead_count + 1).zfill(4)}"
     
-    lead_dict = lead_data.model_dump()
+    lead_dict = lead_data.model_dump(exclude={"version"})
     lead_dict["lead_id"] = lead_id
     lead_dict["created_by_user_id"] = current_user["user_id"]
     lead_dict["lead_date"] = datetime.now(timezone.utc).isoformat()
@@ -745,21 +2037,19 @@ async def get_lead(lead_id: str, current_user: dict = Depends(get_current_user))
 
 @api_router.put("/leads/{lead_id}", response_model=Lead)
 async def update_lead(lead_id: str, lead_data: LeadCreate, current_user: dict = Depends(get_current_user)):
-    existing_lead = await db.leads.find_one({"lead_id": lead_id}, {"_id": 0})
-    if not existing_lead:
-        raise HTTPException(status_code=404, detail="Lead not found")
-    
-    lead_dict = lead_data.model_dump()
-    await db.leads.update_one({"lead_id": lead_id}, {"$set": lead_dict})
+    lead = await db.leads.find_one_and_update(
+        {"lead_id": lead_id, **version_guard(lead_data.version)},
+        {"$set": lead_data.model_dump(exclude={"version"}), "$inc": {"version": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if lead is None:
+        await raise_write_conflict("leads", "lead_id", lead_id, "Lead", lead_data.version)
     
     # Log
     await log_document_action("LEAD", lead_id, "UPDATED", current_user["user_id"])
     
-    lead_dict["lead_id"] = lead_id
-    lead_dict["created_by_user_id"] = existing_lead["created_by_user_id"]
-    lead_dict["lead_date"] = existing_lead["lead_date"]
-    lead_dict["status"] = existing_lead["status"]
-    return lead_dict
+    return lead
 
 @api_router.post("/leads/{lead_id}/convert")
 async def convert_lead_to_quotation(lead_id: str, current_user: dict = Depends(get_current_user)):
@@ -779,184 +2069,456 @@ async def convert_lead_to_quotation(lead_id: str, current_user: dict = Depends(g
     return {"message": "Lead converted successfully", "lead_id": lead_id}
 
 @api_router.delete("/leads/{lead_id}")
-async def delete_lead(lead_id: str, current_user: dict = Depends(get_current_user)):
-    lead = await db.leads.find_one({"lead_id": lead_id}, {"_id": 0})
-    if not lead:
-        raise HTTPException(status_code=404, detail="Lead not found")
-    
-    # Delete the lead
-    await db.leads.delete_one({"lead_id": lead_id})
+async def delete_lead(lead_id: str, version: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    lead = await db.leads.find_one_and_delete({"lead_id": lead_id, **version_guard(version)}, projection={"_id": 0, "lead_id": 1})
+    if lead is None:
+        await raise_write_conflict("leads", "lead_id", lead_id, "Lead", version)
     
     # Log the deletion
     await log_document_action("LEAD", lead_id, "DELETED", current_user["user_id"])
     
     return {"message": "Lead deleted successfully"}
 
+# Stylesheet class per lead status; anything else renders unstyled
+LEAD_STATUS_CLASSES = {"Open": "status-open", "Converted": "status-converted", "Lost": "status-lost"}
+
 @api_router.get("/leads/{lead_id}/pdf")
-async def generate_lead_pdf(lead_id: str, current_user: dict = Depends(get_current_user)):
-    lead = await db.leads.find_one({"lead_id": lead_id}, {"_id": 0})
-    if not lead:
-        raise HTTPException(status_code=404, detail="Lead not found")
-    
-    party = await db.parties.find_one({"party_id": lead["party_id"]}, {"_id": 0})
-    user = await db.users.find_one({"user_id": lead["created_by_user_id"]}, {"_id": 0})
-    
-    # Load letterhead image
-    letterhead_base64 = ""
-    try:
-        import base64
-        letterhead_path = Path(__file__).parent / 'letterhead.png'
-        if letterhead_path.exists():
-            with open(letterhead_path, 'rb') as f:
-                letterhead_base64 = base64.b64encode(f.read()).decode('utf-8')
-    except Exception as e:
-        logger.error(f"Failed to load letterhead: {e}")
-    
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <style>
-            @page {{ size: A4; margin: 0.5cm 1cm; }}
-            body {{ font-family: Arial, sans-serif; font-size: 11px; margin: 0; padding: 0; }}
-            .header {{ margin-bottom: 15px; }}
-            .header img {{ width: 100%; height: auto; max-height: 120px; object-fit: contain; }}
-            .doc-title {{ font-size: 16px; font-weight: bold; color: #000; margin: 15px 0; text-align: center; background: #f0f0f0; padding: 10px; }}
-            .info-section {{ margin: 15px 0; }}
-            .info-label {{ font-weight: bold; display: inline-block; width: 150px; }}
-            .info-value {{ display: inline-block; }}
-            .section-title {{ font-size: 13px; font-weight: bold; margin-top: 20px; margin-bottom: 10px; background: #e0e0e0; padding: 8px; }}
-            .content-box {{ border: 1px solid #ddd; padding: 15px; margin: 10px 0; background: #fafafa; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            {f'<img src="data:image/png;base64,{letterhead_base64}" alt="Letterhead" />' if letterhead_base64 else '''
-            <div style="text-align: center; border-bottom: 2px solid #333; padding-bottom: 10px;">
-                <div style="font-size: 16px; font-weight: bold;">SUNSTORE KOLHAPUR</div>
-                <div style="font-size: 9px;">
-                    Plot No. 1497, Shamrao Kapadi Complex, Opposite HDFC Bank, Konda Lane, Laxmipuri,<br>
-                    Kolhapur - 416002, Maharashtra, India<br>
-                    Phone: 0231 - 2644990 / 91 / 92 | Email: sales@sunstorekolhapur.com<br>
-                    <strong>GST ID: 27ABAFM4283A1ZL</strong>
-                </div>
-            </div>
-            '''}
-        </div>
+async def generate_lead_pdf(lead_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    with pdf_render_trace("lead", lead_id):
+        with pdf_stage("fetch_doc"):
+            lead = await db.leads.find_one({"lead_id": lead_id}, {"_id": 0})
+        if not lead:
+            raise HTTPException(status_code=404, detail="Lead not found")
         
-        <div class="doc-title">LEAD INFORMATION</div>
+        # Leads carry free-text party details; older leads may still reference the Party Master
+        with pdf_stage("fetch_party"):
+            party = None
+            if lead.get("party_id"):
+                party = await db.parties.find_one({"party_id": lead["party_id"]}, {"_id": 0})
+            if not party:
+                party = {
+                    "party_name": lead.get("party_name", ""),
+                    "address": lead.get("party_address", ""),
+                    "city": lead.get("party_city", ""),
+                    "GST_number": lead.get("party_gst", ""),
+                    "contact_person": lead.get("contact_name", ""),
+                    "mobile": lead.get("contact_mobile", "")
+                }
+            user = await db.users.find_one({"user_id": lead["created_by_user_id"]}, {"_id": 0, "name": 1})
         
-        <div class="info-section">
-            <div><span class="info-label">Lead ID:</span> <span class="info-value">{lead['lead_id']}</span></div>
-            <div><span class="info-label">Lead Date:</span> <span class="info-value">{lead['lead_date'][:10]}</span></div>
-            <div><span class="info-label">Status:</span> <span class="info-value" style="color: {'green' if lead['status'] == 'Open' else ('blue' if lead['status'] == 'Converted' else 'red')}; font-weight: bold;">{lead['status']}</span></div>
-            <div><span class="info-label">Created By:</span> <span class="info-value">{user.get('name', 'N/A') if user else 'N/A'}</span></div>
-        </div>
+        with pdf_stage("generate_html"):
+            html_content = render_template(
+                "lead.html",
+                lead=lead,
+                party=party,
+                created_by=user.get("name") if user else None,
+                status_class=LEAD_STATUS_CLASSES.get(lead.get("status"), ""),
+                letterhead_src=await resolve_letterhead_src()
+            )
         
-        <div class="section-title">PARTY DETAILS</div>
-        <div class="content-box">
-            <div><strong>Party Name:</strong> {party['party_name'] if party else 'N/A'}</div>
-            <div><strong>Address:</strong> {party['address'] if party else 'N/A'}, {party.get('city', 'N/A')}, {party.get('state', 'N/A')} - {party.get('pincode', 'N/A')}</div>
-            <div><strong>GST Number:</strong> {party.get('GST_number', 'N/A') if party else 'N/A'}</div>
-            <div><strong>Contact Person:</strong> {party.get('contact_person', 'N/A') if party else 'N/A'}</div>
-            <div><strong>Mobile:</strong> {party.get('mobile', 'N/A') if party else 'N/A'}</div>
-            <div><strong>Email:</strong> {party.get('email', 'N/A') if party else 'N/A'}</div>
-        </div>
+        # Nothing time-dependent is in the HTML, so it identifies the PDF before rendering
+        etag = rendered_pdf_etag(html_content)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=pdf_cache_headers(etag, cacheable=False))
+        pdf = await render_pdf_async(html_content)
         
-        <div class="section-title">LEAD DETAILS</div>
-        <div class="content-box">
-            <div><strong>Contact Name:</strong> {lead['contact_name']}</div>
-            <div><strong>Referred By:</strong> {lead.get('referred_by', 'N/A')}</div>
-        </div>
+        # Generate filename with username and timestamp
+        username = current_user["name"].replace(" ", "_").lower()[:10]
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"lead_{lead['lead_id']}_{username}_{timestamp}.pdf"
         
-        <div class="section-title">REQUIREMENT SUMMARY</div>
-        <div class="content-box">
-            {lead['requirement_summary']}
-        </div>
-        
-        <div class="section-title">NOTES</div>
-        <div class="content-box">
-            {lead.get('notes', 'No additional notes')}
-        </div>
-        
-        <div style="margin-top: 40px; text-align: center; font-size: 10px; color: #666;">
-            <p>This is a computer-generated document. No signature is required.</p>
-            <p>Generated on: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')} UTC</p>
-        </div>
-    </body>
-    </html>
-    """
-    
-    pdf = HTML(string=html_content).write_pdf()
-    
-    # Generate filename with username and timestamp
-    username = current_user["name"].replace(" ", "_").lower()[:10]
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"lead_{lead['lead_id']}_{username}_{timestamp}.pdf"
+        with pdf_stage("response"):
+            return pdf_response(request, filename, content=pdf, etag=etag)
+
+# ==================== TAX SUMMARY ====================
+
+def summarize_document_taxes(items: List[dict]) -> dict:
+    """Totals and the HSN-wise GST split of a document's lines.
     
-    return Response(
-        content=pdf,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    Worked out once whenever the lines are written and stored on the
+    document as `totals` and `hsn_summary`; PDFs and reports read them
+    from there.
+    """
+    groups = {}
+    for item in items:
+        hsn = item.get("HSN") or "HSN/SAC"
+        # Grouped by tax type too, so a document mixing CGST+SGST and IGST lines keeps all its tax
+        group = groups.setdefault((hsn, item["tax_type"]), {"hsn": hsn, "tax_type": item["tax_type"], "taxable": 0, "cgst": 0, "sgst": 0, "igst": 0})
+        group["taxable"] += item["taxable_amount"]
+        if item["tax_type"] == "CGST+SGST":
+            group["cgst"] += item["tax_amount"] / 2
+            group["sgst"] += item["tax_amount"] / 2
+        else:
+            group["igst"] += item["tax_amount"]
+    
+    totals = {"cgst": 0, "sgst": 0, "igst": 0}
+    for group in groups.values():
+        taxable = group["taxable"]
+        if group["tax_type"] == "CGST+SGST":
+            group["cgst_rate"] = round(group["cgst"] / taxable * 100, 2) if taxable > 0 else 9.0
+            group["sgst_rate"] = round(group["sgst"] / taxable * 100, 2) if taxable > 0 else 9.0
+            totals["cgst"] += group["cgst"]
+            totals["sgst"] += group["sgst"]
+        else:
+            group["igst_rate"] = round(group["igst"] / taxable * 100, 2) if taxable > 0 else 18.0
+            totals["igst"] += group["igst"]
+        for field in ("taxable", "cgst", "sgst", "igst"):
+            group[field] = round(group[field], 2)
+    
+    totals.update(
+        subtotal=sum(item["taxable_amount"] for item in items),
+        tax_total=sum(item["tax_amount"] for item in items),
+        grand_total=sum(item["total_amount"] for item in items)
     )
+    return {
+        "totals": {field: round(value, 2) for field, value in totals.items()},
+        "hsn_summary": list(groups.values())
+    }
 
-# ==================== QUOTATION ENDPOINTS ====================
+async def master_hsn_codes(item_ids) -> Dict[str, str]:
+    if not item_ids:
+        return {}
+    return {
+        item["item_id"]: item.get("HSN", "")
+        async for item in db.items.find({"item_id": {"$in": list(item_ids)}}, {"_id": 0, "item_id": 1, "HSN": 1})
+    }
 
-async def get_next_number(doc_type: str) -> str:
-    settings = await db.settings.find_one({"settings_id": "default"}, {"_id": 0})
-    if not settings:
-        settings = {
-            "quotation_prefix": "QTN",
-            "pi_prefix": "PI",
-            "soa_prefix": "SOA"
-        }
+def with_master_hsn(items: List[dict], masters: Dict[str, str]) -> List[dict]:
+    return [item if item.get("HSN") else {**item, "HSN": masters.get(item["item_id"], "")} for item in items]
+
+async def document_tax_fields(items: List[dict]) -> dict:
+    """summarize_document_taxes, taking HSN codes from the items master for lines saved without one."""
+    masters = await master_hsn_codes({item["item_id"] for item in items if not item.get("HSN")})
+    return summarize_document_taxes(with_master_hsn(items, masters))
+
+TAX_BACKFILL_BATCH_SIZE = 500
+# Collections this worker knows have totals on every document
+_tax_totals_complete = set()
+
+async def backfill_collection_totals(collection_name: str, id_field: str) -> int:
+    collection = db[collection_name]
+    filled = 0
+    cursor = collection.find({"totals": {"$exists": False}}, {"_id": 0, id_field: 1, "items": 1})
+    while docs := await cursor.to_list(TAX_BACKFILL_BATCH_SIZE):
+        # One items master lookup per batch for the lines saved without an HSN code
+        masters = await master_hsn_codes({
+            item["item_id"] for doc in docs for item in doc.get("items", []) if not item.get("HSN")
+        })
+        filled += (await collection.bulk_write([
+            UpdateOne(
+                {id_field: doc[id_field], "totals": {"$exists": False}},
+                {"$set": summarize_document_taxes(with_master_hsn(doc.get("items", []), masters))}
+            )
+            for doc in docs
+        ], ordered=False)).modified_count
+    _tax_totals_complete.add(collection_name)
+    return filled
+
+async def ensure_document_totals(collection_names: List[str]):
+    """Reports sum stored totals, so fill any still missing before aggregating."""
+    for spec in PDF_DOCUMENT_TYPES.values():
+        for collection_name in (spec["collection"], spec["archive_collection"]):
+            if collection_name in collection_names and collection_name not in _tax_totals_complete:
+                await backfill_collection_totals(collection_name, spec["id_field"])
+
+async def backfill_document_totals():
+    """Store totals and hsn_summary on documents written before they were kept."""
+    # One worker per hour does the scan; the others find out per collection when a report needs it
+    if not await claim_lease("tax_backfill", 3600):
+        return
+    filled = 0
+    for spec in PDF_DOCUMENT_TYPES.values():
+        for collection_name in (spec["collection"], spec["archive_collection"]):
+            filled += await backfill_collection_totals(collection_name, spec["id_field"])
+    if filled:
+        logger.info(f"Stored tax totals on {filled} existing documents")
+
+# ==================== DOCUMENT PATCHES ====================
+
+# Line fields the server derives; clients may not set them in a patch
+LINE_COMPUTED_FIELDS = {"taxable_amount", "tax_type", "tax_amount", "total_amount"}
+# Line fields copied from the items master when a line is added without them or its item changes
+LINE_SNAPSHOT_FIELDS = ("item_name", "item_code", "UOM", "HSN", "GST_percent")
+# Parties registered in this state are billed CGST+SGST, everyone else IGST
+HOME_STATE_GST_CODE = "27"  # Maharashtra
+
+class DocumentPatchOp(BaseModel):
+    op: str  # add, remove or replace
+    path: str  # /items/3, /items/3/qty, /items/- (append) or /<header field>
+    value: Any = None
+
+class DocumentPatch(BaseModel):
+    version: int  # Line positions refer to this version of the document
+    ops: List[DocumentPatchOp]
+
+def calculate_line_totals(line: dict, party: Optional[dict]) -> dict:
+    """Same arithmetic as the document forms."""
+    taxable = float(line.get("qty") or 0) * float(line.get("rate") or 0) * (1 - float(line.get("discount_percent") or 0) / 100)
+    gst_percent = float(line["GST_percent"]) if line.get("GST_percent") is not None else 18.0
+    tax_amount = taxable * gst_percent / 100
+    return {
+        **line,
+        "taxable_amount": taxable,
+        "tax_type": "CGST+SGST" if (party or {}).get("GST_number", "").startswith(HOME_STATE_GST_CODE) else "IGST",
+        "tax_amount": tax_amount,
+        "total_amount": taxable + tax_amount
+    }
+
+def parse_patch_path(path: str) -> List[str]:
+    if not path.startswith("/"):
+        raise HTTPException(status_code=400, detail=f"Invalid patch path: {path}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+def patch_line_index(token: str, size: int, allow_end: bool = False) -> int:
+    if allow_end and token == "-":
+        return size
+    if not token.isdigit() or int(token) >= size + (1 if allow_end else 0):
+        raise HTTPException(status_code=400, detail=f"Line {token} does not exist")
+    return int(token)
+
+def apply_document_patch(doc: dict, ops: List[DocumentPatchOp], header_fields: set) -> Tuple[dict, List[dict], List[bool]]:
+    """Apply ops to a copy of the document.
     
-    if doc_type == "quotation":
-        count = await db.quotations.count_documents({})
-        prefix = settings.get("quotation_prefix", "QTN")
-    elif doc_type == "pi":
-        count = await db.proforma_invoices.count_documents({})
-        prefix = settings.get("pi_prefix", "PI")
-    elif doc_type == "soa":
-        count = await db.soa.count_documents({})
-        prefix = settings.get("soa_prefix", "SOA")
-    else:
-        prefix = "DOC"
-        count = 0
+    Returns the new header values, the new lines and, per line, whether it
+    was added or changed and so needs its totals recomputed.
+    """
+    header = {}
+    lines = [(line, False) for line in doc["items"]]
+    for op in ops:
+        tokens = parse_patch_path(op.path)
+        if tokens[0] == "items" and len(tokens) in (2, 3):
+            if op.op == "add" and len(tokens) == 2:
+                if not isinstance(op.value, dict):
+                    raise HTTPException(status_code=400, detail="An added line must be an object")
+                lines.insert(patch_line_index(tokens[1], len(lines), allow_end=True), (dict(op.value), True))
+            elif op.op == "remove" and len(tokens) == 2:
+                lines.pop(patch_line_index(tokens[1], len(lines)))
+            elif op.op == "replace" and len(tokens) == 2:
+                if not isinstance(op.value, dict):
+                    raise HTTPException(status_code=400, detail="A replaced line must be an object")
+                lines[patch_line_index(tokens[1], len(lines))] = (dict(op.value), True)
+            elif op.op == "replace":
+                index = patch_line_index(tokens[1], len(lines))
+                field = tokens[2]
+                if field in LINE_COMPUTED_FIELDS or field not in QuotationItemBase.model_fields:
+                    raise HTTPException(status_code=400, detail=f"Line field {field} cannot be patched")
+                line = lines[index][0]
+                if field == "item_id" and op.value != line.get("item_id"):
+                    # A different item: drop the old item's snapshot and rate so the master refills them
+                    line = {k: v for k, v in line.items() if k not in LINE_SNAPSHOT_FIELDS and k != "rate"}
+                lines[index] = ({**line, field: op.value}, True)
+            else:
+                raise HTTPException(status_code=400, detail=f"Unsupported patch: {op.op} {op.path}")
+        elif len(tokens) == 1 and tokens[0] in header_fields and op.op in ("add", "replace"):
+            header[tokens[0]] = op.value
+        else:
+            raise HTTPException(status_code=400, detail=f"Unsupported patch: {op.op} {op.path}")
     
-    return f"{prefix}{str(count + 1).zfill(4)}"
+    if "party_id" in header and header["party_id"] != doc["party_id"]:
+        # The party decides CGST+SGST vs IGST on every line
+        lines = [(line, True) for line, _ in lines]
+    return header, [line for line, _ in lines], [dirty for _, dirty in lines]
 
-@api_router.post("/quotations", response_model=Quotation)
-async def create_quotation(quotation_data: QuotationCreate, current_user: dict = Depends(get_current_user)):
-    base_quotation_no = await get_next_number("quotation")
-    # Get first 4 letters of user name (uppercase)
-    user_prefix = current_user["name"][:4].upper() if current_user.get("name") else "USER"
-    quotation_no = f"{base_quotation_no}/{user_prefix}"
-    quotation_id = f"QTN{await db.quotations.count_documents({}) + 1:04d}"
-    
-    quotation_dict = quotation_data.model_dump()
-    quotation_dict["quotation_id"] = quotation_id
-    quotation_dict["quotation_no"] = quotation_no
-    quotation_dict["created_by_user_id"] = current_user["user_id"]
+def build_items_update(before: List[dict], after: List[dict]) -> dict:
+    """Smallest update that turns the stored lines into the patched ones.
     
-    await db.quotations.insert_one(quotation_dict)
+    Lines have no identity of their own (duplicated lines are identical),
+    so $pull cannot target one; removals other than trailing lines rewrite
+    the array.
+    """
+    if len(after) == len(before):
+        return {"$set": {f"items.{i}": line for i, (old, line) in enumerate(zip(before, after)) if old != line}}
+    # Lines inserted in one contiguous run, everything else untouched
+    if len(after) > len(before):
+        added = len(after) - len(before)
+        for position in range(len(before) + 1):
+            if after[:position] == before[:position] and after[position + added:] == before[position:]:
+                push = {"$each": after[position:position + added]}
+                if position < len(before):
+                    push["$position"] = position
+                return {"$push": {"items": push}}
+    elif after == before[:len(after)]:
+        # Trailing lines removed: truncate in place
+        return {"$push": {"items": {"$each": [], "$slice": len(after)}}}
+    return {"$set": {"items": after}}
+
+async def patch_document(doc_kind: str, doc_id: str, patch: DocumentPatch, current_user: dict) -> dict:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    model = DOCUMENT_CREATE_MODELS[doc_kind]
+    collection = db[spec["collection"]]
+    if not patch.ops:
+        raise HTTPException(status_code=400, detail="No changes")
+    
+    doc = await collection.find_one({spec["id_field"]: doc_id}, {"_id": 0})
+    if not doc or doc.get("is_locked") or doc.get("version", 0) != patch.version:
+        await raise_write_conflict(spec["collection"], spec["id_field"], doc_id, spec["label"], patch.version)
+    
+    header_fields = set(model.model_fields) - {"items", "is_locked", "version"}
+    header, lines, dirty = apply_document_patch(doc, patch.ops, header_fields)
+    
+    if any(dirty):
+        party = await db.parties.find_one(
+            {"party_id": header.get("party_id", doc["party_id"])}, {"_id": 0, "party_name": 1, "GST_number": 1}
+        )
+        if party and "party_id" in header and "party_name_snapshot" not in header:
+            header["party_name_snapshot"] = party["party_name"]
+        # Added lines may name just the item; fill the snapshot fields from the items master
+        missing = {line.get("item_id") for line, d in zip(lines, dirty) if d and not line.get("item_name")}
+        masters = {
+            item["item_id"]: item
+            async for item in db.items.find({"item_id": {"$in": list(missing)}}, {"_id": 0})
+        } if missing else {}
+        for i, line in enumerate(lines):
+            if not dirty[i]:
+                continue
+            master = masters.get(line.get("item_id"))
+            if line.get("item_id") in missing and not master:
+                raise HTTPException(status_code=400, detail=f"Line {i}: item {line.get('item_id')} not found")
+            if master:
+                line = {**line, **{f: master[f] for f in LINE_SNAPSHOT_FIELDS if f in master and not line.get(f)}}
+                if line.get("rate") is None:
+                    line["rate"] = master["rate"]
+            try:
+                lines[i] = calculate_line_totals(line, party)
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=422, detail=f"Line {i}: qty, rate, discount_percent and GST_percent must be numbers")
+    
+    # Validate the whole result so a patch cannot store what a full update would reject
+    try:
+        validated = model.model_validate({**doc, **header, "items": lines}).model_dump(exclude={"version", "is_locked"})
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    
+    update = build_items_update(doc["items"], validated["items"])
+    changed_header = {f: validated[f] for f in header if validated[f] != doc.get(f)}
+    if changed_header:
+        update.setdefault("$set", {}).update(changed_header)
+    if validated["items"] != doc["items"]:
+        update.setdefault("$set", {}).update(await document_tax_fields(validated["items"]))
+    update["$inc"] = {"version": 1}
+    
+    updated = await collection.find_one_and_update(
+        {spec["id_field"]: doc_id, "is_locked": {"$ne": True}, **version_guard(patch.version)},
+        update,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
+        await raise_write_conflict(spec["collection"], spec["id_field"], doc_id, spec["label"], patch.version)
+    await log_document_action(spec["log_type"], doc_id, "UPDATED", current_user["user_id"], details={"ops": len(patch.ops)})
+    return updated
+
+# ==================== QUOTATION ENDPOINTS ====================
+
+# Numbering per document type: counters key, id prefix and settings key for the number prefix
+DOCUMENT_SEQUENCES = {
+    "quotation": ("quotations", "quotation_id", "QTN", "quotation_prefix", "QTN"),
+    "pi": ("proforma_invoices", "pi_id", "PI", "pi_prefix", "PI"),
+    "soa": ("soa", "soa_id", "SOA", "soa_prefix", "SOA")
+}
+
+async def next_sequence(name: str) -> int:
+    # Atomic, so concurrent creates never share a number and deleted numbers are not reused
+    counter = await db.counters.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+async def allocate_document_number(doc_type: str) -> Tuple[str, str]:
+    """(document id, document number) for a new quotation, PI or SOA."""
+    collection, _, id_prefix, prefix_setting, default_prefix = DOCUMENT_SEQUENCES[doc_type]
+    settings = await db.settings.find_one({"settings_id": "default"}, {"_id": 0, prefix_setting: 1}) or {}
+    seq = await next_sequence(collection)
+    return f"{id_prefix}{seq:04d}", f"{settings.get(prefix_setting, default_prefix)}{seq:04d}"
+
+async def seed_document_counters():
+    # Numbers used to be count + 1; start each counter past every id already issued.
+    # Only counters that do not exist yet are seeded, so this scans once per database.
+    for collection, id_field, id_prefix, _, _ in DOCUMENT_SEQUENCES.values():
+        if await db.counters.find_one({"_id": collection}, {"_id": 1}):
+            continue
+        highest = await db[collection].count_documents({})
+        for source in (collection, f"{collection}_archive"):
+            async for doc in db[source].find({}, {"_id": 0, id_field: 1}):
+                suffix = doc.get(id_field, "")[len(id_prefix):]
+                if suffix.isdigit():
+                    highest = max(highest, int(suffix))
+        await db.counters.update_one({"_id": collection}, {"$max": {"seq": highest}}, upsert=True)
+
+async def find_document(doc_kind: str, doc_id: str) -> Optional[dict]:
+    """A quotation, PI or SOA by id, looking in cold storage when it is not in the hot collection."""
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    doc = await db[spec["collection"]].find_one({spec["id_field"]: doc_id}, {"_id": 0})
+    if doc is None:
+        doc = await db[spec["archive_collection"]].find_one({spec["id_field"]: doc_id}, {"_id": 0})
+    return doc
+
+# Delivery state kept on quotations, PIs and SOAs
+DOCUMENT_EMAIL_FIELDS = ("email_status", "email_id", "emailed_to", "email_queued_at", "emailed_at", "email_error")
+# State of the original document that a duplicate starts without
+DUPLICATE_RESET_FIELDS = (
+    "version", "pdf_status", "pdf_error", "pdf_lease_expires_at",
+    "archived_at", "locked_at", "lock_batch_id", "status_changed_at"
+) + DOCUMENT_EMAIL_FIELDS
+
+def reset_duplicated_document(doc: dict) -> dict:
+    """Clear the copied lifecycle state so a duplicate starts as a fresh, unlocked document."""
+    doc["is_locked"] = False
+    for field in DUPLICATE_RESET_FIELDS:
+        doc.pop(field, None)
+    return doc
+
+async def list_documents(doc_kind: str, query: dict, include_archived: bool = False, limit: int = 1000) -> List[dict]:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    docs = await db[spec["collection"]].find(query, {"_id": 0}).to_list(limit)
+    if include_archived and len(docs) < limit:
+        docs += await db[spec["archive_collection"]].find(query, {"_id": 0}).to_list(limit - len(docs))
+    return docs
+
+def document_collection_names(include_archived: bool = False) -> List[str]:
+    """Collections holding quotations, PIs and SOAs, for reports over all three."""
+    names = [spec["collection"] for spec in PDF_DOCUMENT_TYPES.values()]
+    if include_archived:
+        names += [spec["archive_collection"] for spec in PDF_DOCUMENT_TYPES.values()]
+    return names
+
+async def count_documents_of(doc_kind: str, query: dict, include_archived: bool = False) -> int:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    count = await db[spec["collection"]].count_documents(query)
+    if include_archived:
+        count += await db[spec["archive_collection"]].count_documents(query)
+    return count
+
+async def insert_document(doc_kind: str, fields: dict, current_user: dict) -> dict:
+    """Number and store a new quotation, PI or SOA."""
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    doc_id, doc_no = await allocate_document_number(spec["sequence"])
+    if doc_kind == "quotation":
+        # Get first 4 letters of user name (uppercase)
+        user_prefix = current_user["name"][:4].upper() if current_user.get("name") else "USER"
+        doc_no = f"{doc_no}/{user_prefix}"
+    
+    doc = {**fields, spec["id_field"]: doc_id, spec["no_field"]: doc_no, "created_by_user_id": current_user["user_id"]}
+    doc.update(await document_tax_fields(doc["items"]))
+    await db[spec["collection"]].insert_one(doc)
+    doc.pop("_id", None)
     
     # Log
-    await log_document_action("QUOTATION", quotation_id, "CREATED", current_user["user_id"])
-    
-    return quotation_dict
+    await log_document_action(spec["log_type"], doc_id, "CREATED", current_user["user_id"])
+    return doc
 
-@api_router.get("/quotations", response_model=List[Quotation])
-async def get_quotations(
-    my_docs: bool = False,
+def build_document_list_query(
+    current_user: dict,
     party_id: Optional[str] = None,
     user_id: Optional[str] = None,
     period: Optional[str] = None,
     from_date: Optional[str] = None,
-    to_date: Optional[str] = None,
-    current_user: dict = Depends(get_current_user)
-):
+    to_date: Optional[str] = None
+) -> dict:
+    """Mongo filter shared by the quotation, PI and SOA lists and the bulk PDF export."""
     query = {}
     
     # User filter (Admin can filter by user, Sales User sees only their data)
@@ -992,41 +2554,52 @@ async def get_quotations(
         if start_date:
             query["date"] = {"$gte": start_date.isoformat(), "$lte": current_date.isoformat()}
     
-    quotations = await db.quotations.find(query, {"_id": 0}).to_list(1000)
+    return query
+
+@api_router.post("/quotations", response_model=Quotation)
+async def create_quotation(quotation_data: QuotationCreate, current_user: dict = Depends(get_current_user)):
+    return await insert_document("quotation", quotation_data.model_dump(exclude={"version"}), current_user)
+
+@api_router.get("/quotations", response_model=List[Quotation])
+async def get_quotations(
+    my_docs: bool = False,
+    party_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    period: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    include_archived: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    query = build_document_list_query(current_user, party_id, user_id, period, from_date, to_date)
+    
+    quotations = await list_documents("quotation", query, include_archived)
     return quotations
 
 @api_router.get("/quotations/{quotation_id}", response_model=Quotation)
 async def get_quotation(quotation_id: str, current_user: dict = Depends(get_current_user)):
-    quotation = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
+    quotation = await find_document("quotation", quotation_id)
     if not quotation:
         raise HTTPException(status_code=404, detail="Quotation not found")
     return quotation
 
 @api_router.put("/quotations/{quotation_id}", response_model=Quotation)
 async def update_quotation(quotation_id: str, quotation_data: QuotationCreate, current_user: dict = Depends(get_current_user)):
-    existing = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Quotation not found")
-    
-    quotation_dict = quotation_data.model_dump()
-    await db.quotations.update_one({"quotation_id": quotation_id}, {"$set": quotation_dict})
+    # Locked documents and stale copies are rejected by the update itself
+    fields = quotation_data.model_dump(exclude={"version", "is_locked"})
+    doc = await update_document("quotation", quotation_id, fields, quotation_data.version, lock=quotation_data.is_locked)
     
     # Log
     await log_document_action("QUOTATION", quotation_id, "UPDATED", current_user["user_id"])
-    
-    quotation_dict["quotation_id"] = quotation_id
-    quotation_dict["quotation_no"] = existing["quotation_no"]
-    quotation_dict["created_by_user_id"] = existing["created_by_user_id"]
-    return quotation_dict
+    return doc
+
+@api_router.patch("/quotations/{quotation_id}", response_model=Quotation)
+async def patch_quotation(quotation_id: str, patch: DocumentPatch, current_user: dict = Depends(get_current_user)):
+    return await patch_document("quotation", quotation_id, patch, current_user)
 
 @api_router.delete("/quotations/{quotation_id}")
-async def delete_quotation(quotation_id: str, current_user: dict = Depends(get_current_user)):
-    quotation = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
-    if not quotation:
-        raise HTTPException(status_code=404, detail="Quotation not found")
-    
-    # Delete the quotation
-    await db.quotations.delete_one({"quotation_id": quotation_id})
+async def delete_quotation(quotation_id: str, version: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    await delete_document("quotation", quotation_id, version)
     
     # Log the deletion
     await log_document_action("QUOTATION", quotation_id, "DELETED", current_user["user_id"])
@@ -1035,23 +2608,23 @@ async def delete_quotation(quotation_id: str, current_user: dict = Depends(get_c
 
 @api_router.post("/quotations/{quotation_id}/duplicate")
 async def duplicate_quotation(quotation_id: str, current_user: dict = Depends(get_current_user)):
-    quotation = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
+    quotation = await find_document("quotation", quotation_id)
     if not quotation:
         raise HTTPException(status_code=404, detail="Quotation not found")
     
-    base_quotation_no = await get_next_number("quotation")
+    new_quotation_id, base_quotation_no = await allocate_document_number("quotation")
     user_prefix = current_user["name"][:4].upper() if current_user.get("name") else "USER"
     new_quotation_no = f"{base_quotation_no}/{user_prefix}"
-    new_quotation_id = f"QTN{await db.quotations.count_documents({}) + 1:04d}"
     
     new_quotation = quotation.copy()
     new_quotation["quotation_id"] = new_quotation_id
     new_quotation["quotation_no"] = new_quotation_no
     new_quotation["created_by_user_id"] = current_user["user_id"]
     new_quotation["date"] = datetime.now(timezone.utc).isoformat()
-    new_quotation["is_locked"] = False
+    reset_duplicated_document(new_quotation)
     new_quotation["quotation_status"] = None
     
+    new_quotation.update(await document_tax_fields(new_quotation["items"]))
     await db.quotations.insert_one(new_quotation)
     
     # Log
@@ -1060,25 +2633,20 @@ async def duplicate_quotation(quotation_id: str, current_user: dict = Depends(ge
     return {"message": "Quotation duplicated successfully", "quotation_id": new_quotation_id, "quotation_no": new_quotation_no}
 
 @api_router.post("/quotations/{quotation_id}/lock")
-async def lock_quotation(quotation_id: str, current_user: dict = Depends(get_current_user)):
-    quotation = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
-    if not quotation:
-        raise HTTPException(status_code=404, detail="Quotation not found")
-    
-    await db.quotations.update_one({"quotation_id": quotation_id}, {"$set": {"is_locked": True}})
+async def lock_quotation(quotation_id: str, version: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    doc = await lock_document("quotation", quotation_id, version)
     await log_document_action("QUOTATION", quotation_id, "LOCKED", current_user["user_id"])
     
-    return {"message": "Quotation locked successfully"}
+    return {"message": "Quotation locked successfully", "pdf_status": doc["pdf_status"], "version": doc["version"]}
 
 @api_router.post("/quotations/{quotation_id}/convert-to-pi")
 async def convert_quotation_to_pi(quotation_id: str, current_user: dict = Depends(get_current_user)):
-    quotation = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
+    quotation = await find_document("quotation", quotation_id)
     if not quotation:
         raise HTTPException(status_code=404, detail="Quotation not found")
     
     # Create PI from quotation
-    pi_no = await get_next_number("pi")
-    pi_id = f"PI{await db.proforma_invoices.count_documents({}) + 1:04d}"
+    pi_id, pi_no = await allocate_document_number("pi")
     
     pi_dict = {
         "pi_id": pi_id,
@@ -1094,6 +2662,7 @@ async def convert_quotation_to_pi(quotation_id: str, current_user: dict = Depend
         "created_by_user_id": current_user["user_id"]
     }
     
+    pi_dict.update(await document_tax_fields(pi_dict["items"]))
     await db.proforma_invoices.insert_one(pi_dict)
     
     # Log
@@ -1103,13 +2672,12 @@ async def convert_quotation_to_pi(quotation_id: str, current_user: dict = Depend
 
 @api_router.post("/quotations/{quotation_id}/convert-to-soa")
 async def convert_quotation_to_soa(quotation_id: str, current_user: dict = Depends(get_current_user)):
-    quotation = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
+    quotation = await find_document("quotation", quotation_id)
     if not quotation:
         raise HTTPException(status_code=404, detail="Quotation not found")
     
     # Create SOA from quotation
-    soa_no = await get_next_number("soa")
-    soa_id = f"SOA{await db.soa.count_documents({}) + 1:04d}"
+    soa_id, soa_no = await allocate_document_number("soa")
     
     soa_dict = {
         "soa_id": soa_id,
@@ -1125,6 +2693,7 @@ async def convert_quotation_to_soa(quotation_id: str, current_user: dict = Depen
         "created_by_user_id": current_user["user_id"]
     }
     
+    soa_dict.update(await document_tax_fields(soa_dict["items"]))
     await db.soa.insert_one(soa_dict)
     
     # Log
@@ -1136,20 +2705,7 @@ async def convert_quotation_to_soa(quotation_id: str, current_user: dict = Depen
 
 @api_router.post("/proforma-invoices", response_model=ProformaInvoice)
 async def create_proforma_invoice(pi_data: ProformaInvoiceCreate, current_user: dict = Depends(get_current_user)):
-    pi_no = await get_next_number("pi")
-    pi_id = f"PI{await db.proforma_invoices.count_documents({}) + 1:04d}"
-    
-    pi_dict = pi_data.model_dump()
-    pi_dict["pi_id"] = pi_id
-    pi_dict["pi_no"] = pi_no
-    pi_dict["created_by_user_id"] = current_user["user_id"]
-    
-    await db.proforma_invoices.insert_one(pi_dict)
-    
-    # Log
-    await log_document_action("PROFORMA_INVOICE", pi_id, "CREATED", current_user["user_id"])
-    
-    return pi_dict
+    return await insert_document("proforma_invoice", pi_data.model_dump(exclude={"version"}), current_user)
 
 @api_router.get("/proforma-invoices", response_model=List[ProformaInvoice])
 async def get_proforma_invoices(
@@ -1159,78 +2715,38 @@ async def get_proforma_invoices(
     period: Optional[str] = None,
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
+    include_archived: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
-    query = {}
-    
-    # User filter (Admin can filter by user, Sales User sees only their data)
-    if current_user["role"] != "Admin":
-        query["created_by_user_id"] = current_user["user_id"]
-    elif user_id and user_id != "ALL":
-        query["created_by_user_id"] = user_id
-    
-    # Party filter
-    if party_id:
-        query["party_id"] = party_id
-    
-    # Date filter based on period
-    if period and period != "all_time":
-        current_date = datetime.now(timezone.utc)
-        
-        if period == "weekly":
-            start_date = current_date - timedelta(days=7)
-        elif period == "monthly":
-            start_date = current_date - timedelta(days=30)
-        elif period == "ytd":
-            current_year = current_date.year
-            if current_date.month >= 4:
-                start_date = datetime(current_year, 4, 1, tzinfo=timezone.utc)
-            else:
-                start_date = datetime(current_year - 1, 4, 1, tzinfo=timezone.utc)
-        elif period == "custom" and from_date and to_date:
-            start_date = datetime.fromisoformat(from_date).replace(tzinfo=timezone.utc)
-            current_date = datetime.fromisoformat(to_date).replace(tzinfo=timezone.utc)
-        else:
-            start_date = None
-        
-        if start_date:
-            query["date"] = {"$gte": start_date.isoformat(), "$lte": current_date.isoformat()}
+    query = build_document_list_query(current_user, party_id, user_id, period, from_date, to_date)
     
-    pis = await db.proforma_invoices.find(query, {"_id": 0}).to_list(1000)
+    pis = await list_documents("proforma_invoice", query, include_archived)
     return pis
 
 @api_router.get("/proforma-invoices/{pi_id}", response_model=ProformaInvoice)
 async def get_proforma_invoice(pi_id: str, current_user: dict = Depends(get_current_user)):
-    pi = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
+    pi = await find_document("proforma_invoice", pi_id)
     if not pi:
         raise HTTPException(status_code=404, detail="Proforma Invoice not found")
     return pi
 
 @api_router.put("/proforma-invoices/{pi_id}", response_model=ProformaInvoice)
 async def update_proforma_invoice(pi_id: str, pi_data: ProformaInvoiceCreate, current_user: dict = Depends(get_current_user)):
-    existing = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Proforma Invoice not found")
-    
-    pi_dict = pi_data.model_dump()
-    await db.proforma_invoices.update_one({"pi_id": pi_id}, {"$set": pi_dict})
+    # Locked documents and stale copies are rejected by the update itself
+    fields = pi_data.model_dump(exclude={"version", "is_locked"})
+    doc = await update_document("proforma_invoice", pi_id, fields, pi_data.version, lock=pi_data.is_locked)
     
     # Log
     await log_document_action("PROFORMA_INVOICE", pi_id, "UPDATED", current_user["user_id"])
-    
-    pi_dict["pi_id"] = pi_id
-    pi_dict["pi_no"] = existing["pi_no"]
-    pi_dict["created_by_user_id"] = existing["created_by_user_id"]
-    return pi_dict
+    return doc
+
+@api_router.patch("/proforma-invoices/{pi_id}", response_model=ProformaInvoice)
+async def patch_proforma_invoice(pi_id: str, patch: DocumentPatch, current_user: dict = Depends(get_current_user)):
+    return await patch_document("proforma_invoice", pi_id, patch, current_user)
 
 @api_router.delete("/proforma-invoices/{pi_id}")
-async def delete_proforma_invoice(pi_id: str, current_user: dict = Depends(get_current_user)):
-    pi = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
-    if not pi:
-        raise HTTPException(status_code=404, detail="Proforma Invoice not found")
-    
-    # Delete the PI
-    await db.proforma_invoices.delete_one({"pi_id": pi_id})
+async def delete_proforma_invoice(pi_id: str, version: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    await delete_document("proforma_invoice", pi_id, version)
     
     # Log the deletion
     await log_document_action("PROFORMA_INVOICE", pi_id, "DELETED", current_user["user_id"])
@@ -1239,46 +2755,41 @@ async def delete_proforma_invoice(pi_id: str, current_user: dict = Depends(get_c
 
 @api_router.post("/proforma-invoices/{pi_id}/duplicate")
 async def duplicate_proforma_invoice(pi_id: str, current_user: dict = Depends(get_current_user)):
-    pi = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
+    pi = await find_document("proforma_invoice", pi_id)
     if not pi:
         raise HTTPException(status_code=404, detail="Proforma Invoice not found")
     
-    new_pi_no = await get_next_number("pi")
-    new_pi_id = f"PI{await db.proforma_invoices.count_documents({}) + 1:04d}"
+    new_pi_id, new_pi_no = await allocate_document_number("pi")
     
     new_pi = pi.copy()
     new_pi["pi_id"] = new_pi_id
     new_pi["pi_no"] = new_pi_no
     new_pi["created_by_user_id"] = current_user["user_id"]
     new_pi["date"] = datetime.now(timezone.utc).isoformat()
-    new_pi["is_locked"] = False
+    reset_duplicated_document(new_pi)
     new_pi["pi_status"] = "PI Submitted"
     
+    new_pi.update(await document_tax_fields(new_pi["items"]))
     await db.proforma_invoices.insert_one(new_pi)
     await log_document_action("PROFORMA_INVOICE", new_pi_id, "DUPLICATED", current_user["user_id"])
     
     return {"message": "Proforma Invoice duplicated successfully", "pi_id": new_pi_id, "pi_no": new_pi_no}
 
 @api_router.post("/proforma-invoices/{pi_id}/lock")
-async def lock_proforma_invoice(pi_id: str, current_user: dict = Depends(get_current_user)):
-    pi = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
-    if not pi:
-        raise HTTPException(status_code=404, detail="Proforma Invoice not found")
-    
-    await db.proforma_invoices.update_one({"pi_id": pi_id}, {"$set": {"is_locked": True}})
+async def lock_proforma_invoice(pi_id: str, version: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    doc = await lock_document("proforma_invoice", pi_id, version)
     await log_document_action("PROFORMA_INVOICE", pi_id, "LOCKED", current_user["user_id"])
     
-    return {"message": "Proforma Invoice locked successfully"}
+    return {"message": "Proforma Invoice locked successfully", "pdf_status": doc["pdf_status"], "version": doc["version"]}
 
 @api_router.post("/proforma-invoices/{pi_id}/convert-to-soa")
 async def convert_pi_to_soa(pi_id: str, current_user: dict = Depends(get_current_user)):
-    pi = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
+    pi = await find_document("proforma_invoice", pi_id)
     if not pi:
         raise HTTPException(status_code=404, detail="Proforma Invoice not found")
     
     # Create SOA from PI
-    soa_no = await get_next_number("soa")
-    soa_id = f"SOA{await db.soa.count_documents({}) + 1:04d}"
+    soa_id, soa_no = await allocate_document_number("soa")
     
     soa_dict = {
         "soa_id": soa_id,
@@ -1292,6 +2803,7 @@ async def convert_pi_to_soa(pi_id: str, current_user: dict = Depends(get_current
         "created_by_user_id": current_user["user_id"]
     }
     
+    soa_dict.update(await document_tax_fields(soa_dict["items"]))
     await db.soa.insert_one(soa_dict)
     
     # Log
@@ -1301,15 +2813,14 @@ async def convert_pi_to_soa(pi_id: str, current_user: dict = Depends(get_current
 
 @api_router.post("/proforma-invoices/{pi_id}/convert-to-quotation")
 async def convert_pi_to_quotation(pi_id: str, current_user: dict = Depends(get_current_user)):
-    pi = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
+    pi = await find_document("proforma_invoice", pi_id)
     if not pi:
         raise HTTPException(status_code=404, detail="Proforma Invoice not found")
     
     # Create Quotation from PI
-    base_quotation_no = await get_next_number("quotation")
+    quotation_id, base_quotation_no = await allocate_document_number("quotation")
     user_prefix = current_user["name"][:4].upper() if current_user.get("name") else "USER"
     quotation_no = f"{base_quotation_no}/{user_prefix}"
-    quotation_id = f"QTN{await db.quotations.count_documents({}) + 1:04d}"
     
     quotation_dict = {
         "quotation_id": quotation_id,
@@ -1326,6 +2837,7 @@ async def convert_pi_to_quotation(pi_id: str, current_user: dict = Depends(get_c
         "created_by_user_id": current_user["user_id"]
     }
     
+    quotation_dict.update(await document_tax_fields(quotation_dict["items"]))
     await db.quotations.insert_one(quotation_dict)
     
     # Log
@@ -1337,20 +2849,7 @@ async def convert_pi_to_quotation(pi_id: str, current_user: dict = Depends(get_c
 
 @api_router.post("/soa", response_model=SOA)
 async def create_soa(soa_data: SOACreate, current_user: dict = Depends(get_current_user)):
-    soa_no = await get_next_number("soa")
-    soa_id = f"SOA{await db.soa.count_documents({}) + 1:04d}"
-    
-    soa_dict = soa_data.model_dump()
-    soa_dict["soa_id"] = soa_id
-    soa_dict["soa_no"] = soa_no
-    soa_dict["created_by_user_id"] = current_user["user_id"]
-    
-    await db.soa.insert_one(soa_dict)
-    
-    # Log
-    await log_document_action("SOA", soa_id, "CREATED", current_user["user_id"])
-    
-    return soa_dict
+    return await insert_document("soa", soa_data.model_dump(exclude={"version"}), current_user)
 
 @api_router.get("/soa", response_model=List[SOA])
 async def get_soas(
@@ -1360,78 +2859,38 @@ async def get_soas(
     period: Optional[str] = None,
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
+    include_archived: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
-    query = {}
-    
-    # User filter (Admin can filter by user, Sales User sees only their data)
-    if current_user["role"] != "Admin":
-        query["created_by_user_id"] = current_user["user_id"]
-    elif user_id and user_id != "ALL":
-        query["created_by_user_id"] = user_id
-    
-    # Party filter
-    if party_id:
-        query["party_id"] = party_id
-    
-    # Date filter based on period
-    if period and period != "all_time":
-        current_date = datetime.now(timezone.utc)
-        
-        if period == "weekly":
-            start_date = current_date - timedelta(days=7)
-        elif period == "monthly":
-            start_date = current_date - timedelta(days=30)
-        elif period == "ytd":
-            current_year = current_date.year
-            if current_date.month >= 4:
-                start_date = datetime(current_year, 4, 1, tzinfo=timezone.utc)
-            else:
-                start_date = datetime(current_year - 1, 4, 1, tzinfo=timezone.utc)
-        elif period == "custom" and from_date and to_date:
-            start_date = datetime.fromisoformat(from_date).replace(tzinfo=timezone.utc)
-            current_date = datetime.fromisoformat(to_date).replace(tzinfo=timezone.utc)
-        else:
-            start_date = None
-        
-        if start_date:
-            query["date"] = {"$gte": start_date.isoformat(), "$lte": current_date.isoformat()}
+    query = build_document_list_query(current_user, party_id, user_id, period, from_date, to_date)
     
-    soas = await db.soa.find(query, {"_id": 0}).to_list(1000)
+    soas = await list_documents("soa", query, include_archived)
     return soas
 
 @api_router.get("/soa/{soa_id}", response_model=SOA)
 async def get_soa(soa_id: str, current_user: dict = Depends(get_current_user)):
-    soa = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
+    soa = await find_document("soa", soa_id)
     if not soa:
         raise HTTPException(status_code=404, detail="SOA not found")
     return soa
 
 @api_router.put("/soa/{soa_id}", response_model=SOA)
 async def update_soa(soa_id: str, soa_data: SOACreate, current_user: dict = Depends(get_current_user)):
-    existing = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="SOA not found")
-    
-    soa_dict = soa_data.model_dump()
-    await db.soa.update_one({"soa_id": soa_id}, {"$set": soa_dict})
+    # Locked documents and stale copies are rejected by the update itself
+    fields = soa_data.model_dump(exclude={"version", "is_locked"})
+    doc = await update_document("soa", soa_id, fields, soa_data.version, lock=soa_data.is_locked)
     
     # Log
     await log_document_action("SOA", soa_id, "UPDATED", current_user["user_id"])
-    
-    soa_dict["soa_id"] = soa_id
-    soa_dict["soa_no"] = existing["soa_no"]
-    soa_dict["created_by_user_id"] = existing["created_by_user_id"]
-    return soa_dict
+    return doc
+
+@api_router.patch("/soa/{soa_id}", response_model=SOA)
+async def patch_soa(soa_id: str, patch: DocumentPatch, current_user: dict = Depends(get_current_user)):
+    return await patch_document("soa", soa_id, patch, current_user)
 
 @api_router.delete("/soa/{soa_id}")
-async def delete_soa(soa_id: str, current_user: dict = Depends(get_current_user)):
-    soa = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
-    if not soa:
-        raise HTTPException(status_code=404, detail="SOA not found")
-    
-    # Delete the SOA
-    await db.soa.delete_one({"soa_id": soa_id})
+async def delete_soa(soa_id: str, version: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    await delete_document("soa", soa_id, version)
     
     # Log the deletion
     await log_document_action("SOA", soa_id, "DELETED", current_user["user_id"])
@@ -1440,48 +2899,43 @@ async def delete_soa(soa_id: str, current_user: dict = Depends(get_current_user)
 
 @api_router.post("/soa/{soa_id}/duplicate")
 async def duplicate_soa(soa_id: str, current_user: dict = Depends(get_current_user)):
-    soa = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
+    soa = await find_document("soa", soa_id)
     if not soa:
         raise HTTPException(status_code=404, detail="SOA not found")
     
-    new_soa_no = await get_next_number("soa")
-    new_soa_id = f"SOA{await db.soa.count_documents({}) + 1:04d}"
+    new_soa_id, new_soa_no = await allocate_document_number("soa")
     
     new_soa = soa.copy()
     new_soa["soa_id"] = new_soa_id
     new_soa["soa_no"] = new_soa_no
     new_soa["created_by_user_id"] = current_user["user_id"]
     new_soa["date"] = datetime.now(timezone.utc).isoformat()
-    new_soa["is_locked"] = False
+    reset_duplicated_document(new_soa)
     new_soa["soa_status"] = "In Process"
     
+    new_soa.update(await document_tax_fields(new_soa["items"]))
     await db.soa.insert_one(new_soa)
     await log_document_action("SOA", new_soa_id, "DUPLICATED", current_user["user_id"])
     
     return {"message": "SOA duplicated successfully", "soa_id": new_soa_id, "soa_no": new_soa_no}
 
 @api_router.post("/soa/{soa_id}/lock")
-async def lock_soa(soa_id: str, current_user: dict = Depends(get_current_user)):
-    soa = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
-    if not soa:
-        raise HTTPException(status_code=404, detail="SOA not found")
-    
-    await db.soa.update_one({"soa_id": soa_id}, {"$set": {"is_locked": True}})
+async def lock_soa(soa_id: str, version: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    doc = await lock_document("soa", soa_id, version)
     await log_document_action("SOA", soa_id, "LOCKED", current_user["user_id"])
     
-    return {"message": "SOA locked successfully"}
+    return {"message": "SOA locked successfully", "pdf_status": doc["pdf_status"], "version": doc["version"]}
 
 @api_router.post("/soa/{soa_id}/convert-to-quotation")
 async def convert_soa_to_quotation(soa_id: str, current_user: dict = Depends(get_current_user)):
-    soa = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
+    soa = await find_document("soa", soa_id)
     if not soa:
         raise HTTPException(status_code=404, detail="SOA not found")
     
     # Create Quotation from SOA
-    base_quotation_no = await get_next_number("quotation")
+    quotation_id, base_quotation_no = await allocate_document_number("quotation")
     user_prefix = current_user["name"][:4].upper() if current_user.get("name") else "USER"
     quotation_no = f"{base_quotation_no}/{user_prefix}"
-    quotation_id = f"QTN{await db.quotations.count_documents({}) + 1:04d}"
     
     quotation_dict = {
         "quotation_id": quotation_id,
@@ -1498,6 +2952,7 @@ async def convert_soa_to_quotation(soa_id: str, current_user: dict = Depends(get
         "created_by_user_id": current_user["user_id"]
     }
     
+    quotation_dict.update(await document_tax_fields(quotation_dict["items"]))
     await db.quotations.insert_one(quotation_dict)
     
     # Log
@@ -1507,13 +2962,12 @@ async def convert_soa_to_quotation(soa_id: str, current_user: dict = Depends(get
 
 @api_router.post("/soa/{soa_id}/convert-to-pi")
 async def convert_soa_to_pi(soa_id: str, current_user: dict = Depends(get_current_user)):
-    soa = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
+    soa = await find_document("soa", soa_id)
     if not soa:
         raise HTTPException(status_code=404, detail="SOA not found")
     
     # Create PI from SOA
-    pi_no = await get_next_number("pi")
-    pi_id = f"PI{await db.proforma_invoices.count_documents({}) + 1:04d}"
+    pi_id, pi_no = await allocate_document_number("pi")
     
     pi_dict = {
         "pi_id": pi_id,
@@ -1530,6 +2984,7 @@ async def convert_soa_to_pi(soa_id: str, current_user: dict = Depends(get_curren
         "created_by_user_id": current_user["user_id"]
     }
     
+    pi_dict.update(await document_tax_fields(pi_dict["items"]))
     await db.proforma_invoices.insert_one(pi_dict)
     
     # Log
@@ -1537,35 +2992,346 @@ async def convert_soa_to_pi(soa_id: str, current_user: dict = Depends(get_curren
     
     return {"message": "Converted to Proforma Invoice", "pi_id": pi_id, "pi_no": pi_no}
 
+# ==================== DRAFTS ====================
+
+# Autosaved form state, one record per form session; expired by a TTL index
+DRAFT_TTL_DAYS = int(os.environ.get("DRAFT_TTL_DAYS", "14"))
+DRAFT_MAX_LINES = 1000
+
+class DraftCreate(BaseModel):
+    doc_type: str  # quotation, proforma_invoice or soa
+    doc_id: Optional[str] = None  # Set when the draft edits an existing document
+    base_version: Optional[int] = None  # Version of that document when editing began
+    data: Dict[str, Any] = {}
+
+class DraftUpdate(BaseModel):
+    revision: Optional[int] = None  # When given, a write from a stale tab gets 409
+    set: Dict[str, Any] = {}  # Dotted paths into the form data: remarks, items.3, items.3.qty
+    unset: List[str] = []
+
+def draft_spec(doc_type: str) -> dict:
+    if doc_type not in PDF_DOCUMENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"doc_type must be one of: {', '.join(PDF_DOCUMENT_TYPES)}")
+    return PDF_DOCUMENT_TYPES[doc_type]
+
+def validate_draft_path(doc_kind: str, path: str) -> str:
+    header_fields = set(DOCUMENT_CREATE_MODELS[doc_kind].model_fields) - {"items", "version", "is_locked"}
+    tokens = path.split(".")
+    valid = (
+        (len(tokens) == 1 and (tokens[0] in header_fields or tokens[0] == "items"))
+        or (
+            tokens[0] == "items" and len(tokens) in (2, 3)
+            and tokens[1].isdigit() and int(tokens[1]) < DRAFT_MAX_LINES
+            and (len(tokens) == 2 or tokens[2] in QuotationItemBase.model_fields)
+        )
+    )
+    if not valid:
+        raise HTTPException(status_code=400, detail=f"Invalid draft field: {path}")
+    return f"data.{path}"
+
+def draft_expiry() -> dict:
+    now = datetime.now(timezone.utc)
+    return {"updated_at": now.isoformat(), "expires_at": now + timedelta(days=DRAFT_TTL_DAYS)}
+
+def draft_response(draft: dict) -> dict:
+    draft.pop("expires_at", None)
+    return draft
+
+@api_router.post("/drafts", status_code=201)
+async def create_draft(draft_data: DraftCreate, current_user: dict = Depends(get_current_user)):
+    draft_spec(draft_data.doc_type)
+    for path in draft_data.data:
+        validate_draft_path(draft_data.doc_type, path)
+    draft = {
+        "draft_id": str(uuid.uuid4()),
+        "doc_kind": draft_data.doc_type,
+        "doc_id": draft_data.doc_id,
+        "base_version": draft_data.base_version,
+        "user_id": current_user["user_id"],
+        "data": draft_data.data,
+        "revision": 1,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        **draft_expiry()
+    }
+    await db.drafts.insert_one(draft)
+    draft.pop("_id", None)
+    return draft_response(draft)
+
+@api_router.get("/drafts")
+async def get_drafts(doc_type: Optional[str] = None, doc_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    # Summaries for the resume prompt; lines are fetched with the draft itself
+    query = {"user_id": current_user["user_id"]}
+    if doc_type:
+        query["doc_kind"] = doc_type
+    if doc_id is not None:
+        query["doc_id"] = doc_id or None
+    drafts = await db.drafts.find(query, {"_id": 0, "data.items": 0, "expires_at": 0}).sort("updated_at", -1).to_list(50)
+    return drafts
+
+@api_router.get("/drafts/{draft_id}")
+async def get_draft(draft_id: str, current_user: dict = Depends(get_current_user)):
+    draft = await db.drafts.find_one({"draft_id": draft_id, "user_id": current_user["user_id"]}, {"_id": 0, "expires_at": 0})
+    if not draft:
+        raise HTTPException(status_code=404, detail="Draft not found")
+    return draft
+
+@api_router.patch("/drafts/{draft_id}")
+async def update_draft(draft_id: str, changes: DraftUpdate, current_user: dict = Depends(get_current_user)):
+    draft = await db.drafts.find_one({"draft_id": draft_id, "user_id": current_user["user_id"]}, {"_id": 0, "doc_kind": 1})
+    if not draft:
+        raise HTTPException(status_code=404, detail="Draft not found")
+    set_fields = {validate_draft_path(draft["doc_kind"], path): value for path, value in changes.set.items()}
+    unset_fields = {validate_draft_path(draft["doc_kind"], path): "" for path in changes.unset}
+    paths = sorted([*set_fields, *unset_fields])
+    # "items" and "items.3" in one write would conflict in MongoDB
+    if any(b.startswith(a + ".") for a, b in zip(paths, paths[1:])):
+        raise HTTPException(status_code=400, detail="Overlapping draft fields")
+    
+    update = {"$set": {**set_fields, **draft_expiry()}, "$inc": {"revision": 1}}
+    if unset_fields:
+        update["$unset"] = unset_fields
+    query = {"draft_id": draft_id, "user_id": current_user["user_id"]}
+    if changes.revision is not None:
+        query["revision"] = changes.revision
+    updated = await db.drafts.find_one_and_update(
+        query,
+        update,
+        projection={"_id": 0, "draft_id": 1, "revision": 1, "updated_at": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
+        raise HTTPException(status_code=409, detail="Draft was saved from another tab or device; reload it")
+    return updated
+
+@api_router.delete("/drafts/{draft_id}")
+async def delete_draft(draft_id: str, current_user: dict = Depends(get_current_user)):
+    result = await db.drafts.delete_one({"draft_id": draft_id, "user_id": current_user["user_id"]})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Draft not found")
+    return {"message": "Draft discarded"}
+
+@api_router.post("/drafts/{draft_id}/promote")
+async def promote_draft(draft_id: str, current_user: dict = Depends(get_current_user)):
+    """Save a draft as a new document (numbered now) or as an edit of the one it came from."""
+    # Claimed by deleting it, so a double tap cannot create two documents
+    draft = await db.drafts.find_one_and_delete({"draft_id": draft_id, "user_id": current_user["user_id"]})
+    if not draft:
+        raise HTTPException(status_code=404, detail="Draft not found")
+    doc_kind = draft["doc_kind"]
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    model = DOCUMENT_CREATE_MODELS[doc_kind]
+    try:
+        if draft["doc_id"]:
+            existing = await db[spec["collection"]].find_one({spec["id_field"]: draft["doc_id"]}, {"_id": 0})
+            if not existing:
+                await raise_write_conflict(spec["collection"], spec["id_field"], draft["doc_id"], spec["label"], None)
+            try:
+                fields = model.model_validate({**existing, **draft["data"]}).model_dump(exclude={"version", "is_locked"})
+            except ValidationError as e:
+                raise RequestValidationError(e.errors())
+            doc = await update_document(doc_kind, draft["doc_id"], fields, draft["base_version"])
+            await log_document_action(spec["log_type"], draft["doc_id"], "UPDATED", current_user["user_id"])
+        else:
+            try:
+                fields = model.model_validate(draft["data"]).model_dump(exclude={"version"})
+            except ValidationError as e:
+                raise RequestValidationError(e.errors())
+            doc = await insert_document(doc_kind, fields, current_user)
+    except Exception:
+        # Keep the user's work: put the draft back so they can fix it and retry
+        await db.drafts.insert_one(draft)
+        raise
+    return {"doc_type": doc_kind, "doc_id": doc[spec["id_field"]], "doc_no": doc[spec["no_field"]], "version": doc.get("version", 0)}
+
+# ==================== DOCUMENT TEMPLATES ====================
+
+# Templates, letterheads and the WeasyPrint renderer live in pdf_render.py
+
+# Branch -> letterhead file mapping from Settings, refreshed every minute
+_branch_letterheads: Dict[str, Any] = {"mapping": {}, "loaded_at": None}
+
+async def resolve_letterhead_src(branch: str = "") -> str:
+    if branch:
+        loaded_at = _branch_letterheads["loaded_at"]
+        if loaded_at is None or time.monotonic() - loaded_at > 60:
+            settings = await db.settings.find_one({"settings_id": "default"}, {"_id": 0, "branch_letterheads": 1})
+            _branch_letterheads.update({
+                "mapping": (settings or {}).get("branch_letterheads") or {},
+                "loaded_at": time.monotonic()
+            })
+        return letterheads.src_for(_branch_letterheads["mapping"].get(branch, ""))
+    return letterheads.src_for()
+
+
 # ==================== PDF GENERATION ====================
 
-@api_router.get("/quotations/{quotation_id}/pdf")
-async def generate_quotation_pdf(quotation_id: str, current_user: dict = Depends(get_current_user)):
-    # CRITICAL: Fetch document fresh from DB by document_id
-    quotation = await db.quotations.find_one({"quotation_id": quotation_id}, {"_id": 0})
-    if not quotation:
-        raise HTTPException(status_code=404, detail="Quotation not found")
-    
-    # CRITICAL: Resolve party strictly by party_id - no fallback
-    party = await db.parties.find_one({"party_id": quotation["party_id"]}, {"_id": 0})
-    
-    # Use party_name_snapshot if available (for data integrity), otherwise use fresh party lookup
-    if quotation.get("party_name_snapshot") and party:
-        party["party_name"] = quotation["party_name_snapshot"]
+PDF_DOCUMENT_TYPES = {
+    "quotation": {
+        "collection": "quotations",
+        "id_field": "quotation_id",
+        "no_field": "quotation_no",
+        "status_field": "quotation_status",
+        "statuses": [None, "In Process", "Successful", "Lost"],  # None shows as Pending
+        "title": "QUOTATION",
+        "label": "Quotation",
+        "log_type": "QUOTATION",
+        "sequence": "quotation",
+        "archive_collection": "quotations_archive",
+        "archive_statuses": ["Lost"],  # Closed for good; archived once old enough
+        "file_prefix": "quotation",
+        "not_found": "Quotation not found"
+    },
+    "proforma_invoice": {
+        "collection": "proforma_invoices",
+        "id_field": "pi_id",
+        "no_field": "pi_no",
+        "status_field": "pi_status",
+        "statuses": ["PI Submitted", "Payment Recd"],
+        "title": "PROFORMA INVOICE",
+        "label": "Proforma Invoice",
+        "log_type": "PROFORMA_INVOICE",
+        "sequence": "pi",
+        "archive_collection": "proforma_invoices_archive",
+        "archive_statuses": ["Payment Recd"],  # Closed for good; archived once old enough
+        "file_prefix": "proforma_invoice",
+        "not_found": "Proforma Invoice not found"
+    },
+    "soa": {
+        "collection": "soa",
+        "id_field": "soa_id",
+        "no_field": "soa_no",
+        "status_field": "soa_status",
+        "statuses": ["In Process", "Material Given"],
+        "title": "SALES ORDER ACKNOWLEDGEMENT",
+        "label": "SOA",
+        "log_type": "SOA",
+        "sequence": "soa",
+        "archive_collection": "soa_archive",
+        "archive_statuses": ["Material Given"],  # Closed for good; archived once old enough
+        "file_prefix": "soa",
+        "not_found": "SOA not found"
+    }
+}
+
+PDF_RENDER_WORKERS = int(os.environ.get("PDF_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_STORE_DIR = Path(os.environ.get("PDF_STORE_DIR", str(ROOT_DIR / "pdf_store")))
+PDF_BATCH_MAX_DOCUMENTS = int(os.environ.get("PDF_BATCH_MAX_DOCUMENTS", "500"))
+PDF_BATCH_RETENTION_HOURS = int(os.environ.get("PDF_BATCH_RETENTION_HOURS", "24"))
+PDF_SLOW_RENDER_MS = int(os.environ.get("PDF_SLOW_RENDER_MS", "2000"))
+
+PDF_STAGE_SECONDS = metrics.histogram(
+    "pdf_render_stage_seconds",
+    "Time spent in each stage of producing a document PDF",
+    ("doc_type", "stage")
+)
+PDF_RENDER_SECONDS = metrics.histogram(
+    "pdf_render_seconds",
+    "End-to-end time to produce a document PDF",
+    ("doc_type", "source")
+)
+PDF_SLOW_RENDERS = metrics.counter(
+    "pdf_slow_renders_total",
+    "PDF renders slower than PDF_SLOW_RENDER_MS",
+    ("doc_type",)
+)
+
+# Stage timings of the PDF being produced by the current request or task
+_pdf_render_trace: ContextVar[Optional[dict]] = ContextVar("pdf_render_trace", default=None)
+
+@contextmanager
+def pdf_render_trace(doc_type: str, doc_id: str, source: str = "request"):
+    """Collect pdf_stage() timings for one PDF and record them on exit.
     
+    Renders slower than PDF_SLOW_RENDER_MS are logged with their stage breakdown.
+    """
+    trace = {"doc_type": doc_type, "doc_id": doc_id, "lines": 0, "stages": {}}
+    token = _pdf_render_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _pdf_render_trace.reset(token)
+        elapsed = time.perf_counter() - started
+        for stage, seconds in trace["stages"].items():
+            PDF_STAGE_SECONDS.observe(seconds, doc_type=doc_type, stage=stage)
+    # Only completed renders count towards the totals and the slow-render log
+    PDF_RENDER_SECONDS.observe(elapsed, doc_type=doc_type, source=source)
+    if elapsed * 1000 >= PDF_SLOW_RENDER_MS:
+        PDF_SLOW_RENDERS.inc(doc_type=doc_type)
+        breakdown = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in trace["stages"].items())
+        logger.warning(
+            f"Slow PDF render: {doc_type} {doc_id} ({trace['lines']} lines, {source}) "
+            f"took {elapsed * 1000:.0f} ms [{breakdown}]"
+        )
+
+@contextmanager
+def pdf_stage(name: str):
+    trace = _pdf_render_trace.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace["stages"][name] = trace["stages"].get(name, 0) + time.perf_counter() - started
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+def get_pdf_pool() -> Optional[ProcessPoolExecutor]:
+    """Process pool for WeasyPrint layout; None when PDF_RENDER_WORKERS is 0."""
+    global _pdf_pool
+    if _pdf_pool is None and PDF_RENDER_WORKERS > 0:
+        # spawn, not fork: the parent holds Motor threads and an event loop
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=PDF_RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_pdf_worker
+        )
+    return _pdf_pool
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+async def run_in_pdf_pool(fn, *args):
+    """Run a picklable module-level function on the PDF pool (in a thread if disabled)."""
+    pool = get_pdf_pool()
+    if pool is None:
+        return await asyncio.to_thread(fn, *args)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # A worker died (OOM, segfault in a native lib); start a fresh pool next time
+        shutdown_pdf_pool()
+        raise HTTPException(status_code=503, detail="PDF renderer restarted, please retry")
+
+async def render_pdf_async(html_content: str) -> bytes:
+    with pdf_stage("write_pdf"):
+        return await run_in_pdf_pool(render_pdf, html_content)
+
+async def enrich_document_items(items: List[dict]) -> List[dict]:
     # CRITICAL: Items must use stored values (UOM, item_name, etc.), not item master
     # Only fallback to item master if stored values are missing
+    item_ids = list({item["item_id"] for item in items})
+    masters = {
+        item["item_id"]: item
+        async for item in db.items.find(
+            {"item_id": {"$in": item_ids}},
+            {"_id": 0, "item_id": 1, "item_name": 1, "HSN": 1, "UOM": 1, "description": 1}
+        )
+    }
+    
     enriched_items = []
-    for item in quotation["items"]:
+    for item in items:
         enriched_item = item.copy()
-        
-        # Always fetch description from item master (it's display-only, not stored per line)
-        item_details = await db.items.find_one({"item_id": item["item_id"]}, {"_id": 0})
+        item_details = masters.get(item["item_id"])
         
         # Use stored values first (IMMUTABLE data captured at save time)
         enriched_item['item_name'] = item.get('item_name', '')
         enriched_item['hsn'] = item.get('HSN', '')
         enriched_item['uom'] = item.get('UOM', 'Nos')  # CRITICAL: Use stored UOM
+        # Description is display-only, not stored per line
         enriched_item['description'] = item_details.get('description', '') if item_details else ''
         
         # Fallback to item master if stored values are empty (backward compatibility)
@@ -1575,485 +3341,1063 @@ async def generate_quotation_pdf(quotation_id: str, current_user: dict = Depends
             enriched_item['uom'] = enriched_item['uom'] or item_details.get('UOM', 'Nos')
         
         enriched_items.append(enriched_item)
-    
-    # Calculate totals
-    subtotal = sum(item["taxable_amount"] for item in quotation["items"])
-    tax_total = sum(item["tax_amount"] for item in quotation["items"])
-    grand_total = sum(item["total_amount"] for item in quotation["items"])
-    
-    html_content = generate_document_html(
-        doc_type="QUOTATION",
-        doc_no=quotation["quotation_no"],
-        doc_date=quotation["date"],
-        party=party,
-        items=enriched_items,
-        subtotal=subtotal,
-        tax_total=tax_total,
-        grand_total=grand_total,
-        remarks=quotation.get("remarks", ""),
-        payment_terms=quotation.get("payment_terms", ""),
-        delivery_terms=quotation.get("delivery_terms", ""),
-        is_quotation=True
-    )
-    
-    pdf = HTML(string=html_content).write_pdf()
-    
-    # Generate filename with username and timestamp
-    username = current_user["name"].replace(" ", "_").lower()[:10]
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    doc_no_safe = quotation['quotation_no'].replace("/", "_")
-    filename = f"quotation_{doc_no_safe}_{username}_{timestamp}.pdf"
-    
-    return Response(
-        content=pdf,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+    return enriched_items
 
-@api_router.get("/proforma-invoices/{pi_id}/pdf")
-async def generate_pi_pdf(pi_id: str, current_user: dict = Depends(get_current_user)):
-    # CRITICAL: Fetch document fresh from DB by document_id
-    pi = await db.proforma_invoices.find_one({"pi_id": pi_id}, {"_id": 0})
-    if not pi:
-        raise HTTPException(status_code=404, detail="Proforma Invoice not found")
+async def build_document_pdf_html(doc_kind: str, doc: dict) -> str:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
     
     # CRITICAL: Resolve party strictly by party_id - no fallback
-    party = await db.parties.find_one({"party_id": pi["party_id"]}, {"_id": 0})
-    
-    # Use party_name_snapshot if available (for data integrity)
-    if pi.get("party_name_snapshot") and party:
-        party["party_name"] = pi["party_name_snapshot"]
+    with pdf_stage("fetch_party"):
+        party = await db.parties.find_one({"party_id": doc["party_id"]}, {"_id": 0})
     
-    # CRITICAL: Items must use stored values (UOM, item_name, etc.)
-    enriched_items = []
-    for item in pi["items"]:
-        enriched_item = item.copy()
-        
-        # Always fetch description from item master (it's display-only, not stored per line)
-        item_details = await db.items.find_one({"item_id": item["item_id"]}, {"_id": 0})
+    # Use party_name_snapshot if available (for data integrity), otherwise use fresh party lookup
+    if doc.get("party_name_snapshot") and party:
+        party["party_name"] = doc["party_name_snapshot"]
+    
+    with pdf_stage("item_enrichment"):
+        enriched_items = await enrich_document_items(doc["items"])
+        # Documents saved before totals were stored until the backfill reaches them
+        tax = doc if doc.get("totals") else await document_tax_fields(doc["items"])
+    
+    with pdf_stage("generate_html"):
+        return generate_document_html(
+            doc_type=spec["title"],
+            doc_no=doc[spec["no_field"]],
+            doc_date=doc["date"],
+            party=party,
+            items=enriched_items,
+            totals=tax["totals"],
+            hsn_summary=tax["hsn_summary"],
+            remarks=doc.get("remarks", ""),
+            payment_terms=doc.get("payment_terms", ""),
+            delivery_terms=doc.get("delivery_terms", ""),
+            party_confirmation_id=doc.get("party_confirmation_ID", ""),
+            is_soa=doc_kind == "soa",
+            is_quotation=doc_kind == "quotation",
+            letterhead_src=await resolve_letterhead_src(doc.get("branch", ""))
+        )
+
+def pdf_store_path(doc_kind: str, doc_id: str) -> Path:
+    return PDF_STORE_DIR / doc_kind / f"{Path(doc_id).name}.pdf"
+
+def _write_file_atomic(path: Path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+
+async def load_stored_pdf(doc_kind: str, doc_id: str) -> Optional[dict]:
+    record = await db.pdf_store.find_one({"doc_kind": doc_kind, "doc_id": doc_id}, {"_id": 0})
+    if not record:
+        return None
+    path = pdf_store_path(doc_kind, doc_id)
+    if not path.is_file():
+        return None
+    record["path"] = path
+    return record
+
+async def store_pdf(doc_kind: str, doc_id: str, pdf: bytes) -> dict:
+    path = pdf_store_path(doc_kind, doc_id)
+    await asyncio.to_thread(_write_file_atomic, path, pdf)
+    record = {
+        "doc_kind": doc_kind,
+        "doc_id": doc_id,
+        "sha256": hashlib.sha256(pdf).hexdigest(),
+        "size": len(pdf),
+        "rendered_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.pdf_store.replace_one({"doc_kind": doc_kind, "doc_id": doc_id}, record, upsert=True)
+    record["path"] = path
+    return record
+
+async def discard_stored_pdf(doc_kind: str, doc_id: str):
+    await db.pdf_store.delete_one({"doc_kind": doc_kind, "doc_id": doc_id})
+    pdf_store_path(doc_kind, doc_id).unlink(missing_ok=True)
+    await db.pdf_thumbnails.delete_one({"doc_kind": doc_kind, "doc_id": doc_id})
+    pdf_thumbnail_path(doc_kind, doc_id).unlink(missing_ok=True)
+
+async def render_to_pdf_store(doc_kind: str, doc: dict) -> dict:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    doc_id = doc[spec["id_field"]]
+    pdf = await render_pdf_async(await build_document_pdf_html(doc_kind, doc))
+    record = await store_pdf(doc_kind, doc_id, pdf)
+    await db[spec["collection"]].update_one(
+        {spec["id_field"]: doc_id},
+        {"$set": {"pdf_status": "ready"}, "$unset": {"pdf_error": "", "pdf_lease_expires_at": ""}}
+    )
+    return record
+
+# A worker that dies mid-render leaves the claim; it is taken over once the lease runs out
+PDF_PRERENDER_LEASE_SECONDS = int(os.environ.get("PDF_PRERENDER_LEASE_SECONDS", "300"))
+
+def prerender_claimable() -> dict:
+    return {"is_locked": True, "$or": [
+        {"pdf_status": "pending"},
+        {"pdf_status": "rendering", "pdf_lease_expires_at": {"$lte": datetime.now(timezone.utc)}}
+    ]}
+
+# (doc_kind, doc_id) -> running pre-render; re-queued ids render once more when it finishes
+_pdf_prerenders: Dict[tuple, asyncio.Task] = {}
+_pdf_prerenders_requeued = set()
+
+async def _prerender_document_pdf(doc_kind: str, doc_id: str):
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    collection = db[spec["collection"]]
+    key = (doc_kind, doc_id)
+    try:
+        while True:
+            _pdf_prerenders_requeued.discard(key)
+            # Claim it, so workers resuming the same pending documents render each only once
+            doc = await collection.find_one_and_update(
+                {spec["id_field"]: doc_id, **prerender_claimable()},
+                {"$set": {
+                    "pdf_status": "rendering",
+                    "pdf_lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=PDF_PRERENDER_LEASE_SECONDS)
+                }},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            if not doc:
+                return
+            try:
+                with pdf_render_trace(doc_kind, doc_id, source="prerender") as trace:
+                    trace["lines"] = len(doc["items"])
+                    await render_to_pdf_store(doc_kind, doc)
+            except Exception as e:
+                logger.exception(f"Pre-rendering {doc_kind} {doc_id} failed")
+                await collection.update_one(
+                    {spec["id_field"]: doc_id},
+                    {
+                        "$set": {"pdf_status": "failed", "pdf_error": str(e.detail) if isinstance(e, HTTPException) else str(e)},
+                        "$unset": {"pdf_lease_expires_at": ""}
+                    }
+                )
+            # The document was queued again (set back to pending) while we were rendering
+            if key not in _pdf_prerenders_requeued:
+                return
+    finally:
+        _pdf_prerenders.pop(key, None)
+
+def schedule_pdf_prerender(doc_kind: str, doc_id: str) -> asyncio.Task:
+    """Render a locked document into the PDF store after the request returns."""
+    key = (doc_kind, doc_id)
+    task = _pdf_prerenders.get(key)
+    if task:
+        _pdf_prerenders_requeued.add(key)
+        return task
+    task = spawn_background_task(_prerender_document_pdf(doc_kind, doc_id))
+    _pdf_prerenders[key] = task
+    return task
+
+def document_lock_fields() -> dict:
+    """Fields every lock sets, whether one document or a batch is locked."""
+    return {"is_locked": True, "pdf_status": "pending", "locked_at": datetime.now(timezone.utc).isoformat()}
+
+async def update_document(
+    doc_kind: str,
+    doc_id: str,
+    fields: dict,
+    expected_version: Optional[int] = None,
+    lock: bool = False
+) -> dict:
+    """Apply an edit to an unlocked quotation, PI or SOA in one round trip.
+    
+    The filter only matches while the document is unlocked and, when the
+    client sent one, still at the version the edit was based on, so two
+    devices saving the same document cannot overwrite each other.
+    """
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    update = {"$set": dict(fields), "$inc": {"version": 1}}
+    if "items" in fields:
+        update["$set"].update(await document_tax_fields(fields["items"]))
+    if lock:
+        update["$set"].update(document_lock_fields())
+        update["$unset"] = {"pdf_error": ""}
+    doc = await db[spec["collection"]].find_one_and_update(
+        {spec["id_field"]: doc_id, "is_locked": {"$ne": True}, **version_guard(expected_version)},
+        update,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        await raise_write_conflict(spec["collection"], spec["id_field"], doc_id, spec["label"], expected_version)
+    if lock:
+        schedule_pdf_prerender(doc_kind, doc_id)
+    return doc
+
+async def lock_document(doc_kind: str, doc_id: str, expected_version: Optional[int] = None) -> dict:
+    return await update_document(doc_kind, doc_id, {}, expected_version, lock=True)
+
+async def delete_document(doc_kind: str, doc_id: str, expected_version: Optional[int] = None) -> dict:
+    # Locked documents are final and cannot be deleted
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    doc = await db[spec["collection"]].find_one_and_delete(
+        {spec["id_field"]: doc_id, "is_locked": {"$ne": True}, **version_guard(expected_version)},
+        projection={"_id": 0}
+    )
+    if doc is None:
+        await raise_write_conflict(spec["collection"], spec["id_field"], doc_id, spec["label"], expected_version)
+    await discard_stored_pdf(doc_kind, doc_id)
+    return doc
+
+async def resume_pdf_prerenders():
+    # Pre-renders that were pending, or claimed by a worker that has since stopped
+    for doc_kind, spec in PDF_DOCUMENT_TYPES.items():
+        async for doc in db[spec["collection"]].find(prerender_claimable(), {"_id": 0, spec["id_field"]: 1}):
+            schedule_pdf_prerender(doc_kind, doc[spec["id_field"]])
+
+async def get_stored_document_pdf(doc_kind: str, doc: dict) -> dict:
+    """PDF store record of a locked document, rendering it first if needed.
+    
+    A locked document is rendered once, when it is locked, and that copy is
+    what every later download gets, so it does not shift when party or item
+    master data is edited afterwards.
+    """
+    doc_id = doc[PDF_DOCUMENT_TYPES[doc_kind]["id_field"]]
+    prerender = _pdf_prerenders.get((doc_kind, doc_id))
+    if prerender:
+        # Wait for the pre-render instead of rendering the same document twice
+        await asyncio.shield(prerender)
+    with pdf_stage("pdf_store"):
+        stored = await load_stored_pdf(doc_kind, doc_id)
+    if stored:
+        return stored
+    # Locked before pre-rendering existed, or the pre-render failed
+    return await render_to_pdf_store(doc_kind, doc)
+
+async def get_document_pdf(doc_kind: str, doc: dict) -> bytes:
+    """Render a quotation, PI or SOA; locked documents come from the PDF store."""
+    if not doc.get("is_locked"):
+        return await render_pdf_async(await build_document_pdf_html(doc_kind, doc))
+    stored = await get_stored_document_pdf(doc_kind, doc)
+    return await asyncio.to_thread(stored["path"].read_bytes)
+
+def pdf_file_name(doc_kind: str, doc: dict) -> str:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    doc_no_safe = doc[spec["no_field"]].replace("/", "_")
+    return f"{spec['file_prefix']}_{doc_no_safe}.pdf"
+
+PDF_CACHE_MAX_AGE_SECONDS = int(os.environ.get("PDF_CACHE_MAX_AGE_SECONDS", "86400"))
+PDF_STREAM_CHUNK_SIZE = 64 * 1024
+
+def parse_byte_range(range_header: str, size: int) -> Optional[tuple]:
+    """(start, end) for a single `bytes=` range, None to send the whole file.
+    
+    Multi-range and malformed headers are ignored, which RFC 9110 allows.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                raise ValueError
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        # Last byte before the first is invalid, not unsatisfiable
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, size - 1 if end is None else min(end, size - 1)
+
+def _iter_file_range(path: Path, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(PDF_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def rendered_pdf_etag(html_content: str) -> str:
+    """Weak ETag for a PDF rendered on demand, taken from its inputs before rendering.
+    
+    Two renders of the same HTML are equivalent but not promised to be byte-identical,
+    so the tag is weak and these responses do not offer byte ranges.
+    """
+    return f'W/"{hashlib.sha256(f"{pdf_renderer.revision}:{html_content}".encode()).hexdigest()}"'
+
+def pdf_cache_headers(etag: str, cacheable: bool) -> dict:
+    return {
+        "ETag": etag,
+        # Ranges are only safe to stitch together from bytes with a strong ETag
+        "Accept-Ranges": "none" if etag.startswith("W/") else "bytes",
+        # Auth-protected, so never cache in shared proxies
+        "Cache-Control": f"private, max-age={PDF_CACHE_MAX_AGE_SECONDS}" if cacheable else "private, no-cache"
+    }
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses weak comparison: W/"x" and "x" are the same tag
+    if_none_match = request.headers.get("if-none-match")
+    tags = [t.strip().removeprefix("W/") for t in (if_none_match or "").split(",")]
+    return bool(if_none_match) and (if_none_match.strip() == "*" or etag.removeprefix("W/") in tags)
+
+def pdf_response(
+    request: Request,
+    filename: Optional[str],
+    content: Optional[bytes] = None,
+    path: Optional[Path] = None,
+    sha256: Optional[str] = None,
+    cacheable: bool = False,
+    media_type: str = "application/pdf",
+    etag: Optional[str] = None
+) -> Response:
+    """Serve PDF bytes or a stored PDF file with an ETag, 304s and Range.
+    
+    The ETag is the strong content hash unless `etag` (a weak rendered_pdf_etag)
+    is given, in which case Range is not offered. Stored files are streamed in
+    chunks; `cacheable` (locked documents) lets the browser reuse its copy,
+    everything else must revalidate. Thumbnails reuse this with their own media
+    type and no attachment filename.
+    """
+    if content is not None:
+        size = len(content)
+    else:
+        size = path.stat().st_size
+    if etag is None:
+        etag = f'"{sha256 or hashlib.sha256(content).hexdigest()}"'
+    headers = pdf_cache_headers(etag, cacheable)
+    
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    if filename:
+        headers["Content-Disposition"] = f"attachment; filename={filename}"
+    byte_range = None
+    range_header = request.headers.get("range")
+    # If-Range: only honour the range if the client's copy is still current
+    if range_header and headers["Accept-Ranges"] == "bytes" and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except HTTPException as e:
+            e.headers.update(headers)
+            raise
+    
+    start, end = byte_range or (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    status_code = 200
+    if byte_range:
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    if content is not None:
+        return Response(content=content[start:end + 1], status_code=status_code, media_type=media_type, headers=headers)
+    return StreamingResponse(_iter_file_range(path, start, end), status_code=status_code, media_type=media_type, headers=headers)
+
+async def document_pdf_response(doc_kind: str, doc_id: str, request: Request, current_user: dict) -> Response:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    with pdf_render_trace(doc_kind, doc_id) as trace:
+        # CRITICAL: Fetch document fresh from DB by document_id
+        with pdf_stage("fetch_doc"):
+            doc = await find_document(doc_kind, doc_id)
+        if not doc:
+            raise HTTPException(status_code=404, detail=spec["not_found"])
+        trace["lines"] = len(doc["items"])
         
-        # Use stored values first (IMMUTABLE)
-        enriched_item['item_name'] = item.get('item_name', '')
-        enriched_item['hsn'] = item.get('HSN', '')
-        enriched_item['uom'] = item.get('UOM', 'Nos')
-        enriched_item['description'] = item_details.get('description', '') if item_details else ''
+        # Generate filename with username and timestamp
+        username = current_user["name"].replace(" ", "_").lower()[:10]
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = pdf_file_name(doc_kind, doc).replace(".pdf", f"_{username}_{timestamp}.pdf")
         
-        # Fallback to item master if stored values are empty (backward compatibility)
-        if item_details:
-            enriched_item['hsn'] = enriched_item['hsn'] or item_details.get('HSN', '')
-            enriched_item['item_name'] = enriched_item['item_name'] or item_details.get('item_name', '')
-            enriched_item['uom'] = enriched_item['uom'] or item_details.get('UOM', 'Nos')
+        if doc.get("is_locked"):
+            stored = await get_stored_document_pdf(doc_kind, doc)
+            with pdf_stage("response"):
+                return pdf_response(request, filename, path=stored["path"], sha256=stored["sha256"], cacheable=True)
         
-        enriched_items.append(enriched_item)
-    
-    # Calculate totals
-    subtotal = sum(item["taxable_amount"] for item in pi["items"])
-    tax_total = sum(item["tax_amount"] for item in pi["items"])
-    grand_total = sum(item["total_amount"] for item in pi["items"])
-    
-    html_content = generate_document_html(
-        doc_type="PROFORMA INVOICE",
-        doc_no=pi["pi_no"],
-        doc_date=pi["date"],
-        party=party,
-        items=enriched_items,
-        subtotal=subtotal,
-        tax_total=tax_total,
-        grand_total=grand_total,
-        remarks=pi.get("remarks", ""),
-        payment_terms=pi.get("payment_terms", ""),
-        delivery_terms=pi.get("delivery_terms", ""),
-        is_quotation=False
-    )
-    
-    pdf = HTML(string=html_content).write_pdf()
-    
-    # Generate filename with username and timestamp
-    username = current_user["name"].replace(" ", "_").lower()[:10]
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    doc_no_safe = pi['pi_no'].replace("/", "_")
-    filename = f"proforma_invoice_{doc_no_safe}_{username}_{timestamp}.pdf"
-    
-    return Response(
-        content=pdf,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+        html = await build_document_pdf_html(doc_kind, doc)
+        # The HTML and stylesheet decide the PDF, so a browser revalidating its copy needs no render
+        etag = rendered_pdf_etag(html)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=pdf_cache_headers(etag, cacheable=False))
+        pdf = await render_pdf_async(html)
+        with pdf_stage("response"):
+            return pdf_response(request, filename, content=pdf, etag=etag)
+
+@api_router.get("/quotations/{quotation_id}/pdf")
+async def generate_quotation_pdf(quotation_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    return await document_pdf_response("quotation", quotation_id, request, current_user)
+
+@api_router.get("/proforma-invoices/{pi_id}/pdf")
+async def generate_pi_pdf(pi_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    return await document_pdf_response("proforma_invoice", pi_id, request, current_user)
 
 @api_router.get("/soa/{soa_id}/pdf")
-async def generate_soa_pdf(soa_id: str, current_user: dict = Depends(get_current_user)):
-    # CRITICAL: Fetch document fresh from DB by document_id
-    soa = await db.soa.find_one({"soa_id": soa_id}, {"_id": 0})
-    if not soa:
-        raise HTTPException(status_code=404, detail="SOA not found")
+async def generate_soa_pdf(soa_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    return await document_pdf_response("soa", soa_id, request, current_user)
+
+def pdf_thumbnail_path(doc_kind: str, doc_id: str) -> Path:
+    return PDF_STORE_DIR / "thumbnails" / doc_kind / f"{Path(doc_id).name}.png"
+
+async def get_document_thumbnail(doc_kind: str, doc: dict) -> dict:
+    """Stored thumbnail record, regenerated when the page it was made from changes.
     
-    # CRITICAL: Resolve party strictly by party_id - no fallback
-    party = await db.parties.find_one({"party_id": soa["party_id"]}, {"_id": 0})
+    Locked documents key the thumbnail on the stored PDF's hash; unlocked ones
+    on the hash of the generated HTML, so a list view only re-renders the PDF
+    for documents that were edited since the last preview.
+    """
+    doc_id = doc[PDF_DOCUMENT_TYPES[doc_kind]["id_field"]]
+    stored_pdf = None
+    html_content = None
+    if doc.get("is_locked"):
+        stored_pdf = await get_stored_document_pdf(doc_kind, doc)
+        source_key = stored_pdf["sha256"]
+    else:
+        html_content = await build_document_pdf_html(doc_kind, doc)
+        source_key = hashlib.sha256(html_content.encode("utf-8")).hexdigest()
     
-    # Use party_name_snapshot if available (for data integrity)
-    if soa.get("party_name_snapshot") and party:
-        party["party_name"] = soa["party_name_snapshot"]
+    path = pdf_thumbnail_path(doc_kind, doc_id)
+    record = await db.pdf_thumbnails.find_one({"doc_kind": doc_kind, "doc_id": doc_id}, {"_id": 0})
+    if record and record["source_key"] == source_key and path.is_file():
+        record["path"] = path
+        return record
     
-    # CRITICAL: Items must use stored values (UOM, item_name, etc.)
-    enriched_items = []
-    for item in soa["items"]:
-        enriched_item = item.copy()
-        
-        # Always fetch description from item master (it's display-only, not stored per line)
-        item_details = await db.items.find_one({"item_id": item["item_id"]}, {"_id": 0})
-        
-        # Use stored values first (IMMUTABLE)
-        enriched_item['item_name'] = item.get('item_name', '')
-        enriched_item['hsn'] = item.get('HSN', '')
-        enriched_item['uom'] = item.get('UOM', 'Nos')
-        enriched_item['description'] = item_details.get('description', '') if item_details else ''
-        
-        # Fallback to item master if stored values are empty (backward compatibility)
-        if item_details:
-            enriched_item['hsn'] = enriched_item['hsn'] or item_details.get('HSN', '')
-            enriched_item['item_name'] = enriched_item['item_name'] or item_details.get('item_name', '')
-            enriched_item['uom'] = enriched_item['uom'] or item_details.get('UOM', 'Nos')
-        
-        enriched_items.append(enriched_item)
-    
-    # Calculate totals
-    subtotal = sum(item["taxable_amount"] for item in soa["items"])
-    tax_total = sum(item["tax_amount"] for item in soa["items"])
-    grand_total = sum(item["total_amount"] for item in soa["items"])
-    
-    html_content = generate_document_html(
-        doc_type="SALES ORDER ACKNOWLEDGEMENT",
-        doc_no=soa["soa_no"],
-        doc_date=soa["date"],
-        party=party,
-        items=enriched_items,
-        subtotal=subtotal,
-        tax_total=tax_total,
-        grand_total=grand_total,
-        remarks=soa.get("remarks", ""),
-        payment_terms=soa.get("payment_terms", ""),
-        delivery_terms=soa.get("delivery_terms", ""),
-        party_confirmation_id=soa.get("party_confirmation_ID", ""),
-        is_soa=True,
-        is_quotation=False
+    if stored_pdf:
+        pdf = await asyncio.to_thread(stored_pdf["path"].read_bytes)
+    else:
+        pdf = await render_pdf_async(html_content)
+    png = await run_in_pdf_pool(render_pdf_thumbnail, pdf)
+    await asyncio.to_thread(_write_file_atomic, path, png)
+    record = {
+        "doc_kind": doc_kind,
+        "doc_id": doc_id,
+        "source_key": source_key,
+        "sha256": hashlib.sha256(png).hexdigest(),
+        "size": len(png),
+        "rendered_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.pdf_thumbnails.replace_one({"doc_kind": doc_kind, "doc_id": doc_id}, record, upsert=True)
+    record["path"] = path
+    return record
+
+@api_router.get("/pdf/thumbnail/{doc_type}/{doc_id}")
+async def get_pdf_thumbnail(doc_type: str, doc_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    spec = PDF_DOCUMENT_TYPES.get(doc_type)
+    if not spec:
+        raise HTTPException(status_code=400, detail=f"doc_type must be one of: {', '.join(PDF_DOCUMENT_TYPES)}")
+    doc = await find_document(doc_type, doc_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail=spec["not_found"])
+    
+    thumbnail = await get_document_thumbnail(doc_type, doc)
+    return pdf_response(
+        request,
+        None,
+        path=thumbnail["path"],
+        sha256=thumbnail["sha256"],
+        cacheable=bool(doc.get("is_locked")),
+        media_type="image/png"
     )
+
+class BulkDocumentSelection(BaseModel):
+    """Quotations, PIs or SOAs picked by id or, when ids is empty, by filter."""
+    doc_type: str  # quotation, proforma_invoice or soa
+    ids: List[str] = []
+    # Used when ids is empty; same meaning as on the list endpoints
+    period: Optional[str] = None
+    from_date: Optional[str] = None
+    to_date: Optional[str] = None
+    user_id: Optional[str] = None
+    party_id: Optional[str] = None
+    filter_status: Optional[str] = None
+
+class PdfBatchRequest(BulkDocumentSelection):
+    pass
+
+def pdf_batch_path(job_id: str) -> Path:
+    return PDF_STORE_DIR / "batches" / f"{job_id}.zip"
+
+def _purge_old_pdf_batches():
+    cutoff = time.time() - PDF_BATCH_RETENTION_HOURS * 3600
+    # Also catches .zip.part files left by a worker that died mid-batch
+    for path in (PDF_STORE_DIR / "batches").glob("*.zip*"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            pass  # Another worker's sweep got there first
+
+async def run_pdf_batch_cleanup():
+    # Batch zips are only kept for PDF_BATCH_RETENTION_HOURS, downloaded or not
+    while True:
+        try:
+            await asyncio.to_thread(_purge_old_pdf_batches)
+        except Exception as e:
+            logger.error(f"PDF batch cleanup failed: {e}")
+        await asyncio.sleep(3600)
+
+async def run_pdf_batch_job(job_id: str, params: dict, user_id: str) -> dict:
+    doc_kind = params["doc_type"]
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    ids = params["ids"]
     
-    pdf = HTML(string=html_content).write_pdf()
+    docs = {
+        doc[spec["id_field"]]: doc
+        async for doc in db[spec["collection"]].find({spec["id_field"]: {"$in": ids}}, {"_id": 0})
+    }
+    missing = [doc_id for doc_id in ids if doc_id not in docs]
+    failed = [{"id": doc_id, "error": spec["not_found"]} for doc_id in missing]
+    total = len(ids)
+    done = len(missing)
+    await update_job_progress(job_id, done, total)
+    
+    # Two renders per worker keeps the pool busy without holding every PDF in memory
+    limit = asyncio.Semaphore(max(PDF_RENDER_WORKERS, 1) * 2)
+    
+    async def render(doc):
+        async with limit:
+            try:
+                with pdf_render_trace(doc_kind, doc[spec["id_field"]], source="batch") as trace:
+                    trace["lines"] = len(doc["items"])
+                    return doc, await get_document_pdf(doc_kind, doc), None
+            except Exception as e:
+                logger.exception(f"Batch {job_id}: rendering {doc[spec['id_field']]} failed")
+                return doc, None, str(e.detail) if isinstance(e, HTTPException) else str(e)
+    
+    path = pdf_batch_path(job_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written under a temporary name so a download never sees a half-written zip
+    partial = path.with_name(f"{path.name}.part")
+    names = set()
+    try:
+        with zipfile.ZipFile(partial, "w", compression=zipfile.ZIP_STORED) as archive:
+            for next_done in asyncio.as_completed([render(docs[doc_id]) for doc_id in ids if doc_id in docs]):
+                doc, pdf, error = await next_done
+                if error:
+                    failed.append({"id": doc[spec["id_field"]], "error": error})
+                else:
+                    name = pdf_file_name(doc_kind, doc)
+                    if name in names:
+                        name = name.replace(".pdf", f"_{doc[spec['id_field']]}.pdf")
+                    names.add(name)
+                    # PDFs are already compressed; store them as-is
+                    await asyncio.to_thread(archive.writestr, name, pdf)
+                done += 1
+                await update_job_progress(job_id, done, total)
+        partial.replace(path)
+    except BaseException:
+        # Failed or cancelled jobs have nothing to download; don't leave the file behind
+        partial.unlink(missing_ok=True)
+        raise
     
-    # Generate filename with username and timestamp
-    username = current_user["name"].replace(" ", "_").lower()[:10]
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    doc_no_safe = soa['soa_no'].replace("/", "_")
-    filename = f"soa_{doc_no_safe}_{username}_{timestamp}.pdf"
+    return {
+        "file_name": f"{spec['file_prefix']}s_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+        "rendered": len(names),
+        "failed": failed,
+        "download_url": f"/api/pdf/batch/{job_id}/download"
+    }
+
+async def resolve_batch_document_ids(batch: BulkDocumentSelection, current_user: dict, limit: int) -> List[str]:
+    """Ids a bulk request selects, explicitly or by filter, limited to what the user may see."""
+    spec = PDF_DOCUMENT_TYPES.get(batch.doc_type)
+    if not spec:
+        raise HTTPException(status_code=400, detail=f"doc_type must be one of: {', '.join(PDF_DOCUMENT_TYPES)}")
     
-    return Response(
-        content=pdf,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    if batch.ids:
+        query = {spec["id_field"]: {"$in": batch.ids}}
+        if current_user["role"] != "Admin":
+            query["created_by_user_id"] = current_user["user_id"]
+    else:
+        if not (batch.period or batch.user_id or batch.party_id or batch.filter_status):
+            raise HTTPException(status_code=400, detail="Provide document ids or at least one filter")
+        query = build_document_list_query(
+            current_user, batch.party_id, batch.user_id, batch.period, batch.from_date, batch.to_date
+        )
+        if batch.filter_status:
+            query[spec["status_field"]] = batch.filter_status
+    
+    ids = [
+        doc[spec["id_field"]]
+        async for doc in db[spec["collection"]].find(query, {"_id": 0, spec["id_field"]: 1}).sort("date", 1)
+    ]
+    if batch.ids:
+        # Keep the caller's order; silently drop ids this user may not export
+        allowed = set(ids)
+        ids = [doc_id for doc_id in dict.fromkeys(batch.ids) if doc_id in allowed]
+    if not ids:
+        raise HTTPException(status_code=404, detail="No documents match")
+    if len(ids) > limit:
+        raise HTTPException(status_code=400, detail=f"{len(ids)} documents match; narrow the filter to {limit} or fewer")
+    return ids
+
+@api_router.post("/pdf/batch", status_code=202)
+async def start_pdf_batch(batch: PdfBatchRequest, current_user: dict = Depends(get_current_user)):
+    ids = await resolve_batch_document_ids(batch, current_user, PDF_BATCH_MAX_DOCUMENTS)
+    job = await start_background_job(
+        "pdf_batch", {"doc_type": batch.doc_type, "ids": ids}, current_user["user_id"], run_pdf_batch_job
     )
+    return {"job_id": job["job_id"], "status": job["status"], "total": len(ids)}
+
+@api_router.get("/pdf/batch/{job_id}/download")
+async def download_pdf_batch(job_id: str, current_user: dict = Depends(get_current_user)):
+    job = await db.jobs.find_one({"job_id": job_id, "job_type": "pdf_batch"}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if current_user["role"] != "Admin" and job["created_by"] != current_user["user_id"]:
+        raise HTTPException(status_code=403, detail="Not allowed to view this job")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Batch is {job['status']}")
+    
+    path = pdf_batch_path(job_id)
+    if not path.is_file():
+        raise HTTPException(status_code=410, detail="Batch file has expired, please export again")
+    return FileResponse(path, media_type="application/zip", filename=job["result"]["file_name"])
+
+# ==================== DOCUMENT EMAIL ====================
+
+class DocumentEmailRequest(BaseModel):
+    to: List[EmailStr] = []  # Defaults to the party's email
+    subject: Optional[str] = None
+    message: str = ""
+
+class DocumentEmailBatchRequest(BulkDocumentSelection):
+    message: str = ""
+
+def build_document_email(doc_kind: str, doc: dict, party: dict, message: str) -> Tuple[str, str]:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    label = spec["title"].title()
+    greeting = html_escape(party.get("contact_person") or party.get("party_name") or "Sir/Madam")
+    note = "".join(f"<p>{html_escape(line)}</p>" for line in message.splitlines() if line.strip())
+    html_content = f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; padding: 20px;">
+        <p>Dear {greeting},</p>
+        <p>Please find attached our {label} {html_escape(doc[spec["no_field"]])}.</p>
+        {note}
+        <br>
+        <p>Regards,<br>SUNSTORE KOLHAPUR</p>
+    </body>
+    </html>
+    """
+    text = f"Dear {party.get('contact_person') or party.get('party_name') or 'Sir/Madam'},\n\n" \
+        f"Please find attached our {label} {doc[spec['no_field']]}.\n\n{message}\n\nRegards,\nSUNSTORE KOLHAPUR"
+    return html_content, text
+
+async def queue_document_email(
+    doc_kind: str,
+    doc: dict,
+    party: Optional[dict],
+    user_id: str,
+    to: Optional[List[str]] = None,
+    subject: Optional[str] = None,
+    message: str = ""
+) -> dict:
+    """Put a document's PDF in the email outbox and mark the document as queued."""
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    doc_id = doc[spec["id_field"]]
+    party = party or {}
+    recipients = list(to or ([party["email"]] if party.get("email") else []))
+    if not recipients:
+        raise HTTPException(status_code=400, detail="Party has no email address")
+    
+    html_content, text = build_document_email(doc_kind, doc, party, message)
+    email_id = await enqueue_email(
+        recipients,
+        subject or f"{spec['title'].title()} {doc[spec['no_field']]} - SUNSTORE KOLHAPUR",
+        html_content,
+        text=text,
+        kind="document",
+        doc_kind=doc_kind,
+        doc_id=doc_id,
+        attachments=[{"doc_kind": doc_kind, "doc_id": doc_id, "filename": pdf_file_name(doc_kind, doc)}],
+        sent_by=user_id
+    )
+    await db[spec["collection"]].update_one(
+        {spec["id_field"]: doc_id},
+        {
+            "$set": {
+                "email_status": "queued",
+                "email_id": email_id,
+                "emailed_to": recipients,
+                "email_queued_at": datetime.now(timezone.utc).isoformat()
+            },
+            "$unset": {"email_error": ""}
+        }
+    )
+    await log_document_action(spec["log_type"], doc_id, "EMAILED", user_id, details={"to": recipients, "email_id": email_id})
+    return {"email_id": email_id, "to": recipients, "email_status": "queued"}
+
+async def record_document_email_outcome(message: dict, outcome: str, fields: dict):
+    spec = PDF_DOCUMENT_TYPES[message["doc_kind"]]
+    if outcome == "sent":
+        update = {"$set": {"email_status": "sent", "emailed_at": fields["sent_at"]}, "$unset": {"email_error": ""}}
+    elif outcome == "dead":
+        update = {"$set": {"email_status": "failed", "email_error": fields["last_error"]}}
+    else:
+        # Still queued; show why the last attempt failed
+        update = {"$set": {"email_error": fields["last_error"]}}
+    # A newer send of the same document owns the status
+    await db[spec["collection"]].update_one({spec["id_field"]: message["doc_id"], "email_id": message["email_id"]}, update)
+
+async def send_document_email(doc_kind: str, doc_id: str, request: DocumentEmailRequest, current_user: dict) -> dict:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    doc = await find_document(doc_kind, doc_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail=spec["not_found"])
+    party = await db.parties.find_one({"party_id": doc["party_id"]}, {"_id": 0})
+    return await queue_document_email(
+        doc_kind, doc, party, current_user["user_id"], request.to, request.subject, request.message
+    )
+
+@api_router.post("/quotations/{quotation_id}/send", status_code=202)
+async def send_quotation(quotation_id: str, request: DocumentEmailRequest, current_user: dict = Depends(get_current_user)):
+    return await send_document_email("quotation", quotation_id, request, current_user)
+
+@api_router.post("/proforma-invoices/{pi_id}/send", status_code=202)
+async def send_pi(pi_id: str, request: DocumentEmailRequest, current_user: dict = Depends(get_current_user)):
+    return await send_document_email("proforma_invoice", pi_id, request, current_user)
+
+@api_router.post("/soa/{soa_id}/send", status_code=202)
+async def send_soa(soa_id: str, request: DocumentEmailRequest, current_user: dict = Depends(get_current_user)):
+    return await send_document_email("soa", soa_id, request, current_user)
+
+async def run_document_email_job(job_id: str, params: dict, user_id: str) -> dict:
+    # Only enqueues; the outbox sender renders and delivers at its own pace
+    doc_kind = params["doc_type"]
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    ids = params["ids"]
+    docs = {
+        doc[spec["id_field"]]: doc
+        async for doc in db[spec["collection"]].find({spec["id_field"]: {"$in": ids}}, {"_id": 0})
+    }
+    party_ids = list({doc["party_id"] for doc in docs.values()})
+    parties = {p["party_id"]: p async for p in db.parties.find({"party_id": {"$in": party_ids}}, {"_id": 0})}
+    
+    queued, skipped = 0, []
+    for done, doc_id in enumerate(ids, start=1):
+        doc = docs.get(doc_id)
+        if not doc:
+            skipped.append({"id": doc_id, "error": spec["not_found"]})
+        else:
+            try:
+                await queue_document_email(doc_kind, doc, parties.get(doc["party_id"]), user_id, message=params["message"])
+                queued += 1
+            except HTTPException as e:
+                skipped.append({"id": doc_id, "error": e.detail})
+        if done % 20 == 0 or done == len(ids):
+            await update_job_progress(job_id, done, len(ids))
+    return {"queued": queued, "skipped": skipped}
+
+@api_router.post("/email/batch", status_code=202)
+async def start_document_email_batch(batch: DocumentEmailBatchRequest, current_user: dict = Depends(get_current_user)):
+    ids = await resolve_batch_document_ids(batch, current_user, PDF_BATCH_MAX_DOCUMENTS)
+    job = await start_background_job(
+        "email_batch",
+        {"doc_type": batch.doc_type, "ids": ids, "message": batch.message},
+        current_user["user_id"],
+        run_document_email_job
+    )
+    return {"job_id": job["job_id"], "status": job["status"], "total": len(ids)}
 
 async def get_item_details(item_id: str):
     """Fetch item details from database"""
     item = await db.items.find_one({"item_id": item_id}, {"_id": 0})
     return item if item else {}
 
-def generate_document_html(
-    doc_type: str,
-    doc_no: str,
-    doc_date: str,
-    party: dict,
-    items: List[dict],
-    subtotal: float,
-    tax_total: float,
-    grand_total: float,
-    remarks: str = "",
-    payment_terms: str = "",
-    delivery_terms: str = "",
-    party_confirmation_id: str = "",
-    is_soa: bool = False,
-    is_quotation: bool = False
-):
-    # Intro paragraph - different for Quotation vs PI/SOA
-    if is_quotation:
-        intro_paragraph = "Dear Sir,<br>We thank you for your enquiry and we are pleased to submit our <strong>offer</strong> as detailed below."
-    else:
-        intro_paragraph = "Dear Sir,<br>We thank you for your enquiry and we are pleased to submit our <strong>order</strong> as detailed below."
-    
-    # Check if any item has discount > 0
-    has_discount = any(item.get('discount_percent', 0) > 0 for item in items)
+# ==================== BULK OPERATIONS ====================
+
+BULK_MAX_IDS = int(os.environ.get("BULK_MAX_IDS", "1000"))
+
+class BulkStatusRequest(BulkDocumentSelection):
+    # Required, so a client that forgets it cannot reset documents; send null for Pending
+    to_status: Optional[str]
+
+@api_router.post("/bulk/status")
+async def bulk_update_status(request: BulkStatusRequest, current_user: dict = Depends(get_current_user)):
+    """Move many quotations, PIs or SOAs to one status with a single write.
     
-    # Build items table rows based on discount presence
-    items_html = ""
-    for idx, item in enumerate(items, 1):
-        rate = item['rate']
-        discount = item.get('discount_percent', 0)
-        
-        if has_discount:
-            # Full table with List Price, Disc%, Rate columns
-            list_price = rate / (1 - discount / 100) if discount > 0 else rate
-            items_html += f"""
-            <tr>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: center; font-size: 10px;">{idx}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{item.get('item_name', item.get('item_id', ''))}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{item.get('hsn', '')}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{item.get('description', '')}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">{item['qty']:.1f} {item.get('uom', 'Nos')}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">₹{list_price:.2f}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">{discount:.2f}%</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">₹{rate:.2f}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;"><strong>₹{item['taxable_amount']:.2f}</strong></td>
-            </tr>
-            """
+    Locked documents and ones already at the target status are skipped;
+    every requested id gets an outcome: updated, unchanged, locked,
+    not_found, or conflict when it was locked or edited mid-request.
+    """
+    ids = await resolve_batch_document_ids(request, current_user, BULK_MAX_IDS)
+    spec = PDF_DOCUMENT_TYPES[request.doc_type]
+    status_field = spec["status_field"]
+    if request.to_status not in spec["statuses"]:
+        allowed = ", ".join(str(s) for s in spec["statuses"] if s)
+        raise HTTPException(status_code=400, detail=f"{spec['label']} status must be one of: {allowed}")
+    
+    collection = db[spec["collection"]]
+    docs = {
+        doc[spec["id_field"]]: doc
+        async for doc in collection.find(
+            {spec["id_field"]: {"$in": ids}},
+            {"_id": 0, spec["id_field"]: 1, status_field: 1, "is_locked": 1}
+        )
+    }
+    outcomes = {doc_id: "not_found" for doc_id in request.ids}
+    eligible = []
+    for doc_id in ids:
+        doc = docs.get(doc_id)
+        if doc is None:
+            outcomes[doc_id] = "not_found"
+        elif doc.get("is_locked"):
+            outcomes[doc_id] = "locked"
+        elif doc.get(status_field) == request.to_status:
+            outcomes[doc_id] = "unchanged"
         else:
-            # Simplified table: Sr, Item, HSN/SAC, Description, Quantity, Rate, Amount
-            items_html += f"""
-            <tr>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: center; font-size: 10px;">{idx}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{item.get('item_name', item.get('item_id', ''))}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{item.get('hsn', '')}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{item.get('description', '')}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">{item['qty']:.1f} {item.get('uom', 'Nos')}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">₹{rate:.2f}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;"><strong>₹{item['taxable_amount']:.2f}</strong></td>
-            </tr>
-            """
-    
-    # Build tax table rows (group by HSN)
-    hsn_groups = {}
-    for item in items:
-        hsn = item.get('hsn', 'HSN/SAC')
-        if not hsn:
-            hsn = 'HSN/SAC'
-        if hsn not in hsn_groups:
-            hsn_groups[hsn] = {
-                'taxable': 0,
-                'sgst': 0,
-                'cgst': 0,
-                'igst': 0,
-                'tax_type': item['tax_type']
+            eligible.append(doc_id)
+    
+    if eligible:
+        # The stamp identifies this request's writes if the filter drops some
+        stamp = datetime.now(timezone.utc).isoformat()
+        result = await collection.update_many(
+            {spec["id_field"]: {"$in": eligible}, "is_locked": {"$ne": True}, status_field: {"$ne": request.to_status}},
+            {"$set": {status_field: request.to_status, "status_changed_at": stamp}, "$inc": {"version": 1}}
+        )
+        updated = eligible
+        if result.modified_count != len(eligible):
+            changed = {
+                doc[spec["id_field"]]
+                async for doc in collection.find(
+                    {spec["id_field"]: {"$in": eligible}, "status_changed_at": stamp}, {"_id": 0, spec["id_field"]: 1}
+                )
             }
-        hsn_groups[hsn]['taxable'] += item['taxable_amount']
-        
-        if item['tax_type'] == 'CGST+SGST':
-            hsn_groups[hsn]['sgst'] += item['tax_amount'] / 2
-            hsn_groups[hsn]['cgst'] += item['tax_amount'] / 2
+            updated = [doc_id for doc_id in eligible if doc_id in changed]
+        for doc_id in eligible:
+            outcomes[doc_id] = "conflict"
+        for doc_id in updated:
+            outcomes[doc_id] = "updated"
+        await log_document_actions(
+            spec["log_type"], "STATUS_CHANGED", current_user["user_id"],
+            [(doc_id, {"from": docs[doc_id].get(status_field), "to": request.to_status}) for doc_id in updated]
+        )
+    
+    return {
+        "doc_type": request.doc_type,
+        "to_status": request.to_status,
+        "updated": sum(1 for outcome in outcomes.values() if outcome == "updated"),
+        "results": [{"id": doc_id, "outcome": outcome} for doc_id, outcome in outcomes.items()]
+    }
+
+class BulkIdsRequest(BaseModel):
+    ids: List[str]
+
+def bulk_request_ids(request: BulkIdsRequest) -> List[str]:
+    ids = list(dict.fromkeys(request.ids))
+    if not ids:
+        raise HTTPException(status_code=400, detail="Provide at least one id")
+    if len(ids) > BULK_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_IDS} ids per request")
+    return ids
+
+async def count_item_references(item_ids: List[str]) -> Dict[str, int]:
+    """How many quotations, PIs and SOAs use each item, archived ones included, in one aggregation; unused items are omitted."""
+    per_document = [
+        {"$match": {"items.item_id": {"$in": item_ids}}},
+        # Each document counts once however many of its lines use the item
+        {"$project": {"_id": 0, "item_id": {"$setIntersection": ["$items.item_id", {"$literal": item_ids}]}}}
+    ]
+    pipeline = [
+        *per_document,
+        *[
+            {"$unionWith": {"coll": coll, "pipeline": per_document}}
+            for coll in ("proforma_invoices", "soa", "quotations_archive", "proforma_invoices_archive", "soa_archive")
+        ],
+        {"$unwind": "$item_id"},
+        {"$group": {"_id": "$item_id", "documents": {"$sum": 1}}}
+    ]
+    return {row["_id"]: row["documents"] async for row in db.quotations.aggregate(pipeline)}
+
+@api_router.post("/items/bulk-delete")
+async def bulk_delete_items(request: BulkIdsRequest, current_user: dict = Depends(get_current_user)):
+    """Delete many items at once; items used on any document are refused."""
+    ids = bulk_request_ids(request)
+    in_use = await count_item_references(ids)
+    deletable = [item_id for item_id in ids if item_id not in in_use]
+    existing = {
+        item["item_id"]
+        async for item in db.items.find({"item_id": {"$in": deletable}}, {"_id": 0, "item_id": 1})
+    }
+    if existing:
+        await db.items.delete_many({"item_id": {"$in": list(existing)}})
+        await invalidate_item_facets()
+    
+    results = []
+    for item_id in ids:
+        if item_id in in_use:
+            results.append({"id": item_id, "outcome": "in_use", "documents": in_use[item_id]})
         else:
-            hsn_groups[hsn]['igst'] += item['tax_amount']
-    
-    tax_rows_html = ""
-    total_sgst = 0
-    total_cgst = 0
-    total_igst = 0
-    
-    for hsn, values in hsn_groups.items():
-        if values['tax_type'] == 'CGST+SGST':
-            sgst_rate = (values['sgst'] / values['taxable'] * 100) if values['taxable'] > 0 else 9.0
-            cgst_rate = (values['cgst'] / values['taxable'] * 100) if values['taxable'] > 0 else 9.0
-            tax_rows_html += f"""
-            <tr>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{hsn}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">₹{values['taxable']:,.2f}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: left; font-size: 10px;">({sgst_rate:.1f}%) ₹{values['sgst']:,.2f}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: left; font-size: 10px;">({cgst_rate:.1f}%) ₹{values['cgst']:,.2f}</td>
-            </tr>
-            """
-            total_sgst += values['sgst']
-            total_cgst += values['cgst']
+            results.append({"id": item_id, "outcome": "deleted" if item_id in existing else "not_found"})
+    return {"deleted": len(existing), "results": results}
+
+@api_router.post("/parties/bulk-deactivate")
+async def bulk_deactivate_parties(request: BulkIdsRequest, current_user: dict = Depends(get_current_user)):
+    """Bulk form of DELETE /parties/{id}, which marks parties Inactive."""
+    ids = bulk_request_ids(request)
+    statuses = {
+        party["party_id"]: party.get("status")
+        async for party in db.parties.find({"party_id": {"$in": ids}}, {"_id": 0, "party_id": 1, "status": 1})
+    }
+    active = [party_id for party_id in ids if party_id in statuses and statuses[party_id] != "Inactive"]
+    if active:
+        await db.parties.update_many({"party_id": {"$in": active}}, {"$set": {"status": "Inactive"}, "$inc": {"version": 1}})
+        await log_document_actions("PARTY", "DELETED", current_user["user_id"], [(party_id, None) for party_id in active])
+    
+    results = []
+    for party_id in ids:
+        if party_id not in statuses:
+            outcome = "not_found"
         else:
-            igst_rate = (values['igst'] / values['taxable'] * 100) if values['taxable'] > 0 else 18.0
-            tax_rows_html += f"""
-            <tr>
-                <td style="border: 1px solid #ddd; padding: 8px; font-size: 10px;">{hsn}</td>
-                <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-size: 10px;">₹{values['taxable']:,.2f}</td>
-                <td colspan="2" style="border: 1px solid #ddd; padding: 8px; text-align: left; font-size: 10px;">IGST ({igst_rate:.1f}%) ₹{values['igst']:,.2f}</td>
-            </tr>
-            """
-            total_igst += values['igst']
-    
-    confirmation_row = ""
-    if is_soa and party_confirmation_id:
-        confirmation_row = f"<p style='margin: 10px 0;'><strong>Party Confirmation ID:</strong> {party_confirmation_id}</p>"
-    
-    # Dynamic Terms & Conditions with defaults
-    delivery_display = delivery_terms if delivery_terms else "At Earliest"
-    payment_display = payment_terms if payment_terms else "100% Advance along with Techno commercially Signed and Stamped PO"
-    remarks_line = f"<strong>REMARKS :</strong> {remarks}<br>" if remarks else ""
-    
-    terms_and_conditions_html = f"""
-    <div style="margin-top: 20px; padding: 15px; border: 1px solid #ccc; background: #f9f9f9; font-size: 9px; line-height: 1.6;">
-        <div style="font-weight: bold; font-size: 11px; margin-bottom: 10px; border-bottom: 1px solid #999; padding-bottom: 5px;">TERMS & CONDITIONS :</div>
-        <strong>PRICES :</strong> Net, EX-Our Nagaon (Shiroli - P) Godown, inclusive of final discounts.<br>
-        <strong>GST :</strong> Extra at actuals, <strong>INSURANCE :</strong> To be arranged by you. <strong>FREIGHT :</strong> Tempo charges extra at actuals.<br>
-        <strong>PACKING & FORWARDING :</strong> NIL in standard conditions.<br>
-        <strong>INSPECTION :</strong> At our Shiroli Facility, Kolhapur.<br>
-        <strong>DELIVERY :</strong> {delivery_display}<br>
-        <strong>PAYMENTS :</strong> {payment_display}<br>
-        <strong>JURISDICTION :</strong> All transactions arising out of this quotation shall be subject to Kolhapur Courts jurisdiction only.<br>
-        <strong>VALIDITY :</strong> Our offer is valid up to 15 days subject to manufacturer's price revision.<br>
-        {remarks_line}
-        <div style="margin-top: 10px; padding-top: 10px; border-top: 1px dashed #999;">
-            <strong>OUR BANK DETAILS :</strong><br>
-            HDFC Bank Ltd<br>
-            Account No. 50200012223900<br>
-            IFSC HDFC0001274
-        </div>
-    </div>
-    """
-    
-    # Footer for all documents - left aligned, single line format
-    footer_html = """
-    <div style="margin-top: 30px; padding-top: 15px; border-top: 1px solid #999; font-size: 9px; text-align: left;">
-        <p style="margin: 0 0 5px 0;">Thank you for your opportunity! We now look forward to your continued support in our mutual interest.</p>
-        <p style="margin: 0 0 5px 0;"><strong>Regards,</strong></p>
-        <p style="margin: 0 0 8px 0;"><strong>Mahesh Engineering Services</strong></p>
-        <p style="margin: 0; color: #333;">| Our Back Office Contact Details | Email : d@maheshengg.com | Assistance : 9049990950 | Help Desk : 9049990949 | Computer Generated Document, hence unsigned.</p>
-    </div>
-    """
-    
-    # Load letterhead image
-    letterhead_base64 = ""
-    try:
-        import base64
-        letterhead_path = Path(__file__).parent / 'letterhead.png'
-        if letterhead_path.exists():
-            with open(letterhead_path, 'rb') as f:
-                letterhead_base64 = base64.b64encode(f.read()).decode('utf-8')
-    except Exception as e:
-        logger.error(f"Failed to load letterhead: {e}")
+            outcome = "deactivated" if party_id in active else "already_inactive"
+        results.append({"id": party_id, "outcome": outcome})
+    return {"deactivated": len(active), "results": results}
+
+async def bulk_lock_documents(doc_kind: str, request: BulkIdsRequest, current_user: dict) -> dict:
+    """Lock many documents with one update_many and queue their PDF pre-renders."""
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    ids = bulk_request_ids(request)
+    collection = db[spec["collection"]]
+    locked_before = {
+        doc[spec["id_field"]]: bool(doc.get("is_locked"))
+        async for doc in collection.find({spec["id_field"]: {"$in": ids}}, {"_id": 0, spec["id_field"]: 1, "is_locked": 1})
+    }
+    eligible = [doc_id for doc_id in ids if locked_before.get(doc_id) is False]
+    
+    locked = []
+    if eligible:
+        # Identifies this request's writes if some documents were locked elsewhere meanwhile
+        batch_id = uuid.uuid4().hex
+        result = await collection.update_many(
+            {spec["id_field"]: {"$in": eligible}, "is_locked": {"$ne": True}},
+            {"$set": {**document_lock_fields(), "lock_batch_id": batch_id}, "$unset": {"pdf_error": ""}, "$inc": {"version": 1}}
+        )
+        locked = eligible
+        if result.modified_count != len(eligible):
+            # Locked by someone else between the read and the write
+            mine = {
+                doc[spec["id_field"]]
+                async for doc in collection.find({spec["id_field"]: {"$in": eligible}, "lock_batch_id": batch_id}, {"_id": 0, spec["id_field"]: 1})
+            }
+            locked = [doc_id for doc_id in eligible if doc_id in mine]
+        for doc_id in locked:
+            schedule_pdf_prerender(doc_kind, doc_id)
+        await log_document_actions(spec["log_type"], "LOCKED", current_user["user_id"], [(doc_id, None) for doc_id in locked])
     
-    return f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <style>
-            @page {{ size: A4; margin: 0.5cm 1cm; }}
-            body {{ font-family: Arial, sans-serif; font-size: 10px; margin: 0; padding: 0; }}
-            .header {{ margin-bottom: 10px; }}
-            .header img {{ width: 100%; height: auto; max-height: 120px; object-fit: contain; }}
-            .company-name {{ font-size: 16px; font-weight: bold; color: #000; margin-bottom: 5px; }}
-            .company-details {{ font-size: 9px; color: #333; line-height: 1.4; }}
-            .doc-title {{ font-size: 14px; font-weight: bold; color: #000; margin: 15px 0 10px; text-align: center; background: #f0f0f0; padding: 8px; }}
-            .info-section {{ margin: 10px 0; font-size: 10px; }}
-            table {{ width: 100%; border-collapse: collapse; margin: 10px 0; }}
-            th {{ background-color: #d0d0d0; color: #000; padding: 6px; border: 1px solid #999; text-align: left; font-size: 10px; font-weight: bold; }}
-            td {{ padding: 6px; border: 1px solid #ddd; font-size: 10px; }}
-            .items-table {{ margin-bottom: 15px; }}
-            .below-items-section {{ display: flex; justify-content: space-between; margin-bottom: 20px; }}
-            .terms-box {{ width: 55%; padding-right: 20px; }}
-            .summary-box {{ width: 40%; border: 1px solid #999; padding: 10px; background: #f9f9f9; }}
-            .summary-row {{ display: flex; justify-content: space-between; padding: 4px 0; font-size: 10px; }}
-            .summary-row.total {{ font-weight: bold; border-top: 2px solid #333; padding-top: 8px; margin-top: 8px; font-size: 11px; }}
-            .tax-section {{ margin-top: 20px; clear: both; }}
-            .tax-table-title {{ font-weight: bold; margin-bottom: 10px; font-size: 11px; }}
-            .clear {{ clear: both; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            {f'<img src="data:image/png;base64,{letterhead_base64}" alt="Letterhead" />' if letterhead_base64 else '''
-            <div style="text-align: center; border-bottom: 2px solid #333; padding-bottom: 10px;">
-                <div class="company-name">SUNSTORE KOLHAPUR</div>
-                <div class="company-details">
-                    Plot No. 1497, Shamrao Kapadi Complex, Opposite HDFC Bank, Konda Lane, Laxmipuri,<br>
-                    Kolhapur - 416002, Maharashtra, India<br>
-                    Phone: 0231 - 2644990 / 91 / 92 | Email: sales@sunstorekolhapur.com<br>
-                    <strong>GST ID: 27ABAFM4283A1ZL</strong>
-                </div>
-            </div>
-            '''}
-        </div>
-        
-        <div class="doc-title">{doc_type}</div>
-        
-        <div class="info-section">
-            <strong>{doc_type} No:</strong> {doc_no} &nbsp;&nbsp;&nbsp; <strong>Date:</strong> {doc_date[:10]}
-            {f'<br><strong>Party Confirmation ID:</strong> {party_confirmation_id}' if is_soa and party_confirmation_id else ''}
-        </div>
-        
-        <div class="info-section">
-            <strong>To:</strong><br>
-            <strong>{party['party_name']}</strong><br>
-            {party['address']}<br>
-            {party['city']}, {party['state']} - {party['pincode']}<br>
-            <strong>GST:</strong> {party['GST_number']}<br>
-            <strong>Contact:</strong> {party['contact_person']} | {party['mobile']}
-        </div>
-        
-        <!-- Intro Paragraph -->
-        <div style="margin: 15px 0; padding: 10px; font-size: 11px; line-height: 1.5;">
-            {intro_paragraph}
-        </div>
-        
-        <table class="items-table">
-            <thead>
-                <tr>
-                    {f'''<th style="width: 4%;">Sr</th>
-                    <th style="width: 10%;">Item</th>
-                    <th style="width: 10%;">HSN/SAC</th>
-                    <th style="width: 26%;">Description</th>
-                    <th style="width: 10%; text-align: right;">Quantity</th>
-                    <th style="width: 10%; text-align: right;">List Price</th>
-                    <th style="width: 8%; text-align: right;">Disc%</th>
-                    <th style="width: 10%; text-align: right;">Rate</th>
-                    <th style="width: 12%; text-align: right;">Amount</th>''' if has_discount else '''<th style="width: 5%;">Sr</th>
-                    <th style="width: 15%;">Item</th>
-                    <th style="width: 12%;">HSN/SAC</th>
-                    <th style="width: 33%;">Description</th>
-                    <th style="width: 12%; text-align: right;">Quantity</th>
-                    <th style="width: 11%; text-align: right;">Rate</th>
-                    <th style="width: 12%; text-align: right;">Amount</th>'''}
-                </tr>
-            </thead>
-            <tbody>
-                {items_html}
-            </tbody>
-        </table>
-        
-        <!-- Totals Summary Box -->
-        <div style="display: flex; justify-content: flex-end; margin: 15px 0;">
-            <div class="summary-box" style="width: 40%; border: 1px solid #999; padding: 10px; background: #f9f9f9;">
-                <div class="summary-row" style="display: flex; justify-content: space-between; padding: 4px 0; font-size: 10px;">
-                    <span>Net Total</span>
-                    <span>₹{subtotal:,.2f}</span>
-                </div>
-                {f'<div class="summary-row" style="display: flex; justify-content: space-between; padding: 4px 0; font-size: 10px;"><span>SGST</span><span>₹{total_sgst:,.2f}</span></div>' if total_sgst > 0 else ''}
-                {f'<div class="summary-row" style="display: flex; justify-content: space-between; padding: 4px 0; font-size: 10px;"><span>CGST</span><span>₹{total_cgst:,.2f}</span></div>' if total_cgst > 0 else ''}
-                {f'<div class="summary-row" style="display: flex; justify-content: space-between; padding: 4px 0; font-size: 10px;"><span>IGST</span><span>₹{total_igst:,.2f}</span></div>' if total_igst > 0 else ''}
-                <div class="summary-row total" style="display: flex; justify-content: space-between; font-weight: bold; border-top: 2px solid #333; padding-top: 8px; margin-top: 8px; font-size: 11px;">
-                    <span>Grand Total</span>
-                    <span>₹{grand_total:,.2f}</span>
-                </div>
-            </div>
-        </div>
-        
-        <!-- Tax Table Below -->
-        <div class="tax-section" style="margin-top: 15px;">
-            <div class="tax-table-title" style="font-weight: bold; margin-bottom: 10px; font-size: 11px;">ITEM TAX TABLE</div>
-            
-            <table style="width: 70%;">
-                <thead>
-                    <tr>
-                        <th style="width: 25%;">HSN/SAC</th>
-                        <th style="width: 30%; text-align: right;">Taxable Amount</th>
-                        <th style="width: 22%; text-align: right;">SGST</th>
-                        <th style="width: 23%; text-align: right;">CGST</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {tax_rows_html}
-                </tbody>
-            </table>
-        </div>
-        
-        <!-- Terms & Conditions -->
-        {terms_and_conditions_html}
-        
-        <!-- Footer -->
-        {footer_html}
-    </body>
-    </html>
-    """
+    outcomes = {doc_id: "already_locked" for doc_id in ids if doc_id in locked_before}
+    outcomes.update({doc_id: "locked" for doc_id in locked})
+    return {
+        "locked": len(locked),
+        "results": [{"id": doc_id, "outcome": outcomes.get(doc_id, "not_found")} for doc_id in ids]
+    }
+
+@api_router.post("/quotations/bulk-lock")
+async def bulk_lock_quotations(request: BulkIdsRequest, current_user: dict = Depends(get_current_user)):
+    return await bulk_lock_documents("quotation", request, current_user)
+
+@api_router.post("/proforma-invoices/bulk-lock")
+async def bulk_lock_proforma_invoices(request: BulkIdsRequest, current_user: dict = Depends(get_current_user)):
+    return await bulk_lock_documents("proforma_invoice", request, current_user)
+
+@api_router.post("/soa/bulk-lock")
+async def bulk_lock_soas(request: BulkIdsRequest, current_user: dict = Depends(get_current_user)):
+    return await bulk_lock_documents("soa", request, current_user)
+
+# ==================== ARCHIVE ====================
+
+# Closed documents older than this many financial years move to *_archive collections
+ARCHIVE_AFTER_FINANCIAL_YEARS = int(os.environ.get("ARCHIVE_AFTER_FINANCIAL_YEARS", "2"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+# How often one worker starts the archive job on its own; 0 leaves it to POST /archive/run
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get("ARCHIVE_INTERVAL_HOURS", "24"))
+
+class ArchiveRequest(BaseModel):
+    financial_years: Optional[int] = None  # Defaults to ARCHIVE_AFTER_FINANCIAL_YEARS
+
+def financial_year_start(years_back: int = 0) -> str:
+    """Start date (1 April) of the financial year `years_back` years before the current one."""
+    today = datetime.now(timezone.utc)
+    start_year = today.year if today.month >= 4 else today.year - 1
+    return datetime(start_year - years_back, 4, 1, tzinfo=timezone.utc).date().isoformat()
+
+def archive_query(doc_kind: str, cutoff: str) -> dict:
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    return {spec["status_field"]: {"$in": spec["archive_statuses"]}, "date": {"$lt": cutoff}}
+
+async def archive_batch(doc_kind: str, cutoff: str) -> int:
+    """Move up to ARCHIVE_BATCH_SIZE closed documents to cold storage; returns how many moved."""
+    spec = PDF_DOCUMENT_TYPES[doc_kind]
+    hot, cold = db[spec["collection"]], db[spec["archive_collection"]]
+    docs = await hot.find(archive_query(doc_kind, cutoff), {"_id": 0}).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+    if not docs:
+        return 0
+    
+    archived_at = datetime.now(timezone.utc).isoformat()
+    # Upserts, so a batch interrupted before the delete is simply copied again
+    await cold.bulk_write([
+        ReplaceOne({spec["id_field"]: doc[spec["id_field"]]}, {**doc, "archived_at": archived_at}, upsert=True)
+        for doc in docs
+    ], ordered=False)
+    # Only remove the hot copy if nobody edited it while it was being copied
+    await hot.bulk_write([
+        DeleteOne({spec["id_field"]: doc[spec["id_field"]], **version_guard(doc.get("version", 0))})
+        for doc in docs
+    ], ordered=False)
+    
+    ids = [doc[spec["id_field"]] for doc in docs]
+    still_hot = [
+        doc[spec["id_field"]]
+        async for doc in hot.find({spec["id_field"]: {"$in": ids}}, {"_id": 0, spec["id_field"]: 1})
+    ]
+    if still_hot:
+        await cold.delete_many({spec["id_field"]: {"$in": still_hot}})
+    return len(ids) - len(still_hot)
+
+async def run_archive_job(job_id: str, params: dict, user_id: str) -> dict:
+    cutoff = params["cutoff"]
+    totals = {
+        doc_kind: await db[spec["collection"]].count_documents(archive_query(doc_kind, cutoff))
+        for doc_kind, spec in PDF_DOCUMENT_TYPES.items()
+    }
+    total = sum(totals.values())
+    done = 0
+    archived = {}
+    await update_job_progress(job_id, done, total)
+    for doc_kind in PDF_DOCUMENT_TYPES:
+        archived[doc_kind] = 0
+        # Bounded by the initial count so edits racing the job cannot loop it forever
+        while archived[doc_kind] < totals[doc_kind]:
+            moved = await archive_batch(doc_kind, cutoff)
+            if moved == 0:
+                break
+            archived[doc_kind] += moved
+            done += moved
+            await update_job_progress(job_id, done, total)
+    
+    logger.info(f"Archive job {job_id}: moved {archived} (dated before {cutoff})")
+    return {"cutoff": cutoff, "archived": archived}
+
+@api_router.post("/archive/run", status_code=202)
+async def start_archive(request: ArchiveRequest, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "Admin":
+        raise HTTPException(status_code=403, detail="Only Admin can archive documents")
+    years = ARCHIVE_AFTER_FINANCIAL_YEARS if request.financial_years is None else request.financial_years
+    if years < 1:
+        raise HTTPException(status_code=400, detail="financial_years must be at least 1")
+    
+    cutoff = financial_year_start(years - 1)
+    job = await start_background_job("archive", {"cutoff": cutoff}, current_user["user_id"], run_archive_job)
+    return {"job_id": job["job_id"], "status": job["status"], "cutoff": cutoff}
+
+async def run_scheduled_archive():
+    interval = ARCHIVE_INTERVAL_HOURS * 3600
+    while True:
+        try:
+            # Every worker checks in; the lease lets one of them start a job per interval
+            if await claim_lease("archive", interval):
+                cutoff = financial_year_start(max(ARCHIVE_AFTER_FINANCIAL_YEARS, 1) - 1)
+                await start_background_job("archive", {"cutoff": cutoff}, "system", run_archive_job)
+        except Exception as e:
+            logger.error(f"Scheduled archive failed to start: {e}")
+        await asyncio.sleep(min(interval, 3600))
 
 # ==================== SETTINGS ====================
 
@@ -2068,7 +4412,8 @@ async def get_settings(current_user: dict = Depends(get_current_user)):
             "soa_prefix": "SOA",
             "payment_terms": "",
             "delivery_terms": "",
-            "terms_and_conditions": ""
+            "terms_and_conditions": "",
+            "branch_letterheads": {}
         }
         await db.settings.insert_one(settings)
     return settings
@@ -2086,6 +4431,7 @@ async def update_settings(settings_data: SettingsBase, current_user: dict = Depe
         {"$set": settings_dict},
         upsert=True
     )
+    _branch_letterheads.update({"mapping": settings_dict["branch_letterheads"], "loaded_at": time.monotonic()})
     
     return settings_dict
 
@@ -2097,6 +4443,7 @@ async def get_dashboard_stats(
     period: Optional[str] = "weekly",
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
+    include_archived: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     # Calculate date range based on period
@@ -2158,23 +4505,23 @@ async def get_dashboard_stats(
     }
     
     quotations_by_status = {
-        "total": await db.quotations.count_documents(quotation_filter),
-        "successful": await db.quotations.count_documents({**quotation_filter, "quotation_status": "Successful"}),
-        "lost": await db.quotations.count_documents({**quotation_filter, "quotation_status": "Lost"}),
-        "in_process": await db.quotations.count_documents({**quotation_filter, "quotation_status": "In Process"}),
-        "pending": await db.quotations.count_documents({**quotation_filter, "quotation_status": None})
+        "total": await count_documents_of("quotation", quotation_filter, include_archived),
+        "successful": await count_documents_of("quotation", {**quotation_filter, "quotation_status": "Successful"}, include_archived),
+        "lost": await count_documents_of("quotation", {**quotation_filter, "quotation_status": "Lost"}, include_archived),
+        "in_process": await count_documents_of("quotation", {**quotation_filter, "quotation_status": "In Process"}, include_archived),
+        "pending": await count_documents_of("quotation", {**quotation_filter, "quotation_status": None}, include_archived)
     }
     
     pi_by_status = {
-        "total": await db.proforma_invoices.count_documents(pi_filter),
-        "pi_submitted": await db.proforma_invoices.count_documents({**pi_filter, "pi_status": "PI Submitted"}),
-        "payment_recd": await db.proforma_invoices.count_documents({**pi_filter, "pi_status": "Payment Recd"})
+        "total": await count_documents_of("proforma_invoice", pi_filter, include_archived),
+        "pi_submitted": await count_documents_of("proforma_invoice", {**pi_filter, "pi_status": "PI Submitted"}, include_archived),
+        "payment_recd": await count_documents_of("proforma_invoice", {**pi_filter, "pi_status": "Payment Recd"}, include_archived)
     }
     
     soa_by_status = {
-        "total": await db.soa.count_documents(soa_filter),
-        "in_process": await db.soa.count_documents({**soa_filter, "soa_status": "In Process"}),
-        "material_given": await db.soa.count_documents({**soa_filter, "soa_status": "Material Given"})
+        "total": await count_documents_of("soa", soa_filter, include_archived),
+        "in_process": await count_documents_of("soa", {**soa_filter, "soa_status": "In Process"}, include_archived),
+        "material_given": await count_documents_of("soa", {**soa_filter, "soa_status": "Material Given"}, include_archived)
     }
     
     stats = {
@@ -2236,9 +4583,120 @@ async def get_recent_activity(
     activity = await db.document_logs.find(query_filter, {"_id": 0}).sort("timestamp", -1).limit(20).to_list(20)
     return activity
 
+# ==================== BACKGROUND JOBS ====================
+
+# Strong references so running tasks are not garbage collected mid-flight
+_background_tasks = set()
+
+def spawn_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def claim_lease(name: str, seconds: float) -> bool:
+    """Take the named lease for `seconds` unless another worker holds an unexpired one."""
+    now = datetime.now(timezone.utc)
+    try:
+        # A held lease fails the filter, so the upsert collides with its _id
+        await db.leases.update_one(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {"expires_at": now + timedelta(seconds=seconds), "claimed_at": now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+# Running jobs touch heartbeat_at; one that stops (its worker died or restarted) is marked failed
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_STALE_SECONDS = float(os.environ.get("JOB_STALE_SECONDS", "300"))
+
+async def _job_heartbeat(job_id: str):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            await db.jobs.update_one({"job_id": job_id}, {"$set": {"heartbeat_at": datetime.now(timezone.utc).isoformat()}})
+        except Exception as e:
+            logger.error(f"Job {job_id} heartbeat failed: {e}")
+
+async def fail_stale_jobs(query: Optional[dict] = None) -> int:
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=JOB_STALE_SECONDS)).isoformat()
+    result = await db.jobs.update_many(
+        {
+            **(query or {}),
+            "status": {"$in": ["queued", "running"]},
+            # Jobs started before heartbeats existed only have updated_at
+            "$or": [{"heartbeat_at": {"$lt": cutoff}}, {"heartbeat_at": {"$exists": False}, "updated_at": {"$lt": cutoff}}]
+        },
+        {"$set": {
+            "status": "failed",
+            "error": "Interrupted by a server restart, please run it again",
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+    return result.modified_count
+
+async def update_job_progress(job_id: str, done: int, total: int):
+    await db.jobs.update_one(
+        {"job_id": job_id},
+        {"$set": {"progress": {"done": done, "total": total}, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def _run_background_job(job_id: str, params: dict, user_id: str, runner):
+    now = datetime.now(timezone.utc).isoformat()
+    await db.jobs.update_one(
+        {"job_id": job_id},
+        {"$set": {"status": "running", "updated_at": now, "heartbeat_at": now}}
+    )
+    heartbeat = spawn_background_task(_job_heartbeat(job_id))
+    try:
+        result = await runner(job_id, params, user_id)
+        update = {"status": "completed", "result": result}
+    except Exception as e:
+        logger.exception(f"Background job {job_id} failed")
+        update = {"status": "failed", "error": str(e.detail) if isinstance(e, HTTPException) else str(e)}
+    finally:
+        heartbeat.cancel()
+    update["updated_at"] = datetime.now(timezone.utc).isoformat()
+    await db.jobs.update_one({"job_id": job_id}, {"$set": update})
+
+async def start_background_job(job_type: str, params: dict, user_id: str, runner) -> dict:
+    """Record a job and run `runner(job_id, params, user_id)` after the request returns."""
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "job_id": f"JOB{uuid.uuid4().hex[:12].upper()}",
+        "job_type": job_type,
+        "status": "queued",
+        "params": params,
+        "progress": {"done": 0, "total": 0},
+        "result": None,
+        "error": None,
+        "created_by": user_id,
+        "created_at": now,
+        "updated_at": now,
+        "heartbeat_at": now
+    }
+    await db.jobs.insert_one(job)
+    job.pop("_id", None)
+    
+    spawn_background_task(_run_background_job(job["job_id"], params, user_id, runner))
+    return job
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    # Catches jobs whose worker died without a restart to sweep them
+    await fail_stale_jobs({"job_id": job_id})
+    job = await db.jobs.find_one({"job_id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if current_user["role"] != "Admin" and job["created_by"] != current_user["user_id"]:
+        raise HTTPException(status_code=403, detail="Not allowed to view this job")
+    return job
+
 # ==================== DOCUMENT LOG ====================
 
-async def log_document_action(doc_type: str, doc_id: str, action: str, user_id: str):
+async def log_document_action(doc_type: str, doc_id: str, action: str, user_id: str, details: Optional[dict] = None):
     log_count = await db.document_logs.count_documents({})
     log_id = f"LOG{str(log_count + 1).zfill(6)}"
     
@@ -2254,9 +4712,41 @@ async def log_document_action(doc_type: str, doc_id: str, action: str, user_id:
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "version_no": version
     }
+    if details:
+        log_entry["details"] = details
     
     await db.document_logs.insert_one(log_entry)
 
+async def log_document_actions(doc_type: str, action: str, user_id: str, entries: List[Tuple[str, Optional[dict]]]):
+    """log_document_action for many documents in one insert; entries are (doc_id, details)."""
+    if not entries:
+        return
+    log_count = await db.document_logs.count_documents({})
+    versions = {
+        row["_id"]: row["count"]
+        async for row in db.document_logs.aggregate([
+            {"$match": {"document_id": {"$in": [doc_id for doc_id, _ in entries]}}},
+            {"$group": {"_id": "$document_id", "count": {"$sum": 1}}}
+        ])
+    }
+    timestamp = datetime.now(timezone.utc).isoformat()
+    log_entries = []
+    for offset, (doc_id, details) in enumerate(entries, start=1):
+        log_entry = {
+            "log_id": f"LOG{str(log_count + offset).zfill(6)}",
+            "document_type": doc_type,
+            "document_id": doc_id,
+            "action": action,
+            "updated_by": user_id,
+            "timestamp": timestamp,
+            "version_no": versions.get(doc_id, 0) + 1
+        }
+        if details:
+            log_entry["details"] = details
+        log_entries.append(log_entry)
+    
+    await db.document_logs.insert_many(log_entries)
+
 @api_router.get("/logs")
 async def get_logs(current_user: dict = Depends(get_current_user)):
     logs = await db.document_logs.find({}, {"_id": 0}).sort("timestamp", -1).to_list(1000)
@@ -2265,11 +4755,11 @@ async def get_logs(current_user: dict = Depends(get_current_user)):
 # ==================== REPORTS ====================
 
 @api_router.get("/reports/item-wise-sales")
-async def report_item_wise_sales(current_user: dict = Depends(get_current_user)):
+async def report_item_wise_sales(include_archived: bool = False, current_user: dict = Depends(get_current_user)):
     # Aggregate all items from quotations, PIs, and SOAs
     item_sales = {}
     
-    for collection_name in ["quotations", "proforma_invoices", "soa"]:
+    for collection_name in document_collection_names(include_archived):
         collection = db[collection_name]
         docs = await collection.find({}, {"_id": 0, "items": 1}).to_list(1000)
         for doc in docs:
@@ -2282,40 +4772,42 @@ async def report_item_wise_sales(current_user: dict = Depends(get_current_user))
     
     return list(item_sales.values())
 
+async def sum_document_totals(group_field: str, include_archived: bool = False) -> List[Tuple[Any, float, int]]:
+    """(group value, sum of grand totals, document count) per collection, from the stored totals."""
+    rows = []
+    collection_names = document_collection_names(include_archived)
+    await ensure_document_totals(collection_names)
+    for collection_name in collection_names:
+        async for row in db[collection_name].aggregate([
+            {"$group": {"_id": f"${group_field}", "amount": {"$sum": "$totals.grand_total"}, "doc_count": {"$sum": 1}}}
+        ]):
+            rows.append((row["_id"], row["amount"], row["doc_count"]))
+    return rows
+
 @api_router.get("/reports/party-wise-sales")
-async def report_party_wise_sales(current_user: dict = Depends(get_current_user)):
+async def report_party_wise_sales(include_archived: bool = False, current_user: dict = Depends(get_current_user)):
     party_sales = {}
     
-    for collection_name in ["quotations", "proforma_invoices", "soa"]:
-        collection = db[collection_name]
-        docs = await collection.find({}, {"_id": 0, "party_id": 1, "items": 1}).to_list(1000)
-        for doc in docs:
-            party_id = doc["party_id"]
-            if party_id not in party_sales:
-                party_sales[party_id] = {"party_id": party_id, "amount": 0, "doc_count": 0}
-            doc_total = sum(item["total_amount"] for item in doc.get("items", []))
-            party_sales[party_id]["amount"] += doc_total
-            party_sales[party_id]["doc_count"] += 1
+    for party_id, amount, doc_count in await sum_document_totals("party_id", include_archived):
+        if party_id not in party_sales:
+            party_sales[party_id] = {"party_id": party_id, "amount": 0, "doc_count": 0}
+        party_sales[party_id]["amount"] += amount
+        party_sales[party_id]["doc_count"] += doc_count
     
     return list(party_sales.values())
 
 @api_router.get("/reports/user-wise-sales")
-async def report_user_wise_sales(current_user: dict = Depends(get_current_user)):
+async def report_user_wise_sales(include_archived: bool = False, current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "Admin":
         raise HTTPException(status_code=403, detail="Only Admin can view this report")
     
     user_sales = {}
     
-    for collection_name in ["quotations", "proforma_invoices", "soa"]:
-        collection = db[collection_name]
-        docs = await collection.find({}, {"_id": 0, "created_by_user_id": 1, "items": 1}).to_list(1000)
-        for doc in docs:
-            user_id = doc["created_by_user_id"]
-            if user_id not in user_sales:
-                user_sales[user_id] = {"user_id": user_id, "amount": 0, "doc_count": 0}
-            doc_total = sum(item["total_amount"] for item in doc.get("items", []))
-            user_sales[user_id]["amount"] += doc_total
-            user_sales[user_id]["doc_count"] += 1
+    for user_id, amount, doc_count in await sum_document_totals("created_by_user_id", include_archived):
+        if user_id not in user_sales:
+            user_sales[user_id] = {"user_id": user_id, "amount": 0, "doc_count": 0}
+        user_sales[user_id]["amount"] += amount
+        user_sales[user_id]["doc_count"] += doc_count
     
     return list(user_sales.values())
 
@@ -2369,22 +4861,25 @@ async def report_quotation_aging(current_user: dict = Depends(get_current_user))
     return aging_data
 
 @api_router.get("/reports/gst-summary")
-async def report_gst_summary(current_user: dict = Depends(get_current_user)):
+async def report_gst_summary(include_archived: bool = False, current_user: dict = Depends(get_current_user)):
     cgst_total = 0
     sgst_total = 0
     igst_total = 0
     
-    for collection_name in ["quotations", "proforma_invoices", "soa"]:
-        collection = db[collection_name]
-        docs = await collection.find({}, {"_id": 0, "items": 1}).to_list(1000)
-        for doc in docs:
-            for item in doc.get("items", []):
-                tax_amount = item["tax_amount"]
-                if item["tax_type"] == "CGST+SGST":
-                    cgst_total += tax_amount / 2
-                    sgst_total += tax_amount / 2
-                else:
-                    igst_total += tax_amount
+    collection_names = document_collection_names(include_archived)
+    await ensure_document_totals(collection_names)
+    for collection_name in collection_names:
+        async for row in db[collection_name].aggregate([
+            {"$group": {
+                "_id": None,
+                "cgst": {"$sum": "$totals.cgst"},
+                "sgst": {"$sum": "$totals.sgst"},
+                "igst": {"$sum": "$totals.igst"}
+            }}
+        ]):
+            cgst_total += row["cgst"]
+            sgst_total += row["sgst"]
+            igst_total += row["igst"]
     
     return {
         "CGST": round(cgst_total, 2),
@@ -2393,6 +4888,47 @@ async def report_gst_summary(current_user: dict = Depends(get_current_user)):
         "total_tax": round(cgst_total + sgst_total + igst_total, 2)
     }
 
+# ==================== DIAGNOSTICS ====================
+
+@api_router.get("/debug/loop-blocking")
+async def get_loop_blocking_report(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "Admin":
+        raise HTTPException(status_code=403, detail="Only Admin can view diagnostics")
+    return {
+        "enabled": LOOP_WATCHDOG_ENABLED,
+        "threshold_ms": LOOP_WATCHDOG_THRESHOLD_MS,
+        "offenders": loop_watchdog.report()
+    }
+
+@api_router.get("/email-outbox")
+async def get_email_outbox(status: Optional[str] = None, limit: int = 100, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "Admin":
+        raise HTTPException(status_code=403, detail="Only Admin can view the email outbox")
+    query = {"status": status} if status else {}
+    # Bodies and attachments can be large and contain reset tokens
+    messages = await db.email_outbox.find(
+        query, {"_id": 0, "html": 0, "text": 0}
+    ).sort("created_at", -1).to_list(min(limit, 1000))
+    for message in messages:
+        if isinstance(message.get("next_attempt_at"), datetime):
+            message["next_attempt_at"] = message["next_attempt_at"].isoformat()
+        message.pop("lease_expires_at", None)
+        message.pop("expires_at", None)
+    return messages
+
+@api_router.post("/email-outbox/{email_id}/retry")
+async def retry_email(email_id: str, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "Admin":
+        raise HTTPException(status_code=403, detail="Only Admin can retry emails")
+    result = await db.email_outbox.update_one(
+        {"email_id": email_id, "status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now(timezone.utc)}, "$unset": {"expires_at": ""}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead-lettered email not found")
+    _email_outbox_wakeup.set()
+    return {"message": "Email queued for retry"}
+
 # ==================== USERS (Admin only) ====================
 
 @api_router.get("/users", response_model=List[User])
@@ -2408,15 +4944,45 @@ async def update_user_status(user_id: str, status: str, current_user: dict = Dep
     if current_user["role"] != "Admin":
         raise HTTPException(status_code=403, detail="Only Admin can update user status")
     
-    result = await db.users.update_one({"user_id": user_id}, {"$set": {"status": status}})
-    if result.modified_count == 0:
+    # Bumping the generation ends existing sessions, and reactivation does not revive them
+    if not await revoke_user_tokens(user_id, status):
         raise HTTPException(status_code=404, detail="User not found")
     
     return {"message": "User status updated"}
 
+@api_router.put("/users/{user_id}", response_model=User)
+async def update_user(user_id: str, user_data: UserUpdate, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "Admin":
+        raise HTTPException(status_code=403, detail="Only Admin can update users")
+    if user_data.role is not None and user_data.role not in USER_ROLES:
+        raise HTTPException(status_code=400, detail=f"role must be one of: {', '.join(USER_ROLES)}")
+    
+    user = await db.users.find_one({"user_id": user_id}, {"_id": 0, "password_hashed": 0})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    changes = {field: value for field, value in user_data.model_dump(exclude_none=True).items() if user.get(field) != value}
+    if "name" in changes or "role" in changes:
+        # Open sessions would keep the old name and role until they expire
+        await revoke_user_tokens(user_id, changes=changes)
+    elif changes:
+        await db.users.update_one({"user_id": user_id}, {"$set": changes})
+    return {**user, **changes}
+
 # Include router
 app.include_router(api_router)
 
+if not METRICS_TOKEN:
+    logger.warning("METRICS_TOKEN is not set; /metrics is disabled")
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    # Scraped by Prometheus, not the frontend, so it takes a shared token instead of a user session
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -2425,6 +4991,107 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so CORS preflights and errors are counted too
+app.add_middleware(MetricsMiddleware)
+
+@app.on_event("startup")
+async def ensure_indexes():
+    try:
+        await db.items.create_index("item_id")
+        await db.items.create_index([("brand", 1), ("category", 1), ("UOM", 1)])
+        await db.parties.create_index("party_id")
+        await db.parties.create_index("gst_key")
+        await db.parties.create_index("name_key")
+        await db.jobs.create_index("job_id")
+        await db.party_duplicate_clusters.create_index([("job_id", 1), ("cluster_no", 1)])
+        for spec in PDF_DOCUMENT_TYPES.values():
+            # Last line of defence against a number being issued twice
+            await db[spec["collection"]].create_index(spec["id_field"], unique=True)
+            # Reference check before deleting items
+            await db[spec["collection"]].create_index("items.item_id")
+            await db[spec["collection"]].create_index([(spec["status_field"], 1), ("date", 1)])
+            await db[spec["archive_collection"]].create_index(spec["id_field"], unique=True)
+            await db[spec["archive_collection"]].create_index("items.item_id")
+            await db[spec["archive_collection"]].create_index("date")
+        await db.pdf_store.create_index([("doc_kind", 1), ("doc_id", 1)], unique=True)
+        await db.pdf_thumbnails.create_index([("doc_kind", 1), ("doc_id", 1)], unique=True)
+        await db.email_outbox.create_index("email_id", unique=True)
+        await db.email_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+        await db.email_outbox.create_index("expires_at", expireAfterSeconds=0)
+        if RATE_LIMIT_BACKEND == "mongo":
+            await db.rate_limits.create_index("key", unique=True)
+            await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+        await db.drafts.create_index("draft_id", unique=True)
+        await db.drafts.create_index([("user_id", 1), ("doc_kind", 1), ("updated_at", -1)])
+        await db.drafts.create_index("expires_at", expireAfterSeconds=0)
+        await backfill_party_match_keys()
+        # Totals are derived data; documents missing them still render, so fill in behind startup
+        spawn_background_task(backfill_document_totals())
+    except Exception as e:
+        logger.error(f"Failed to create indexes: {e}")
+
+@app.on_event("startup")
+async def fail_interrupted_jobs():
+    try:
+        failed = await fail_stale_jobs()
+        if failed:
+            logger.warning(f"Marked {failed} interrupted background jobs as failed")
+    except Exception as e:
+        logger.error(f"Failed to sweep interrupted jobs: {e}")
+
+@app.on_event("startup")
+async def prepare_document_numbering():
+    # Deliberately not caught: serving with unseeded counters would reissue QTN0001, PI0001, ...
+    await seed_document_counters()
+
+@app.on_event("startup")
+async def preload_pdf_assets():
+    # Load fonts, the stylesheet and the letterhead before the first PDF request
+    try:
+        pool = get_pdf_pool()
+        if pool is None:
+            await asyncio.to_thread(pdf_renderer.warm_up)
+        else:
+            # Concurrent pings start every worker; each warms up in its initializer
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(pool, ping_pdf_worker) for _ in range(PDF_RENDER_WORKERS)))
+    except Exception as e:
+        logger.error(f"PDF renderer warm-up failed: {e}")
+    try:
+        await resume_pdf_prerenders()
+    except Exception as e:
+        logger.error(f"Failed to resume PDF pre-renders: {e}")
+
+@app.on_event("startup")
+async def load_token_revocations():
+    try:
+        await token_revocations.reload()
+    except Exception as e:
+        logger.error(f"Failed to load token revocations: {e}")
+    spawn_background_task(refresh_token_revocations())
+
+@app.on_event("startup")
+async def start_email_outbox():
+    spawn_background_task(run_email_outbox())
+
+@app.on_event("startup")
+async def start_archive_schedule():
+    if ARCHIVE_INTERVAL_HOURS > 0:
+        spawn_background_task(run_scheduled_archive())
+
+@app.on_event("startup")
+async def start_pdf_batch_cleanup():
+    spawn_background_task(run_pdf_batch_cleanup())
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    spawn_background_task(monitor_event_loop_lag())
+    if LOOP_WATCHDOG_ENABLED:
+        loop_watchdog.start(asyncio.get_running_loop(), app.routes)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    loop_watchdog.stop()
+    password_executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_pdf_pool()
     client.close()
@@ -4,16 +4,34 @@ import { Button } from './ui/button';
 import { Input } from './ui/input';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from './ui/select';
 import { Search, X, Plus, Filter } from 'lucide-react';
+import { api } from '../utils/api';
 
 export const ItemSelectorModal = ({ open, onClose, items, onSelectItem, onQuickCreate }) => {
   const [searchQuery, setSearchQuery] = useState('');
   const [selectedBrand, setSelectedBrand] = useState('ALL');
   const [selectedCategory, setSelectedCategory] = useState('ALL');
   const [filteredItems, setFilteredItems] = useState([]);
+  const [facets, setFacets] = useState(null);
 
-  // Extract unique brands and categories
-  const brands = ['ALL', ...new Set(items.map(item => item.brand).filter(Boolean))];
-  const categories = ['ALL', ...new Set(items.map(item => item.category).filter(Boolean))];
+  // Brand and category options with counts from the server; each list ignores its own filter
+  useEffect(() => {
+    if (!open) return;
+    let cancelled = false;
+    const params = {};
+    if (selectedBrand !== 'ALL') params.brand = selectedBrand;
+    if (selectedCategory !== 'ALL') params.category = selectedCategory;
+    api.getItemFacets(params)
+      .then(response => { if (!cancelled) setFacets(response.data); })
+      .catch(() => { if (!cancelled) setFacets(null); });
+    return () => { cancelled = true; };
+  }, [open, selectedBrand, selectedCategory]);
+
+  // Fall back to the loaded items when the facet request fails
+  const facetOptions = (buckets, field) => buckets
+    ? buckets.filter(bucket => bucket.value).map(bucket => ({ value: bucket.value, label: `${bucket.value} (${bucket.count})` }))
+    : [...new Set(items.map(item => item[field]).filter(Boolean))].map(value => ({ value, label: value }));
+  const brands = [{ value: 'ALL', label: 'ALL' }, ...facetOptions(facets?.brands, 'brand')];
+  const categories = [{ value: 'ALL', label: 'ALL' }, ...facetOptions(facets?.categories, 'category')];
 
   useEffect(() => {
     if (!open) {
@@ -106,8 +124,8 @@ export const ItemSelectorModal = ({ open, onClose, items, onSelectItem, onQuickC
               </SelectTrigger>
               <SelectContent>
                 {brands.map(brand => (
-                  <SelectItem key={brand} value={brand} className="text-xs">
-                    {brand}
+                  <SelectItem key={brand.value} value={brand.value} className="text-xs">
+                    {brand.label}
                   </SelectItem>
                 ))}
               </SelectContent>
@@ -119,8 +137,8 @@ export const ItemSelectorModal = ({ open, onClose, items, onSelectItem, onQuickC
               </SelectTrigger>
               <SelectContent>
                 {categories.map(category => (
-                  <SelectItem key={category} value={category} className="text-xs">
-                    {category}
+                  <SelectItem key={category.value} value={category.value} className="text-xs">
+                    {category.label}
                   </SelectItem>
                 ))}
               </SelectContent>
@@ -0,0 +1,57 @@
+import React, { useEffect, useRef, useState } from 'react';
+import { FileText } from 'lucide-react';
+import { api } from '../utils/api';
+
+// First-page preview for grid cards. Fetched only once the card scrolls into
+// view so long lists on mobile do not request every thumbnail up front.
+export const PdfThumbnail = ({ docType, docId }) => {
+  const containerRef = useRef(null);
+  const [visible, setVisible] = useState(false);
+  const [src, setSrc] = useState(null);
+  const [failed, setFailed] = useState(false);
+
+  useEffect(() => {
+    const node = containerRef.current;
+    if (!node || !('IntersectionObserver' in window)) {
+      setVisible(true);
+      return undefined;
+    }
+    const observer = new IntersectionObserver((entries) => {
+      if (entries.some(entry => entry.isIntersecting)) {
+        setVisible(true);
+        observer.disconnect();
+      }
+    }, { rootMargin: '200px' });
+    observer.observe(node);
+    return () => observer.disconnect();
+  }, []);
+
+  useEffect(() => {
+    if (!visible) return undefined;
+    let objectUrl = null;
+    let cancelled = false;
+    api.getPDFThumbnail(docType, docId)
+      .then(response => {
+        if (cancelled) return;
+        objectUrl = URL.createObjectURL(response.data);
+        setSrc(objectUrl);
+      })
+      .catch(() => {
+        if (!cancelled) setFailed(true);
+      });
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [visible, docType, docId]);
+
+  return (
+    <div ref={containerRef} className="h-40 bg-slate-50 border rounded overflow-hidden flex items-center justify-center">
+      {src ? (
+        <img src={src} alt="Document preview" className="h-full w-full object-cover object-top" />
+      ) : (
+        <FileText size={32} className={failed ? 'text-slate-300' : 'text-slate-300 animate-pulse'} />
+      )}
+    </div>
+  );
+};
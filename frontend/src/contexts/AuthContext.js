@@ -13,11 +13,63 @@ export const useAuth = () => {
   return context;
 };
 
+// One refresh at a time: requests that fail together wait on the same renewal
+let refreshPromise = null;
+
+const refreshSession = () => {
+  if (!refreshPromise) {
+    const refreshToken = localStorage.getItem('refresh_token');
+    refreshPromise = (refreshToken
+      ? axios.post(`${API_URL}/auth/refresh`, { refresh_token: refreshToken }, { skipAuthRefresh: true })
+      : Promise.reject(new Error('No refresh token'))
+    )
+      .then(response => {
+        localStorage.setItem('token', response.data.access_token);
+        localStorage.setItem('refresh_token', response.data.refresh_token);
+        return response.data;
+      })
+      .finally(() => {
+        refreshPromise = null;
+      });
+  }
+  return refreshPromise;
+};
+
 export const AuthProvider = ({ children }) => {
   const [user, setUser] = useState(null);
   const [token, setToken] = useState(localStorage.getItem('token'));
   const [loading, setLoading] = useState(true);
 
+  useEffect(() => {
+    // Access tokens are short-lived: renew on a 401 and replay the request once
+    const interceptor = axios.interceptors.response.use(
+      response => response,
+      async error => {
+        const original = error.config;
+        if (
+          error.response?.status !== 401 ||
+          !original ||
+          original.skipAuthRefresh ||
+          original._retried ||
+          !original.headers?.Authorization
+        ) {
+          return Promise.reject(error);
+        }
+        original._retried = true;
+        try {
+          const session = await refreshSession();
+          setToken(session.access_token);
+          original.headers.Authorization = `Bearer ${session.access_token}`;
+          return axios(original);
+        } catch (refreshError) {
+          logout();
+          return Promise.reject(error);
+        }
+      }
+    );
+    return () => axios.interceptors.response.eject(interceptor);
+  }, []);
+
   useEffect(() => {
     if (token) {
       fetchCurrentUser();
@@ -42,8 +94,9 @@ export const AuthProvider = ({ children }) => {
 
   const login = async (email, password) => {
     const response = await axios.post(`${API_URL}/auth/login`, { email, password });
-    const { access_token, user: userData } = response.data;
+    const { access_token, refresh_token, user: userData } = response.data;
     localStorage.setItem('token', access_token);
+    localStorage.setItem('refresh_token', refresh_token);
     setToken(access_token);
     setUser(userData);
     return userData;
@@ -55,6 +108,7 @@ export const AuthProvider = ({ children }) => {
 
   const logout = () => {
     localStorage.removeItem('token');
+    localStorage.removeItem('refresh_token');
     setToken(null);
     setUser(null);
   };
@@ -0,0 +1,145 @@
+import { useCallback, useEffect, useRef, useState } from 'react';
+import { toast } from 'sonner';
+import { api } from '../utils/api';
+
+const AUTOSAVE_DELAY_MS = 1500;
+
+const pick = (data, fields) => {
+  const picked = {};
+  fields.forEach(field => {
+    if (data[field] !== undefined) picked[field] = data[field];
+  });
+  return picked;
+};
+
+const sameValue = (a, b) => JSON.stringify(a) === JSON.stringify(b);
+
+// Only what changed since the last save: header fields by name, edited lines
+// as items.<n>, and the whole items list once lines are added or removed.
+const diffDraft = (saved, current) => {
+  const changes = {};
+  Object.keys(current).forEach(field => {
+    if (field === 'items') return;
+    if (!sameValue(saved[field], current[field])) changes[field] = current[field];
+  });
+  const savedItems = saved.items || [];
+  const items = current.items || [];
+  if (items.length !== savedItems.length) {
+    changes.items = items;
+  } else {
+    items.forEach((item, index) => {
+      if (!sameValue(savedItems[index], item)) changes[`items.${index}`] = item;
+    });
+  }
+  return changes;
+};
+
+// Keeps a server-side draft of a quotation, PI or SOA form while the user
+// types, and offers to restore it when the form is opened again. Fields saved
+// are the keys of the form's initial state.
+export const useDraftAutosave = ({ docType, docId, formData, setFormData, enabled }) => {
+  const fieldsRef = useRef(Object.keys(formData));
+  const draftRef = useRef(null); // { draft_id, revision }
+  const savedRef = useRef(null); // Form data as the server last stored it
+  const savingRef = useRef(Promise.resolve());
+  const [ready, setReady] = useState(false);
+  const [status, setStatus] = useState('idle'); // idle, saving, saved or failed
+
+  const save = useCallback((data, extra = {}) => {
+    savingRef.current = savingRef.current.then(async () => {
+      if (!savedRef.current) return;
+      const current = { ...pick(data, fieldsRef.current), ...extra };
+      const changes = diffDraft(savedRef.current, current);
+      if (Object.keys(changes).length === 0) return;
+      setStatus('saving');
+      try {
+        if (draftRef.current) {
+          const response = await api.updateDraft(draftRef.current.draft_id, {
+            revision: draftRef.current.revision,
+            set: changes
+          });
+          draftRef.current.revision = response.data.revision;
+        } else {
+          const response = await api.createDraft({
+            doc_type: docType,
+            doc_id: docId || null,
+            base_version: docId ? data.version : null,
+            data: current
+          });
+          draftRef.current = { draft_id: response.data.draft_id, revision: response.data.revision };
+        }
+        savedRef.current = { ...savedRef.current, ...current };
+        setStatus('saved');
+      } catch (error) {
+        setStatus('failed');
+        if (error.response?.status === 409) {
+          toast.error(error.response.data.detail);
+        }
+      }
+    });
+    return savingRef.current;
+  }, [docType, docId]);
+
+  // Once the form has loaded, look for an earlier draft of it
+  useEffect(() => {
+    if (!enabled || ready) return;
+    savedRef.current = pick(formData, fieldsRef.current);
+    setReady(true);
+    api.getDrafts({ doc_type: docType, doc_id: docId || '' })
+      .then(async response => {
+        const [latest] = response.data;
+        if (!latest) return;
+        toast('You have unsaved changes from earlier', {
+          description: `Last saved ${new Date(latest.updated_at).toLocaleString()}`,
+          duration: Infinity,
+          action: {
+            label: 'Restore',
+            onClick: async () => {
+              try {
+                const draftRes = await api.getDraft(latest.draft_id);
+                draftRef.current = { draft_id: latest.draft_id, revision: draftRes.data.revision };
+                savedRef.current = { ...savedRef.current, ...draftRes.data.data };
+                setFormData(prev => ({ ...prev, ...draftRes.data.data }));
+              } catch (error) {
+                toast.error('Failed to restore draft');
+              }
+            }
+          },
+          cancel: {
+            label: 'Discard',
+            onClick: () => api.deleteDraft(latest.draft_id).catch(() => {})
+          }
+        });
+      })
+      .catch(() => {});
+  }, [enabled, ready, docType, docId]);
+
+  useEffect(() => {
+    if (!enabled || !ready) return undefined;
+    const timer = setTimeout(() => save(formData), AUTOSAVE_DELAY_MS);
+    return () => clearTimeout(timer);
+  }, [formData, enabled, ready, save]);
+
+  // Saves pending edits plus `extra` and turns the draft into the document.
+  // Resolves to null when nothing was drafted, so the caller saves normally.
+  const promote = useCallback(async (extra = {}) => {
+    await save(formData, extra);
+    if (!draftRef.current) return null;
+    const response = await api.promoteDraft(draftRef.current.draft_id);
+    draftRef.current = null;
+    savedRef.current = null;
+    return response.data;
+  }, [formData, save]);
+
+  const discard = useCallback(async () => {
+    await savingRef.current;
+    if (!draftRef.current) return;
+    const draftId = draftRef.current.draft_id;
+    draftRef.current = null;
+    await api.deleteDraft(draftId).catch(() => {});
+  }, []);
+
+  return { status, promote, discard };
+};
+
+export default useDraftAutosave;
@@ -28,7 +28,7 @@ export const ForgotPassword = () => {
         setShowResetForm(true);
       }
     } catch (error) {
-      toast.error('Failed to send reset email');
+      toast.error(error.response?.data?.detail || 'Failed to send reset email');
     } finally {
       setLoading(false);
     }
@@ -42,7 +42,7 @@ export const Items = () => {
       toast.success('Item deleted successfully');
       fetchItems();
     } catch (error) {
-      toast.error('Failed to delete item');
+      toast.error(error.response?.data?.detail || 'Failed to delete item');
     }
   };
 
@@ -55,12 +55,16 @@ export const Items = () => {
     if (!window.confirm(`Are you sure you want to delete ${selectedItems.length} items?`)) return;
     
     try {
-      await Promise.all(selectedItems.map(id => api.deleteItem(id)));
-      toast.success(`${selectedItems.length} items deleted successfully`);
-      setSelectedItems([]);
+      const response = await api.bulkDeleteItems(selectedItems);
+      const inUse = response.data.results.filter(r => r.outcome === 'in_use');
+      toast.success(`${response.data.deleted} items deleted successfully`);
+      if (inUse.length > 0) {
+        toast.error(`${inUse.length} items are used in documents and were not deleted`);
+      }
+      setSelectedItems(inUse.map(r => r.id));
       fetchItems();
     } catch (error) {
-      toast.error('Failed to delete items');
+      toast.error(error.response?.data?.detail || 'Failed to delete items');
     }
   };
 
@@ -56,7 +56,7 @@ export const LeadForm = () => {
       }
       navigate('/leads');
     } catch (error) {
-      toast.error('Failed to save lead');
+      toast.error(error.response?.data?.detail || 'Failed to save lead');
     }
   };
 
@@ -86,7 +86,7 @@ export const Leads = () => {
       toast.success('Lead deleted successfully');
       fetchLeads();
     } catch (error) {
-      toast.error('Failed to delete lead');
+      toast.error(error.response?.data?.detail || 'Failed to delete lead');
     }
   };
 
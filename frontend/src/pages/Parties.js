@@ -55,12 +55,12 @@ export const Parties = () => {
     if (!window.confirm(`Are you sure you want to delete ${selectedParties.length} parties?`)) return;
     
     try {
-      await Promise.all(selectedParties.map(id => api.deleteParty(id)));
-      toast.success(`${selectedParties.length} parties deleted successfully`);
+      const response = await api.bulkDeactivateParties(selectedParties);
+      toast.success(`${response.data.deactivated} parties deleted successfully`);
       setSelectedParties([]);
       fetchParties();
     } catch (error) {
-      toast.error('Failed to delete parties');
+      toast.error(error.response?.data?.detail || 'Failed to delete parties');
     }
   };
 
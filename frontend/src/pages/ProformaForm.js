@@ -1,6 +1,8 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate, useParams } from 'react-router-dom';
 import { api } from '../utils/api';
+import { buildDocumentPatch } from '../utils/documentPatch';
+import { useDraftAutosave } from '../hooks/useDraftAutosave';
 import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
 import { Label } from '../components/ui/label';
@@ -29,10 +31,16 @@ export const ProformaForm = () => {
   const [isConverting, setIsConverting] = useState(false);
   const [selectedParty, setSelectedParty] = useState(null);
   const [isLocked, setIsLocked] = useState(false);
+  const savedRef = useRef(null); // The document as loaded, for building a PATCH
   const [formData, setFormData] = useState({
     party_id: '', date: new Date().toISOString().split('T')[0], validity_days: 30,
     payment_terms: '', delivery_terms: '', remarks: '', pi_status: 'PI Submitted', items: []
   });
+  // Loaded documents carry a version; wait for it before snapshotting
+  const draft = useDraftAutosave({
+    docType: 'proforma_invoice', docId: id, formData, setFormData,
+    enabled: !isLocked && (!id || formData.version !== undefined)
+  });
 
   useEffect(() => {
     fetchData();
@@ -60,9 +68,10 @@ export const ProformaForm = () => {
     try {
       const response = await api.getProformaInvoice(id);
       const piData = response.data;
+      savedRef.current = { ...piData };
       
-      // Set locked state
-      setIsLocked(piData.is_locked === true);
+      // Set locked state (archived documents are read-only too)
+      setIsLocked(piData.is_locked === true || Boolean(piData.archived_at));
       
       // Enrich items with full details from items master
       const itemsRes = await api.getItems({});
@@ -107,7 +116,7 @@ export const ProformaForm = () => {
       setIsLocked(true);
       toast.success('Proforma Invoice locked successfully');
     } catch (error) {
-      toast.error('Failed to lock Proforma Invoice');
+      toast.error(error.response?.data?.detail || 'Failed to lock Proforma Invoice');
     }
   };
 
@@ -130,7 +139,7 @@ export const ProformaForm = () => {
       toast.success('Proforma Invoice deleted successfully');
       navigate('/proforma-invoices');
     } catch (error) {
-      toast.error('Failed to delete Proforma Invoice');
+      toast.error(error.response?.data?.detail || 'Failed to delete Proforma Invoice');
     }
   };
 
@@ -303,8 +312,15 @@ export const ProformaForm = () => {
         party_name_snapshot: selectedParty?.party_name || ''
       };
       
-      if (id) {
-        await api.updateProformaInvoice(id, submitData);
+      const promoted = await draft.promote({ party_name_snapshot: submitData.party_name_snapshot });
+      if (promoted) {
+        toast.success(id ? 'Proforma Invoice updated' : `Proforma Invoice ${promoted.doc_no} created`);
+      } else if (id) {
+        // Send only what changed; the version makes a concurrent edit fail with 409
+        const ops = buildDocumentPatch(savedRef.current, submitData);
+        if (ops.length > 0) {
+          await api.patchProformaInvoice(id, { version: savedRef.current.version ?? 0, ops });
+        }
         toast.success('Proforma Invoice updated');
       } else {
         await api.createProformaInvoice(submitData);
@@ -312,7 +328,7 @@ export const ProformaForm = () => {
       }
       navigate('/proforma-invoices');
     } catch (error) {
-      toast.error('Failed to save proforma invoice');
+      toast.error(error.response?.data?.detail || 'Failed to save proforma invoice');
     }
   };
 
@@ -9,8 +9,9 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '.
 import { Input } from '../components/ui/input';
 import { Badge } from '../components/ui/badge';
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '../components/ui/table';
-import { Plus, FileDown, Edit, Filter, Trash2, User, Grid, List } from 'lucide-react';
+import { Plus, FileDown, Mail, Edit, Filter, Trash2, User, Grid, List } from 'lucide-react';
 import { toast } from 'sonner';
+import { PdfThumbnail } from '../components/PdfThumbnail';
 
 export const ProformaInvoices = () => {
   const { user } = useAuth();
@@ -104,6 +105,16 @@ export const ProformaInvoices = () => {
     }
   };
 
+  const handleSendEmail = async (doc) => {
+    if (!window.confirm(`Email ${doc.pi_no} to the party as a PDF?`)) return;
+    try {
+      const response = await api.sendPI(doc.pi_id);
+      toast.success(`Queued for ${response.data.to.join(', ')}`);
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Failed to send email');
+    }
+  };
+
   const handleDelete = async (id) => {
     if (!window.confirm('Are you sure you want to delete this proforma invoice?')) return;
     
@@ -112,7 +123,7 @@ export const ProformaInvoices = () => {
       toast.success('Proforma Invoice deleted successfully');
       fetchPIs();
     } catch (error) {
-      toast.error('Failed to delete proforma invoice');
+      toast.error(error.response?.data?.detail || 'Failed to delete proforma invoice');
     }
   };
 
@@ -233,6 +244,7 @@ export const ProformaInvoices = () => {
                 </div>
               </CardHeader>
               <CardContent className="space-y-1 pt-0">
+                <PdfThumbnail docType="proforma_invoice" docId={pi.pi_id} />
                 <p className="text-xs text-muted-foreground">{partiesMap[pi.party_id] || 'Unknown Party'}</p>
                 <p className="text-xs">Date: {new Date(pi.date).toLocaleDateString()}</p>
                 <p className="text-xs">Validity: {pi.validity_days} days</p>
@@ -243,6 +255,7 @@ export const ProformaInvoices = () => {
                 <div className="flex gap-2 pt-2" onClick={(e) => e.stopPropagation()}>
                   <Button size="sm" variant="outline" onClick={() => navigate(`/proforma-invoices/${pi.pi_id}`)}>Edit</Button>
                   <Button size="sm" variant="outline" onClick={() => handleDownloadPDF(pi.pi_id, pi.pi_no)}><FileDown size={14} /></Button>
+                  <Button size="sm" variant="outline" title={pi.email_status ? `Email: ${pi.email_status}` : 'Email to party'} onClick={() => handleSendEmail(pi)}><Mail size={14} /></Button>
                   {user?.role === 'Admin' && (
                     <Button size="sm" variant="destructive" onClick={() => handleDelete(pi.pi_id)}><Trash2 size={14} /></Button>
                   )}
@@ -260,6 +273,7 @@ export const ProformaInvoices = () => {
                 <TableHead>PI No</TableHead>
                 <TableHead>Party</TableHead>
                 <TableHead>Date</TableHead>
+                <TableHead className="text-right">Amount</TableHead>
                 <TableHead>Validity</TableHead>
                 <TableHead>Status</TableHead>
                 <TableHead>Created By</TableHead>
@@ -272,6 +286,7 @@ export const ProformaInvoices = () => {
                   <TableCell className="font-medium">{pi.pi_no}</TableCell>
                   <TableCell>{partiesMap[pi.party_id] || 'Unknown'}</TableCell>
                   <TableCell>{new Date(pi.date).toLocaleDateString()}</TableCell>
+                  <TableCell className="text-right">{pi.totals ? `₹${pi.totals.grand_total.toFixed(2)}` : '-'}</TableCell>
                   <TableCell>{pi.validity_days} days</TableCell>
                   <TableCell>
                     <Badge variant={pi.pi_status === 'Payment Recd' ? 'default' : 'secondary'} className="text-xs">
@@ -282,6 +297,7 @@ export const ProformaInvoices = () => {
                   <TableCell className="text-right" onClick={(e) => e.stopPropagation()}>
                     <div className="flex justify-end gap-1">
                       <Button size="sm" variant="outline" onClick={() => handleDownloadPDF(pi.pi_id, pi.pi_no)}><FileDown size={14} /></Button>
+                      <Button size="sm" variant="outline" title={pi.email_status ? `Email: ${pi.email_status}` : 'Email to party'} onClick={() => handleSendEmail(pi)}><Mail size={14} /></Button>
                       {user?.role === 'Admin' && (
                         <Button size="sm" variant="destructive" onClick={() => handleDelete(pi.pi_id)}><Trash2 size={14} /></Button>
                       )}
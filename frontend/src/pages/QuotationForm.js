@@ -1,6 +1,8 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate, useParams } from 'react-router-dom';
 import { api } from '../utils/api';
+import { buildDocumentPatch } from '../utils/documentPatch';
+import { useDraftAutosave } from '../hooks/useDraftAutosave';
 import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
 import { Label } from '../components/ui/label';
@@ -29,10 +31,16 @@ export const QuotationForm = () => {
   const [isConverting, setIsConverting] = useState(false);
   const [selectedParty, setSelectedParty] = useState(null);
   const [isLocked, setIsLocked] = useState(false);
+  const savedRef = useRef(null); // The document as loaded, for building a PATCH
   const [formData, setFormData] = useState({
     party_id: '', date: new Date().toISOString().split('T')[0], validity_days: 30,
     payment_terms: '', delivery_terms: '', remarks: '', quotation_status: null, items: []
   });
+  // Loaded documents carry a version; wait for it before snapshotting
+  const draft = useDraftAutosave({
+    docType: 'quotation', docId: id, formData, setFormData,
+    enabled: !isLocked && (!id || formData.version !== undefined)
+  });
 
   useEffect(() => {
     fetchData();
@@ -61,9 +69,10 @@ export const QuotationForm = () => {
     try {
       const response = await api.getQuotation(id);
       const quotationData = response.data;
+      savedRef.current = { ...quotationData };
       
-      // Set locked state
-      setIsLocked(quotationData.is_locked === true);
+      // Set locked state (archived documents are read-only too)
+      setIsLocked(quotationData.is_locked === true || Boolean(quotationData.archived_at));
       
       // Enrich items with full details from items master
       const itemsRes = await api.getItems({});
@@ -108,7 +117,7 @@ export const QuotationForm = () => {
       setIsLocked(true);
       toast.success('Quotation locked successfully');
     } catch (error) {
-      toast.error('Failed to lock quotation');
+      toast.error(error.response?.data?.detail || 'Failed to lock quotation');
     }
   };
 
@@ -131,7 +140,7 @@ export const QuotationForm = () => {
       toast.success('Quotation deleted successfully');
       navigate('/quotations');
     } catch (error) {
-      toast.error('Failed to delete quotation');
+      toast.error(error.response?.data?.detail || 'Failed to delete quotation');
     }
   };
 
@@ -306,8 +315,15 @@ export const QuotationForm = () => {
         party_name_snapshot: selectedParty?.party_name || ''
       };
       
-      if (id) {
-        await api.updateQuotation(id, submitData);
+      const promoted = await draft.promote({ party_name_snapshot: submitData.party_name_snapshot });
+      if (promoted) {
+        toast.success(id ? 'Quotation updated' : `Quotation ${promoted.doc_no} created`);
+      } else if (id) {
+        // Send only what changed; the version makes a concurrent edit fail with 409
+        const ops = buildDocumentPatch(savedRef.current, submitData);
+        if (ops.length > 0) {
+          await api.patchQuotation(id, { version: savedRef.current.version ?? 0, ops });
+        }
         toast.success('Quotation updated');
       } else {
         await api.createQuotation(submitData);
@@ -315,7 +331,7 @@ export const QuotationForm = () => {
       }
       navigate('/quotations');
     } catch (error) {
-      toast.error('Failed to save quotation');
+      toast.error(error.response?.data?.detail || 'Failed to save quotation');
     }
   };
 
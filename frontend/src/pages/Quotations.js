@@ -9,8 +9,9 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '.
 import { Input } from '../components/ui/input';
 import { Badge } from '../components/ui/badge';
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '../components/ui/table';
-import { Plus, FileDown, Filter, Trash2, User, Grid, List } from 'lucide-react';
+import { Plus, FileDown, Mail, Filter, Trash2, User, Grid, List } from 'lucide-react';
 import { toast } from 'sonner';
+import { PdfThumbnail } from '../components/PdfThumbnail';
 
 export const Quotations = () => {
   const { user } = useAuth();
@@ -102,6 +103,16 @@ export const Quotations = () => {
     }
   };
 
+  const handleSendEmail = async (doc) => {
+    if (!window.confirm(`Email ${doc.quotation_no} to the party as a PDF?`)) return;
+    try {
+      const response = await api.sendQuotation(doc.quotation_id);
+      toast.success(`Queued for ${response.data.to.join(', ')}`);
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Failed to send email');
+    }
+  };
+
   const handleDelete = async (id) => {
     if (!window.confirm('Are you sure you want to delete this quotation?')) return;
     
@@ -110,7 +121,7 @@ export const Quotations = () => {
       toast.success('Quotation deleted successfully');
       fetchQuotations();
     } catch (error) {
-      toast.error('Failed to delete quotation');
+      toast.error(error.response?.data?.detail || 'Failed to delete quotation');
     }
   };
 
@@ -235,6 +246,7 @@ export const Quotations = () => {
                 </div>
               </CardHeader>
               <CardContent className="space-y-1 pt-0">
+                <PdfThumbnail docType="quotation" docId={qtn.quotation_id} />
                 <p className="text-xs text-muted-foreground">{partiesMap[qtn.party_id] || 'Unknown Party'}</p>
                 <p className="text-xs">Date: {new Date(qtn.date).toLocaleDateString()}</p>
                 <div className="flex items-center gap-1 text-xs text-muted-foreground">
@@ -244,6 +256,7 @@ export const Quotations = () => {
                 <div className="flex gap-2 pt-2" onClick={(e) => e.stopPropagation()}>
                   <Button size="sm" variant="outline" onClick={() => navigate(`/quotations/${qtn.quotation_id}`)}>Edit</Button>
                   <Button size="sm" variant="outline" onClick={() => handleDownloadPDF(qtn.quotation_id)}><FileDown size={14} /></Button>
+                  <Button size="sm" variant="outline" title={qtn.email_status ? `Email: ${qtn.email_status}` : 'Email to party'} onClick={() => handleSendEmail(qtn)}><Mail size={14} /></Button>
                   {user?.role === 'Admin' && (
                     <Button size="sm" variant="destructive" onClick={() => handleDelete(qtn.quotation_id)}><Trash2 size={14} /></Button>
                   )}
@@ -261,6 +274,7 @@ export const Quotations = () => {
                 <TableHead>Quotation No</TableHead>
                 <TableHead>Party</TableHead>
                 <TableHead>Date</TableHead>
+                <TableHead className="text-right">Amount</TableHead>
                 <TableHead>Status</TableHead>
                 <TableHead>Created By</TableHead>
                 <TableHead className="text-right">Actions</TableHead>
@@ -272,6 +286,7 @@ export const Quotations = () => {
                   <TableCell className="font-medium">{qtn.quotation_no}</TableCell>
                   <TableCell>{partiesMap[qtn.party_id] || 'Unknown'}</TableCell>
                   <TableCell>{new Date(qtn.date).toLocaleDateString()}</TableCell>
+                  <TableCell className="text-right">{qtn.totals ? `₹${qtn.totals.grand_total.toFixed(2)}` : '-'}</TableCell>
                   <TableCell>
                     <Badge variant={
                       qtn.quotation_status === 'Successful' ? 'default' :
@@ -285,6 +300,7 @@ export const Quotations = () => {
                   <TableCell className="text-right" onClick={(e) => e.stopPropagation()}>
                     <div className="flex justify-end gap-1">
                       <Button size="sm" variant="outline" onClick={() => handleDownloadPDF(qtn.quotation_id)}><FileDown size={14} /></Button>
+                      <Button size="sm" variant="outline" title={qtn.email_status ? `Email: ${qtn.email_status}` : 'Email to party'} onClick={() => handleSendEmail(qtn)}><Mail size={14} /></Button>
                       {user?.role === 'Admin' && (
                         <Button size="sm" variant="destructive" onClick={() => handleDelete(qtn.quotation_id)}><Trash2 size={14} /></Button>
                       )}
@@ -11,12 +11,14 @@ export const Reports = () => {
   const fetchReport = async (type) => {
     try {
       let response;
+      // Sales and GST reports are lifetime totals, so archived documents count too
+      const lifetime = { include_archived: true };
       switch(type) {
-        case 'item': response = await api.getItemWiseSales(); break;
-        case 'party': response = await api.getPartyWiseSales(); break;
-        case 'user': response = await api.getUserWiseSales(); break;
+        case 'item': response = await api.getItemWiseSales(lifetime); break;
+        case 'party': response = await api.getPartyWiseSales(lifetime); break;
+        case 'user': response = await api.getUserWiseSales(lifetime); break;
         case 'lead': response = await api.getLeadConversion(); break;
-        case 'gst': response = await api.getGSTSummary(); break;
+        case 'gst': response = await api.getGSTSummary(lifetime); break;
         default: return;
       }
       setReports({ ...reports, [type]: response.data });
@@ -1,6 +1,8 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate, useParams } from 'react-router-dom';
 import { api } from '../utils/api';
+import { buildDocumentPatch } from '../utils/documentPatch';
+import { useDraftAutosave } from '../hooks/useDraftAutosave';
 import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
 import { Label } from '../components/ui/label';
@@ -30,10 +32,16 @@ export const SOAForm = () => {
   const [isConverting, setIsConverting] = useState(false);
   const [selectedParty, setSelectedParty] = useState(null);
   const [isLocked, setIsLocked] = useState(false);
+  const savedRef = useRef(null); // The document as loaded, for building a PATCH
   const [formData, setFormData] = useState({
     party_id: '', date: new Date().toISOString().split('T')[0],
     terms_and_conditions: '', remarks: '', soa_status: 'In Process', items: []
   });
+  // Loaded documents carry a version; wait for it before snapshotting
+  const draft = useDraftAutosave({
+    docType: 'soa', docId: id, formData, setFormData,
+    enabled: !isLocked && (!id || formData.version !== undefined)
+  });
 
   useEffect(() => {
     fetchData();
@@ -61,9 +69,10 @@ export const SOAForm = () => {
     try {
       const response = await api.getSOA(id);
       const soaData = response.data;
+      savedRef.current = { ...soaData };
       
-      // Set locked state
-      setIsLocked(soaData.is_locked === true);
+      // Set locked state (archived documents are read-only too)
+      setIsLocked(soaData.is_locked === true || Boolean(soaData.archived_at));
       
       // Enrich items with full details from items master
       const itemsRes = await api.getItems({});
@@ -108,7 +117,7 @@ export const SOAForm = () => {
       setIsLocked(true);
       toast.success('SOA locked successfully');
     } catch (error) {
-      toast.error('Failed to lock SOA');
+      toast.error(error.response?.data?.detail || 'Failed to lock SOA');
     }
   };
 
@@ -131,7 +140,7 @@ export const SOAForm = () => {
       toast.success('SOA deleted successfully');
       navigate('/soa');
     } catch (error) {
-      toast.error('Failed to delete SOA');
+      toast.error(error.response?.data?.detail || 'Failed to delete SOA');
     }
   };
 
@@ -304,8 +313,15 @@ export const SOAForm = () => {
         party_name_snapshot: selectedParty?.party_name || ''
       };
       
-      if (id) {
-        await api.updateSOA(id, submitData);
+      const promoted = await draft.promote({ party_name_snapshot: submitData.party_name_snapshot });
+      if (promoted) {
+        toast.success(id ? 'SOA updated' : `SOA ${promoted.doc_no} created`);
+      } else if (id) {
+        // Send only what changed; the version makes a concurrent edit fail with 409
+        const ops = buildDocumentPatch(savedRef.current, submitData);
+        if (ops.length > 0) {
+          await api.patchSOA(id, { version: savedRef.current.version ?? 0, ops });
+        }
         toast.success('SOA updated');
       } else {
         await api.createSOA(submitData);
@@ -313,7 +329,7 @@ export const SOAForm = () => {
       }
       navigate('/soa');
     } catch (error) {
-      toast.error('Failed to save SOA');
+      toast.error(error.response?.data?.detail || 'Failed to save SOA');
     }
   };
 
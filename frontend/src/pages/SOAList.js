@@ -9,8 +9,9 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '.
 import { Input } from '../components/ui/input';
 import { Badge } from '../components/ui/badge';
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '../components/ui/table';
-import { Plus, FileDown, Edit, Filter, Trash2, User, Grid, List } from 'lucide-react';
+import { Plus, FileDown, Mail, Edit, Filter, Trash2, User, Grid, List } from 'lucide-react';
 import { toast } from 'sonner';
+import { PdfThumbnail } from '../components/PdfThumbnail';
 
 export const SOAList = () => {
   const { user } = useAuth();
@@ -104,6 +105,16 @@ export const SOAList = () => {
     }
   };
 
+  const handleSendEmail = async (doc) => {
+    if (!window.confirm(`Email ${doc.soa_no} to the party as a PDF?`)) return;
+    try {
+      const response = await api.sendSOA(doc.soa_id);
+      toast.success(`Queued for ${response.data.to.join(', ')}`);
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Failed to send email');
+    }
+  };
+
   const handleDelete = async (id) => {
     if (!window.confirm('Are you sure you want to delete this SOA?')) return;
     
@@ -112,7 +123,7 @@ export const SOAList = () => {
       toast.success('SOA deleted successfully');
       fetchSOAs();
     } catch (error) {
-      toast.error('Failed to delete SOA');
+      toast.error(error.response?.data?.detail || 'Failed to delete SOA');
     }
   };
 
@@ -233,6 +244,7 @@ export const SOAList = () => {
                 </div>
               </CardHeader>
               <CardContent className="space-y-1 pt-0">
+                <PdfThumbnail docType="soa" docId={soa.soa_id} />
                 <p className="text-xs text-muted-foreground">{partiesMap[soa.party_id] || 'Unknown Party'}</p>
                 <p className="text-xs">Date: {new Date(soa.date).toLocaleDateString()}</p>
                 <p className="text-xs">Confirmation: {soa.party_confirmation_ID || 'N/A'}</p>
@@ -243,6 +255,7 @@ export const SOAList = () => {
                 <div className="flex gap-2 pt-2" onClick={(e) => e.stopPropagation()}>
                   <Button size="sm" variant="outline" onClick={() => navigate(`/soa/${soa.soa_id}`)}>Edit</Button>
                   <Button size="sm" variant="outline" onClick={() => handleDownloadPDF(soa.soa_id, soa.soa_no)}><FileDown size={14} /></Button>
+                  <Button size="sm" variant="outline" title={soa.email_status ? `Email: ${soa.email_status}` : 'Email to party'} onClick={() => handleSendEmail(soa)}><Mail size={14} /></Button>
                   {user?.role === 'Admin' && (
                     <Button size="sm" variant="destructive" onClick={() => handleDelete(soa.soa_id)}><Trash2 size={14} /></Button>
                   )}
@@ -260,6 +273,7 @@ export const SOAList = () => {
                 <TableHead>SOA No</TableHead>
                 <TableHead>Party</TableHead>
                 <TableHead>Date</TableHead>
+                <TableHead className="text-right">Amount</TableHead>
                 <TableHead>Confirmation ID</TableHead>
                 <TableHead>Status</TableHead>
                 <TableHead>Created By</TableHead>
@@ -272,6 +286,7 @@ export const SOAList = () => {
                   <TableCell className="font-medium">{soa.soa_no}</TableCell>
                   <TableCell>{partiesMap[soa.party_id] || 'Unknown'}</TableCell>
                   <TableCell>{new Date(soa.date).toLocaleDateString()}</TableCell>
+                  <TableCell className="text-right">{soa.totals ? `₹${soa.totals.grand_total.toFixed(2)}` : '-'}</TableCell>
                   <TableCell>{soa.party_confirmation_ID || 'N/A'}</TableCell>
                   <TableCell>
                     <Badge variant={soa.soa_status === 'Material Given' ? 'default' : 'secondary'} className="text-xs">
@@ -282,6 +297,7 @@ export const SOAList = () => {
                   <TableCell className="text-right" onClick={(e) => e.stopPropagation()}>
                     <div className="flex justify-end gap-1">
                       <Button size="sm" variant="outline" onClick={() => handleDownloadPDF(soa.soa_id, soa.soa_no)}><FileDown size={14} /></Button>
+                      <Button size="sm" variant="outline" title={soa.email_status ? `Email: ${soa.email_status}` : 'Email to party'} onClick={() => handleSendEmail(soa)}><Mail size={14} /></Button>
                       {user?.role === 'Admin' && (
                         <Button size="sm" variant="destructive" onClick={() => handleDelete(soa.soa_id)}><Trash2 size={14} /></Button>
                       )}
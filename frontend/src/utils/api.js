@@ -14,7 +14,12 @@ export const api = {
   createParty: (data) => axios.post(`${API_URL}/parties`, data, { headers: getAuthHeader() }),
   updateParty: (id, data) => axios.put(`${API_URL}/parties/${id}`, data, { headers: getAuthHeader() }),
   deleteParty: (id) => axios.delete(`${API_URL}/parties/${id}`, { headers: getAuthHeader() }),
+  bulkDeactivateParties: (ids) => axios.post(`${API_URL}/parties/bulk-deactivate`, { ids }, { headers: getAuthHeader() }),
   duplicateParty: (id) => axios.post(`${API_URL}/parties/${id}/duplicate`, {}, { headers: getAuthHeader() }),
+  // Starts a background scan (poll getJob); getPartyDuplicates then reads the stored clusters
+  scanPartyDuplicates: (data = {}) => axios.post(`${API_URL}/parties/duplicates/scan`, data, { headers: getAuthHeader() }),
+  getPartyDuplicates: () => axios.get(`${API_URL}/parties/duplicates`, { headers: getAuthHeader() }),
+  mergeParties: (keepPartyId, mergePartyIds) => axios.post(`${API_URL}/parties/merge`, { keep_party_id: keepPartyId, merge_party_ids: mergePartyIds }, { headers: getAuthHeader() }),
   exportPartiesCSV: () => axios.get(`${API_URL}/parties/export/csv`, { headers: getAuthHeader(), responseType: 'blob' }),
   uploadPartiesCSV: (file) => {
     const formData = new FormData();
@@ -24,10 +29,13 @@ export const api = {
 
   // Items
   getItems: (params) => axios.get(`${API_URL}/items`, { params, headers: getAuthHeader() }),
+  getItemFacets: (params) => axios.get(`${API_URL}/items/facets`, { params, headers: getAuthHeader() }),
   getItem: (id) => axios.get(`${API_URL}/items/${id}`, { headers: getAuthHeader() }),
   createItem: (data) => axios.post(`${API_URL}/items`, data, { headers: getAuthHeader() }),
   updateItem: (id, data) => axios.put(`${API_URL}/items/${id}`, data, { headers: getAuthHeader() }),
   deleteItem: (id) => axios.delete(`${API_URL}/items/${id}`, { headers: getAuthHeader() }),
+  // Items used on any document are skipped; see results[].outcome
+  bulkDeleteItems: (ids) => axios.post(`${API_URL}/items/bulk-delete`, { ids }, { headers: getAuthHeader() }),
   duplicateItem: (id) => axios.post(`${API_URL}/items/${id}/duplicate`, {}, { headers: getAuthHeader() }),
   exportItemsCSV: () => axios.get(`${API_URL}/items/export/csv`, { headers: getAuthHeader(), responseType: 'blob' }),
   uploadItemsCSV: (file) => {
@@ -50,36 +58,63 @@ export const api = {
   getQuotation: (id) => axios.get(`${API_URL}/quotations/${id}`, { headers: getAuthHeader() }),
   createQuotation: (data) => axios.post(`${API_URL}/quotations`, data, { headers: getAuthHeader() }),
   updateQuotation: (id, data) => axios.put(`${API_URL}/quotations/${id}`, data, { headers: getAuthHeader() }),
+  // Line-level changes: { version, ops: [{ op: 'replace', path: '/items/3/qty', value: 2 }] }
+  patchQuotation: (id, data) => axios.patch(`${API_URL}/quotations/${id}`, data, { headers: getAuthHeader() }),
   deleteQuotation: (id) => axios.delete(`${API_URL}/quotations/${id}`, { headers: getAuthHeader() }),
   duplicateQuotation: (id) => axios.post(`${API_URL}/quotations/${id}/duplicate`, {}, { headers: getAuthHeader() }),
   lockQuotation: (id) => axios.post(`${API_URL}/quotations/${id}/lock`, {}, { headers: getAuthHeader() }),
+  bulkLockQuotations: (ids) => axios.post(`${API_URL}/quotations/bulk-lock`, { ids }, { headers: getAuthHeader() }),
   convertQuotationToPI: (id) => axios.post(`${API_URL}/quotations/${id}/convert-to-pi`, {}, { headers: getAuthHeader() }),
   convertQuotationToSOA: (id) => axios.post(`${API_URL}/quotations/${id}/convert-to-soa`, {}, { headers: getAuthHeader() }),
   downloadQuotationPDF: (id) => axios.get(`${API_URL}/quotations/${id}/pdf`, { headers: getAuthHeader(), responseType: 'blob' }),
+  sendQuotation: (id, data = {}) => axios.post(`${API_URL}/quotations/${id}/send`, data, { headers: getAuthHeader() }),
 
   // Proforma Invoices
   getProformaInvoices: (params) => axios.get(`${API_URL}/proforma-invoices`, { params, headers: getAuthHeader() }),
   getProformaInvoice: (id) => axios.get(`${API_URL}/proforma-invoices/${id}`, { headers: getAuthHeader() }),
   createProformaInvoice: (data) => axios.post(`${API_URL}/proforma-invoices`, data, { headers: getAuthHeader() }),
   updateProformaInvoice: (id, data) => axios.put(`${API_URL}/proforma-invoices/${id}`, data, { headers: getAuthHeader() }),
+  patchProformaInvoice: (id, data) => axios.patch(`${API_URL}/proforma-invoices/${id}`, data, { headers: getAuthHeader() }),
   deleteProformaInvoice: (id) => axios.delete(`${API_URL}/proforma-invoices/${id}`, { headers: getAuthHeader() }),
   duplicateProformaInvoice: (id) => axios.post(`${API_URL}/proforma-invoices/${id}/duplicate`, {}, { headers: getAuthHeader() }),
   lockProformaInvoice: (id) => axios.post(`${API_URL}/proforma-invoices/${id}/lock`, {}, { headers: getAuthHeader() }),
+  bulkLockProformaInvoices: (ids) => axios.post(`${API_URL}/proforma-invoices/bulk-lock`, { ids }, { headers: getAuthHeader() }),
   convertPIToSOA: (id) => axios.post(`${API_URL}/proforma-invoices/${id}/convert-to-soa`, {}, { headers: getAuthHeader() }),
   convertPIToQuotation: (id) => axios.post(`${API_URL}/proforma-invoices/${id}/convert-to-quotation`, {}, { headers: getAuthHeader() }),
   downloadPIPDF: (id) => axios.get(`${API_URL}/proforma-invoices/${id}/pdf`, { headers: getAuthHeader(), responseType: 'blob' }),
+  sendPI: (id, data = {}) => axios.post(`${API_URL}/proforma-invoices/${id}/send`, data, { headers: getAuthHeader() }),
 
   // SOA
   getSOAs: (params) => axios.get(`${API_URL}/soa`, { params, headers: getAuthHeader() }),
   getSOA: (id) => axios.get(`${API_URL}/soa/${id}`, { headers: getAuthHeader() }),
   createSOA: (data) => axios.post(`${API_URL}/soa`, data, { headers: getAuthHeader() }),
   updateSOA: (id, data) => axios.put(`${API_URL}/soa/${id}`, data, { headers: getAuthHeader() }),
+  patchSOA: (id, data) => axios.patch(`${API_URL}/soa/${id}`, data, { headers: getAuthHeader() }),
   deleteSOA: (id) => axios.delete(`${API_URL}/soa/${id}`, { headers: getAuthHeader() }),
   duplicateSOA: (id) => axios.post(`${API_URL}/soa/${id}/duplicate`, {}, { headers: getAuthHeader() }),
   lockSOA: (id) => axios.post(`${API_URL}/soa/${id}/lock`, {}, { headers: getAuthHeader() }),
+  bulkLockSOAs: (ids) => axios.post(`${API_URL}/soa/bulk-lock`, { ids }, { headers: getAuthHeader() }),
   convertSOAToQuotation: (id) => axios.post(`${API_URL}/soa/${id}/convert-to-quotation`, {}, { headers: getAuthHeader() }),
   convertSOAToPI: (id) => axios.post(`${API_URL}/soa/${id}/convert-to-pi`, {}, { headers: getAuthHeader() }),
   downloadSOAPDF: (id) => axios.get(`${API_URL}/soa/${id}/pdf`, { headers: getAuthHeader(), responseType: 'blob' }),
+  sendSOA: (id, data = {}) => axios.post(`${API_URL}/soa/${id}/send`, data, { headers: getAuthHeader() }),
+
+  // Autosaved form drafts (updateDraft sends only changed fields: { revision, set: { 'items.2': line } })
+  getDrafts: (params) => axios.get(`${API_URL}/drafts`, { params, headers: getAuthHeader() }),
+  getDraft: (id) => axios.get(`${API_URL}/drafts/${id}`, { headers: getAuthHeader() }),
+  createDraft: (data) => axios.post(`${API_URL}/drafts`, data, { headers: getAuthHeader() }),
+  updateDraft: (id, data) => axios.patch(`${API_URL}/drafts/${id}`, data, { headers: getAuthHeader() }),
+  deleteDraft: (id) => axios.delete(`${API_URL}/drafts/${id}`, { headers: getAuthHeader() }),
+  promoteDraft: (id) => axios.post(`${API_URL}/drafts/${id}/promote`, {}, { headers: getAuthHeader() }),
+
+  // Bulk PDF export (poll getJob with the returned job_id, then download the zip)
+  startPDFBatch: (data) => axios.post(`${API_URL}/pdf/batch`, data, { headers: getAuthHeader() }),
+  downloadPDFBatch: (jobId) => axios.get(`${API_URL}/pdf/batch/${jobId}/download`, { headers: getAuthHeader(), responseType: 'blob' }),
+  // Bulk email of PDFs to each document's party (poll getJob with the returned job_id)
+  startEmailBatch: (data) => axios.post(`${API_URL}/email/batch`, data, { headers: getAuthHeader() }),
+  // Move many documents to one status: { doc_type, ids | filters (period, party_id, filter_status, ...), to_status }
+  bulkUpdateStatus: (data) => axios.post(`${API_URL}/bulk/status`, data, { headers: getAuthHeader() }),
+  getPDFThumbnail: (docType, id) => axios.get(`${API_URL}/pdf/thumbnail/${docType}/${id}`, { headers: getAuthHeader(), responseType: 'blob' }),
 
   // Dashboard
   getDashboardStats: (params) => axios.get(`${API_URL}/dashboard/stats`, { params, headers: getAuthHeader() }),
@@ -89,17 +124,22 @@ export const api = {
   getSettings: () => axios.get(`${API_URL}/settings`, { headers: getAuthHeader() }),
   updateSettings: (data) => axios.put(`${API_URL}/settings`, data, { headers: getAuthHeader() }),
 
-  // Reports
-  getItemWiseSales: () => axios.get(`${API_URL}/reports/item-wise-sales`, { headers: getAuthHeader() }),
-  getPartyWiseSales: () => axios.get(`${API_URL}/reports/party-wise-sales`, { headers: getAuthHeader() }),
-  getUserWiseSales: () => axios.get(`${API_URL}/reports/user-wise-sales`, { headers: getAuthHeader() }),
+  // Reports (pass { include_archived: true } to count archived documents too)
+  getItemWiseSales: (params) => axios.get(`${API_URL}/reports/item-wise-sales`, { params, headers: getAuthHeader() }),
+  getPartyWiseSales: (params) => axios.get(`${API_URL}/reports/party-wise-sales`, { params, headers: getAuthHeader() }),
+  getUserWiseSales: (params) => axios.get(`${API_URL}/reports/user-wise-sales`, { params, headers: getAuthHeader() }),
   getLeadConversion: () => axios.get(`${API_URL}/reports/lead-conversion`, { headers: getAuthHeader() }),
   getPendingLeads: () => axios.get(`${API_URL}/reports/pending-leads`, { headers: getAuthHeader() }),
   getQuotationAging: () => axios.get(`${API_URL}/reports/quotation-aging`, { headers: getAuthHeader() }),
-  getGSTSummary: () => axios.get(`${API_URL}/reports/gst-summary`, { headers: getAuthHeader() }),
+  getGSTSummary: (params) => axios.get(`${API_URL}/reports/gst-summary`, { params, headers: getAuthHeader() }),
   getDocumentLogs: () => axios.get(`${API_URL}/logs`, { headers: getAuthHeader() }),
 
+  // Background jobs
+  getJob: (jobId) => axios.get(`${API_URL}/jobs/${jobId}`, { headers: getAuthHeader() }),
+
   // Users
   getUsers: () => axios.get(`${API_URL}/users`, { headers: getAuthHeader() }),
+  // Changing name or role signs the user out of their open sessions
+  updateUser: (userId, data) => axios.put(`${API_URL}/users/${userId}`, data, { headers: getAuthHeader() }),
   updateUserStatus: (userId, status) => axios.put(`${API_URL}/users/${userId}/status`, null, { params: { status }, headers: getAuthHeader() }),
 };
@@ -0,0 +1,50 @@
+// Line fields the server recomputes; a patch may not set them
+const LINE_COMPUTED_FIELDS = ['taxable_amount', 'tax_type', 'tax_amount', 'total_amount'];
+
+const sameValue = (a, b) => JSON.stringify(a) === JSON.stringify(b);
+
+const lineValue = (line) => {
+  const value = { ...line };
+  LINE_COMPUTED_FIELDS.forEach(field => delete value[field]);
+  return value;
+};
+
+// JSON-patch style ops that turn the document as loaded into the edited form
+// data, for PATCH /quotations|proforma-invoices|soa/{id}. Edited lines are
+// sent field by field; added or removed lines as one contiguous run.
+export const buildDocumentPatch = (saved, current) => {
+  const ops = [];
+  Object.keys(current).forEach(field => {
+    if (field === 'items' || field === 'version') return;
+    if (!sameValue(saved[field], current[field])) {
+      ops.push({ op: 'replace', path: `/${field}`, value: current[field] });
+    }
+  });
+
+  const before = saved.items || [];
+  const after = current.items || [];
+  if (before.length === after.length) {
+    after.forEach((line, index) => {
+      Object.keys(lineValue(line)).forEach(field => {
+        if (!sameValue(before[index][field], line[field])) {
+          ops.push({ op: 'replace', path: `/items/${index}/${field}`, value: line[field] });
+        }
+      });
+    });
+  } else {
+    const shorter = Math.min(before.length, after.length);
+    let start = 0;
+    while (start < shorter && sameValue(before[start], after[start])) start++;
+    let end = 0;
+    while (end < shorter - start && sameValue(before[before.length - 1 - end], after[after.length - 1 - end])) end++;
+    for (let index = before.length - 1 - end; index >= start; index--) {
+      ops.push({ op: 'remove', path: `/items/${index}` });
+    }
+    for (let index = start; index < after.length - end; index++) {
+      ops.push({ op: 'add', path: `/items/${index}`, value: lineValue(after[index]) });
+    }
+  }
+  return ops;
+};
+
+export default buildDocumentPatch;
@@ -0,0 +1,130 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The API runs against an in-memory MongoDB; skip everything when it is not installed
+pytest.importorskip("mongomock_motor")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ["PDF_RENDER_WORKERS"] = "0"
+os.environ["ARCHIVE_INTERVAL_HOURS"] = "0"
+
+import mongomock.collection
+import motor.motor_asyncio
+from mongomock_motor import AsyncMongoMockClient
+
+
+class _MockMotorClient(AsyncMongoMockClient):
+    def __init__(self, *args, **kwargs):
+        kwargs.pop("event_listeners", None)
+        super().__init__()
+
+
+motor.motor_asyncio.AsyncIOMotorClient = _MockMotorClient
+
+# mongomock returns None from find_one_and_update(..., projection={"_id": 0},
+# return_document=AFTER); drop _id after the lookup instead
+_find_and_modify = mongomock.collection.Collection._find_and_modify
+
+
+def _find_and_modify_without_id(self, query, projection=None, *args, **kwargs):
+    drop_id = isinstance(projection, dict) and projection.get("_id") == 0
+    if drop_id:
+        projection = {k: v for k, v in projection.items() if k != "_id"} or None
+    doc = _find_and_modify(self, query, projection, *args, **kwargs)
+    if drop_id and doc is not None:
+        doc.pop("_id", None)
+    return doc
+
+
+mongomock.collection.Collection._find_and_modify = _find_and_modify_without_id
+
+import server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+# Maharashtra parties are billed CGST+SGST, the Karnataka one IGST
+HOME_PARTY = {
+    "party_name": "Home Traders", "address": "1 Main Road", "city": "Kolhapur", "state": "Maharashtra",
+    "pincode": "416001", "contact_person": "A", "mobile": "9000000001", "email": "home@example.com",
+    "GST_number": "27AAAAA0000A1Z5"
+}
+OUTSIDE_PARTY = {
+    "party_name": "Outside Traders", "address": "2 Main Road", "city": "Belagavi", "state": "Karnataka",
+    "pincode": "590001", "contact_person": "B", "mobile": "9000000002", "email": "outside@example.com",
+    "GST_number": "29BBBBB0000B1Z5"
+}
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(server.app) as client:
+        user = {"name": "Test Admin", "email": "admin@example.com", "mobile": "9000000000", "role": "Admin", "password": "secret123"}
+        client.post("/api/auth/register", json=user)
+        response = client.post("/api/auth/login", json={"email": user["email"], "password": user["password"]})
+        client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+        yield client
+
+
+class RecordingTransport(server.EmailTransport):
+    name = "test"
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+@pytest.fixture
+def sent_emails(monkeypatch):
+    """Messages the outbox sender delivers, instead of writing them to EMAIL_FILE_DIR."""
+    transport = RecordingTransport()
+    monkeypatch.setattr(server, "email_transport", transport)
+    return transport.sent
+
+
+@pytest.fixture(scope="session")
+def sales_user(client):
+    user = {"name": "Test Sales", "email": "sales@example.com", "mobile": "9000000003", "role": "Sales User", "password": "secret123"}
+    user_id = client.post("/api/auth/register", json=user).json()["user_id"]
+    response = client.post("/api/auth/login", json={"email": user["email"], "password": user["password"]})
+    return {"user_id": user_id, "headers": {"Authorization": f"Bearer {response.json()['access_token']}"}}
+
+
+@pytest.fixture(scope="session")
+def parties(client):
+    return {
+        "home": client.post("/api/parties", json=HOME_PARTY).json()["party_id"],
+        "outside": client.post("/api/parties", json=OUTSIDE_PARTY).json()["party_id"]
+    }
+
+
+@pytest.fixture(scope="session")
+def items(client):
+    meter = {"item_code": "M1", "item_name": "Meter", "UOM": "Nos", "rate": 100, "HSN": "9028", "GST_percent": 18}
+    panel = {"item_code": "P1", "item_name": "Panel", "UOM": "Set", "rate": 250, "HSN": "8541", "GST_percent": 12}
+    return {
+        "meter": client.post("/api/items", json=meter).json()["item_id"],
+        "panel": client.post("/api/items", json=panel).json()["item_id"]
+    }
+
+
+@pytest.fixture
+def make_quotation(client, parties, items):
+    def make(**fields):
+        line = {
+            "item_id": items["meter"], "item_name": "Meter", "item_code": "M1", "UOM": "Nos", "HSN": "9028",
+            "GST_percent": 18, "qty": 2, "rate": 100, "discount_percent": 0, "taxable_amount": 200,
+            "tax_type": "CGST+SGST", "tax_amount": 36, "total_amount": 236
+        }
+        body = {"party_id": parties["home"], "date": "2026-05-01", "items": [line], **fields}
+        response = client.post("/api/quotations", json=body)
+        assert response.status_code == 200, response.text
+        return response.json()
+    return make
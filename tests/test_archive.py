@@ -0,0 +1,75 @@
+from mongomock_motor import AsyncMongoMockCollection
+
+import pytest
+
+import server
+
+from .test_pdf_batch import wait_for_job
+
+
+@pytest.fixture
+def closed_quotation(make_quotation, parties):
+    # Kept off the home party, whose Lost quotations other tests select in bulk
+    def make(date="2020-05-01", quotation_status="Lost"):
+        return make_quotation(party_id=parties["outside"], date=date, quotation_status=quotation_status)
+    return make
+
+
+def stored(client, collection, quotation_id):
+    return client.portal.call(server.db[collection].find_one, {"quotation_id": quotation_id}, {"_id": 0})
+
+
+def test_only_old_closed_documents_are_archived(client, closed_quotation):
+    old_lost = closed_quotation()["quotation_id"]
+    old_open = closed_quotation(quotation_status="In Process")["quotation_id"]
+    recent_lost = closed_quotation(date=server.financial_year_start())["quotation_id"]
+
+    response = client.post("/api/archive/run", json={"financial_years": 1})
+    assert response.status_code == 202, response.text
+    assert response.json()["cutoff"] == server.financial_year_start()
+    job = wait_for_job(client, response.json()["job_id"])
+    assert job["status"] == "completed", job
+    assert job["result"]["archived"]["quotation"] >= 1
+
+    assert stored(client, "quotations", old_lost) is None
+    assert stored(client, "quotations_archive", old_lost)["archived_at"]
+    for quotation_id in (old_open, recent_lost):
+        assert stored(client, "quotations", quotation_id)
+        assert stored(client, "quotations_archive", quotation_id) is None
+
+
+def test_archived_documents_stay_readable_but_not_editable(client, closed_quotation):
+    doc = closed_quotation()
+    client.portal.call(server.archive_batch, "quotation", server.financial_year_start())
+    url = f"/api/quotations/{doc['quotation_id']}"
+
+    fetched = client.get(url)
+    assert fetched.status_code == 200
+    assert fetched.json()["archived_at"]
+    listed = client.get("/api/quotations", params={"include_archived": True}).json()
+    assert doc["quotation_id"] in {q["quotation_id"] for q in listed}
+    assert doc["quotation_id"] not in {q["quotation_id"] for q in client.get("/api/quotations").json()}
+
+    edit = client.patch(url, json={"version": doc["version"], "ops": [{"op": "replace", "path": "/remarks", "value": "late"}]})
+    assert edit.status_code == 423
+
+
+def test_document_edited_while_being_copied_stays_hot(client, closed_quotation, monkeypatch):
+    quotation_id = closed_quotation()["quotation_id"]
+    bulk_write = AsyncMongoMockCollection.bulk_write
+
+    async def edit_after_copy(self, requests, **kwargs):
+        result = await bulk_write(self, requests, **kwargs)
+        if self.name == "quotations_archive":
+            await server.db.quotations.update_one({"quotation_id": quotation_id}, {"$inc": {"version": 1}})
+        return result
+
+    monkeypatch.setattr(AsyncMongoMockCollection, "bulk_write", edit_after_copy)
+    client.portal.call(server.archive_batch, "quotation", server.financial_year_start())
+    assert stored(client, "quotations", quotation_id)
+    assert stored(client, "quotations_archive", quotation_id) is None
+
+
+def test_archive_is_admin_only(client, sales_user):
+    assert client.post("/api/archive/run", json={}, headers=sales_user["headers"]).status_code == 403
+    assert client.post("/api/archive/run", json={"financial_years": 0}).status_code == 400
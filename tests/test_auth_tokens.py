@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+import server
+
+
+def new_session(client, email, role="Sales User"):
+    user = {"name": "Token User", "email": email, "mobile": "9000000020", "role": role, "password": "secret123"}
+    user_id = client.post("/api/auth/register", json=user).json()["user_id"]
+    tokens = client.post("/api/auth/login", json={"email": email, "password": "secret123"}).json()
+    return user_id, tokens
+
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_refresh_rotates_the_session(client):
+    user_id, tokens = new_session(client, "refresh@example.com")
+    response = client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 200, response.text
+    renewed = response.json()
+    assert renewed["user"]["user_id"] == user_id
+    assert client.get("/api/settings", headers=bearer(renewed["access_token"])).status_code == 200
+
+
+def test_only_access_tokens_open_a_session(client):
+    _, tokens = new_session(client, "tokentypes@example.com")
+    # A refresh or reset token is signed with the same key but must not authenticate requests
+    assert client.get("/api/settings", headers=bearer(tokens["refresh_token"])).status_code == 401
+    reset = server.create_access_token({"sub": tokens["user"]["user_id"], "type": "reset"}, timedelta(minutes=5))
+    assert client.get("/api/settings", headers=bearer(reset)).status_code == 401
+    # And an access token cannot be used to refresh
+    assert client.post("/api/auth/refresh", json={"refresh_token": tokens["access_token"]}).status_code == 401
+
+
+def test_revoked_generation_is_rejected(client):
+    user_id, tokens = new_session(client, "revoked@example.com")
+    assert client.portal.call(server.revoke_user_tokens, user_id)
+    assert client.get("/api/settings", headers=bearer(tokens["access_token"])).status_code == 401
+    assert client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+    # Other workers see the bump on their next reload
+    other_worker = server.TokenRevocations()
+    client.portal.call(other_worker.reload)
+    assert other_worker.is_revoked(user_id, 0)
+    assert not other_worker.is_revoked(user_id, 1)
+
+
+def test_role_change_ends_open_sessions(client):
+    user_id, tokens = new_session(client, "promoted@example.com")
+    response = client.put(f"/api/users/{user_id}", json={"role": "Admin", "mobile": "9000000021"})
+    assert response.status_code == 200, response.text
+    assert (response.json()["role"], response.json()["mobile"]) == ("Admin", "9000000021")
+    assert client.get("/api/settings", headers=bearer(tokens["access_token"])).status_code == 401
+
+    relogin = client.post("/api/auth/login", json={"email": "promoted@example.com", "password": "secret123"}).json()
+    assert relogin["user"]["role"] == "Admin"
+
+
+def test_mobile_change_keeps_sessions(client):
+    user_id, tokens = new_session(client, "mobile@example.com")
+    assert client.put(f"/api/users/{user_id}", json={"mobile": "9000000022"}).status_code == 200
+    assert client.get("/api/settings", headers=bearer(tokens["access_token"])).status_code == 200
+
+
+def test_user_updates_are_admin_only(client, sales_user):
+    assert client.put(f"/api/users/{sales_user['user_id']}", json={"role": "Admin"}, headers=sales_user["headers"]).status_code == 403
+    assert client.put(f"/api/users/{sales_user['user_id']}", json={"role": "Owner"}).status_code == 400
+    assert client.put("/api/users/USR9999", json={"name": "Nobody"}).status_code == 404
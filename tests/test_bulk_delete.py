@@ -0,0 +1,54 @@
+import pytest
+
+import server
+
+from .conftest import HOME_PARTY
+
+
+def new_item(client, code):
+    item = {"item_code": code, "item_name": f"Item {code}", "UOM": "Nos", "rate": 10, "HSN": "8544", "GST_percent": 18}
+    return client.post("/api/items", json=item).json()["item_id"]
+
+
+@pytest.fixture
+def references(monkeypatch):
+    # mongomock implements neither $unionWith nor $setIntersection, so the count is stubbed
+    counts = {}
+
+    async def count_item_references(item_ids):
+        return {item_id: counts[item_id] for item_id in item_ids if item_id in counts}
+
+    monkeypatch.setattr(server, "count_item_references", count_item_references)
+    return counts
+
+
+def test_items_used_on_documents_are_kept(client, references):
+    used, unused = new_item(client, "BD1"), new_item(client, "BD2")
+    references[used] = 1
+
+    response = client.post("/api/items/bulk-delete", json={"ids": [used, unused, "ITM9999", unused]})
+    assert response.status_code == 200, response.text
+    assert response.json() == {"deleted": 1, "results": [
+        {"id": used, "outcome": "in_use", "documents": 1},
+        {"id": unused, "outcome": "deleted"},
+        {"id": "ITM9999", "outcome": "not_found"}
+    ]}
+    assert client.portal.call(server.db.items.find_one, {"item_id": used})
+    assert client.portal.call(server.db.items.find_one, {"item_id": unused}) is None
+
+
+def test_parties_are_deactivated_not_deleted(client):
+    party_id = client.post("/api/parties", json={**HOME_PARTY, "party_name": "Bulk Gone Traders", "GST_number": ""}).json()["party_id"]
+    first = client.post("/api/parties/bulk-deactivate", json={"ids": [party_id, "PTY9999"]}).json()
+    assert first == {"deactivated": 1, "results": [
+        {"id": party_id, "outcome": "deactivated"}, {"id": "PTY9999", "outcome": "not_found"}
+    ]}
+    again = client.post("/api/parties/bulk-deactivate", json={"ids": [party_id]}).json()
+    assert again["results"] == [{"id": party_id, "outcome": "already_inactive"}]
+    assert client.portal.call(server.db.parties.find_one, {"party_id": party_id})["status"] == "Inactive"
+
+
+def test_empty_and_oversized_requests_are_refused(client, monkeypatch):
+    assert client.post("/api/items/bulk-delete", json={"ids": []}).status_code == 400
+    monkeypatch.setattr(server, "BULK_MAX_IDS", 2)
+    assert client.post("/api/parties/bulk-deactivate", json={"ids": ["a", "b", "c"]}).status_code == 400
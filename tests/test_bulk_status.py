@@ -0,0 +1,56 @@
+from mongomock_motor import AsyncMongoMockCollection
+
+import server
+
+
+def bulk_status(client, ids, to_status="In Process", **filters):
+    body = {"doc_type": "quotation", "ids": ids, "to_status": to_status, **filters}
+    return client.post("/api/bulk/status", json=body)
+
+
+def outcomes(response):
+    assert response.status_code == 200, response.text
+    return {result["id"]: result["outcome"] for result in response.json()["results"]}
+
+
+def test_each_id_gets_an_outcome(client, make_quotation):
+    fresh = make_quotation()["quotation_id"]
+    done = make_quotation(quotation_status="In Process")["quotation_id"]
+    locked = make_quotation()["quotation_id"]
+    assert client.post(f"/api/quotations/{locked}/lock").status_code == 200
+
+    response = bulk_status(client, [fresh, done, locked])
+    assert outcomes(response) == {fresh: "updated", done: "unchanged", locked: "locked"}
+    assert response.json()["updated"] == 1
+    updated = client.get(f"/api/quotations/{fresh}").json()
+    assert updated["quotation_status"] == "In Process"
+
+
+def test_unknown_ids_are_dropped_from_the_selection(client, make_quotation):
+    doc = make_quotation()["quotation_id"]
+    assert outcomes(bulk_status(client, [doc, "QTN9999"])) == {doc: "updated", "QTN9999": "not_found"}
+    assert bulk_status(client, ["QTN9999"]).status_code == 404
+
+
+def test_document_locked_mid_request_is_a_conflict(client, make_quotation, monkeypatch):
+    first = make_quotation()["quotation_id"]
+    second = make_quotation()["quotation_id"]
+    update_many = AsyncMongoMockCollection.update_many
+
+    async def lock_first_then_update(self, *args, **kwargs):
+        await update_many(self, {"quotation_id": first}, {"$set": {"is_locked": True}})
+        return await update_many(self, *args, **kwargs)
+
+    monkeypatch.setattr(AsyncMongoMockCollection, "update_many", lock_first_then_update)
+    assert outcomes(bulk_status(client, [first, second])) == {first: "conflict", second: "updated"}
+
+
+def test_filter_status_selects_and_to_status_is_required(client, make_quotation):
+    lost = make_quotation(quotation_status="Lost", remarks="bulk-filter")["quotation_id"]
+    party_id = client.get(f"/api/quotations/{lost}").json()["party_id"]
+    response = bulk_status(client, [], to_status="In Process", party_id=party_id, filter_status="Lost")
+    assert outcomes(response) == {lost: "updated"}
+    missing_target = client.post("/api/bulk/status", json={"doc_type": "quotation", "ids": [lost]})
+    assert missing_target.status_code == 422
+    assert bulk_status(client, [lost], to_status="Shipped").status_code == 400
+    assert server.BulkStatusRequest.model_fields.keys() >= {"filter_status", "to_status"}
@@ -0,0 +1,140 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def line(name, qty=1, rate=10):
+    return {"item_id": "ITM0001", "item_name": name, "qty": qty, "rate": rate}
+
+
+def patch(client, doc, ops, version=None):
+    body = {"version": doc["version"] if version is None else version, "ops": ops}
+    return client.patch(f"/api/quotations/{doc['quotation_id']}", json=body)
+
+
+# ---- path parsing ----
+
+def test_parse_patch_path_splits_and_unescapes_tokens():
+    assert server.parse_patch_path("/items/3/qty") == ["items", "3", "qty"]
+    assert server.parse_patch_path("/a~1b~0c") == ["a/b~c"]
+
+
+def test_parse_patch_path_requires_leading_slash():
+    with pytest.raises(HTTPException) as error:
+        server.parse_patch_path("items/0")
+    assert error.value.status_code == 400
+
+
+def test_patch_line_index_bounds():
+    assert server.patch_line_index("2", 3) == 2
+    assert server.patch_line_index("-", 3, allow_end=True) == 3
+    assert server.patch_line_index("3", 3, allow_end=True) == 3
+    for token, allow_end in (("3", False), ("-", False), ("x", True), ("4", True)):
+        with pytest.raises(HTTPException):
+            server.patch_line_index(token, 3, allow_end=allow_end)
+
+
+# ---- build_items_update ----
+
+def test_build_items_update_sets_only_changed_lines():
+    before = [line("a"), line("b"), line("c")]
+    after = [line("a"), line("b", qty=5), line("c")]
+    assert server.build_items_update(before, after) == {"$set": {"items.1": line("b", qty=5)}}
+
+
+def test_build_items_update_appends_with_push():
+    before = [line("a"), line("b")]
+    after = before + [line("c"), line("d")]
+    assert server.build_items_update(before, after) == {"$push": {"items": {"$each": [line("c"), line("d")]}}}
+
+
+def test_build_items_update_inserts_at_position():
+    before = [line("a"), line("b")]
+    after = [line("a"), line("x"), line("b")]
+    assert server.build_items_update(before, after) == {"$push": {"items": {"$each": [line("x")], "$position": 1}}}
+
+
+def test_build_items_update_truncates_with_slice():
+    before = [line("a"), line("b"), line("c")]
+    assert server.build_items_update(before, before[:1]) == {"$push": {"items": {"$each": [], "$slice": 1}}}
+
+
+def test_build_items_update_rewrites_other_changes():
+    before = [line("a"), line("b"), line("c")]
+    removed_middle = [line("a"), line("c")]
+    assert server.build_items_update(before, removed_middle) == {"$set": {"items": removed_middle}}
+    scattered = [line("x"), line("a"), line("b"), line("c"), line("y")]
+    assert server.build_items_update(before, scattered) == {"$set": {"items": scattered}}
+
+
+# ---- PATCH endpoint ----
+
+def test_patch_recomputes_line_and_document_totals(client, make_quotation):
+    doc = make_quotation()
+    response = patch(client, doc, [{"op": "replace", "path": "/items/0/qty", "value": 3}])
+    assert response.status_code == 200, response.text
+    updated = response.json()
+    assert updated["version"] == doc["version"] + 1
+    assert updated["items"][0]["taxable_amount"] == 300
+    assert updated["items"][0]["tax_amount"] == 54
+    assert updated["items"][0]["total_amount"] == 354
+    assert updated["totals"]["subtotal"] == 300
+    assert updated["totals"]["cgst"] == 27
+    assert updated["totals"]["grand_total"] == 354
+
+
+def test_patch_appends_line_filled_from_items_master(client, make_quotation, items):
+    doc = make_quotation()
+    response = patch(client, doc, [{"op": "add", "path": "/items/-", "value": {"item_id": items["panel"], "qty": 2}}])
+    assert response.status_code == 200, response.text
+    added = response.json()["items"][-1]
+    assert (added["item_name"], added["HSN"], added["rate"], added["total_amount"]) == ("Panel", "8541", 250, 560)
+    assert response.json()["totals"]["grand_total"] == 236 + 560
+
+
+def test_patch_replacing_item_refills_snapshot(client, make_quotation, items):
+    doc = make_quotation()
+    response = patch(client, doc, [{"op": "replace", "path": "/items/0/item_id", "value": items["panel"]}])
+    assert response.status_code == 200, response.text
+    changed = response.json()["items"][0]
+    assert (changed["item_name"], changed["item_code"], changed["UOM"], changed["HSN"]) == ("Panel", "P1", "Set", "8541")
+    assert (changed["GST_percent"], changed["rate"], changed["total_amount"]) == (12, 250, 560)
+
+
+def test_patch_changing_party_switches_tax_type(client, make_quotation, parties):
+    doc = make_quotation()
+    response = patch(client, doc, [{"op": "replace", "path": "/party_id", "value": parties["outside"]}])
+    assert response.status_code == 200, response.text
+    updated = response.json()
+    assert updated["party_name_snapshot"] == "Outside Traders"
+    assert updated["items"][0]["tax_type"] == "IGST"
+    assert updated["totals"]["igst"] == 36
+
+
+def test_patch_with_stale_version_is_rejected(client, make_quotation):
+    doc = make_quotation()
+    assert patch(client, doc, [{"op": "replace", "path": "/remarks", "value": "first"}]).status_code == 200
+    response = patch(client, doc, [{"op": "replace", "path": "/remarks", "value": "second"}])
+    assert response.status_code == 409
+    assert client.get(f"/api/quotations/{doc['quotation_id']}").json()["remarks"] == "first"
+
+
+def test_patch_on_locked_document_is_rejected(client, make_quotation):
+    doc = make_quotation()
+    assert client.post(f"/api/quotations/{doc['quotation_id']}/lock").status_code == 200
+    response = patch(client, doc, [{"op": "replace", "path": "/remarks", "value": "late"}], version=doc["version"] + 1)
+    assert response.status_code == 423
+
+
+@pytest.mark.parametrize("op, message", [
+    ({"op": "replace", "path": "/items/0/total_amount", "value": 1}, "cannot be patched"),
+    ({"op": "replace", "path": "/quotation_id", "value": "QTN9999"}, "Unsupported patch"),
+    ({"op": "remove", "path": "/items/5"}, "does not exist"),
+    ({"op": "replace", "path": "/items/0/item_id", "value": "ITM9999"}, "not found"),
+])
+def test_patch_rejects_invalid_ops(client, make_quotation, op, message):
+    doc = make_quotation()
+    response = patch(client, doc, [op])
+    assert response.status_code == 400
+    assert message in response.json()["detail"]
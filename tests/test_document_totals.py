@@ -0,0 +1,49 @@
+import server
+
+
+def line(hsn, tax_type, taxable, tax):
+    return {"item_id": "ITM0001", "HSN": hsn, "tax_type": tax_type, "taxable_amount": taxable,
+            "tax_amount": tax, "total_amount": taxable + tax}
+
+
+def test_summary_splits_tax_by_type():
+    summary = server.summarize_document_taxes([
+        line("9028", "CGST+SGST", 100, 18),
+        line("9028", "CGST+SGST", 50, 9),
+        line("8541", "IGST", 200, 24),
+    ])
+    assert summary["totals"] == {"cgst": 13.5, "sgst": 13.5, "igst": 24, "subtotal": 350, "tax_total": 51, "grand_total": 401}
+    home, outside = summary["hsn_summary"]
+    assert (home["hsn"], home["taxable"], home["cgst"], home["cgst_rate"]) == ("9028", 150, 13.5, 9.0)
+    assert (outside["hsn"], outside["igst"], outside["igst_rate"]) == ("8541", 24, 12.0)
+
+
+def test_summary_keeps_all_tax_when_one_hsn_mixes_types():
+    summary = server.summarize_document_taxes([
+        line("9028", "CGST+SGST", 100, 18),
+        line("9028", "IGST", 100, 18),
+    ])
+    totals = summary["totals"]
+    assert (totals["cgst"], totals["sgst"], totals["igst"]) == (9, 9, 18)
+    assert totals["cgst"] + totals["sgst"] + totals["igst"] == totals["tax_total"]
+    assert [group["tax_type"] for group in summary["hsn_summary"]] == ["CGST+SGST", "IGST"]
+
+
+def test_summary_of_lines_without_hsn():
+    summary = server.summarize_document_taxes([{**line("", "IGST", 0, 0)}])
+    assert summary["hsn_summary"][0]["hsn"] == "HSN/SAC"
+    assert summary["hsn_summary"][0]["igst_rate"] == 18.0
+
+
+def test_backfill_stores_totals_with_master_hsn(client, items):
+    legacy = {"quotation_id": "QTNLEGACY", "items": [{**line("", "IGST", 250, 30), "item_id": items["panel"]}]}
+    current = {"quotation_id": "QTNCURRENT", "items": [], "totals": {"grand_total": 1}}
+    client.portal.call(server.db.quotations.insert_many, [legacy, current])
+
+    assert client.portal.call(server.backfill_collection_totals, "quotations", "quotation_id") == 1
+    stored = client.portal.call(server.db.quotations.find_one, {"quotation_id": "QTNLEGACY"})
+    assert stored["totals"]["igst"] == 30
+    assert stored["hsn_summary"][0]["hsn"] == "8541"
+    untouched = client.portal.call(server.db.quotations.find_one, {"quotation_id": "QTNCURRENT"})
+    assert untouched["totals"] == {"grand_total": 1}
+    assert "quotations" in server._tax_totals_complete
@@ -0,0 +1,111 @@
+import pytest
+
+import server
+from .conftest import HOME_PARTY
+
+WRITES = {
+    "update": lambda client, doc_id, body, version: client.put(f"/api/quotations/{doc_id}", json={**body, "version": version}),
+    "lock": lambda client, doc_id, body, version: client.post(f"/api/quotations/{doc_id}/lock", params={"version": version}),
+    "delete": lambda client, doc_id, body, version: client.delete(f"/api/quotations/{doc_id}", params={"version": version}),
+}
+
+
+def editable(doc):
+    return {field: doc[field] for field in server.QuotationCreate.model_fields if field in doc}
+
+
+@pytest.mark.parametrize("write", WRITES)
+def test_write_on_missing_document_is_404(client, make_quotation, write):
+    body = editable(make_quotation())
+    response = WRITES[write](client, "QTN9999", body, 0)
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("write", WRITES)
+def test_write_with_stale_version_is_409(client, make_quotation, write):
+    doc = make_quotation()
+    assert client.put(f"/api/quotations/{doc['quotation_id']}", json={**editable(doc), "remarks": "newer"}).status_code == 200
+    response = WRITES[write](client, doc["quotation_id"], editable(doc), doc["version"])
+    assert response.status_code == 409
+    assert client.get(f"/api/quotations/{doc['quotation_id']}").json()["remarks"] == "newer"
+
+
+@pytest.mark.parametrize("write", WRITES)
+def test_write_on_locked_document_is_423(client, make_quotation, write):
+    doc = make_quotation()
+    locked = client.post(f"/api/quotations/{doc['quotation_id']}/lock").json()
+    assert locked["version"] == doc["version"] + 1
+    response = WRITES[write](client, doc["quotation_id"], editable(doc), locked["version"])
+    assert response.status_code == 423
+    assert client.get(f"/api/quotations/{doc['quotation_id']}").status_code == 200
+
+
+@pytest.mark.parametrize("write", WRITES)
+def test_write_at_current_version_succeeds(client, make_quotation, write):
+    doc = make_quotation()
+    response = WRITES[write](client, doc["quotation_id"], editable(doc), doc["version"])
+    assert response.status_code == 200, response.text
+
+
+def party_body(gst, name):
+    return {**HOME_PARTY, "GST_number": gst, "party_name": name}
+
+
+def test_party_edit_keeping_gst_skips_uniqueness_check(client):
+    party = client.post("/api/parties", json=party_body("27CCCCC0000C1Z5", "Legacy One")).json()
+    # Duplicates that predate the uniqueness check must not block unrelated edits
+    twin = {**party_body("27CCCCC0000C1Z5", "Legacy Two"), "party_id": "PTYLEGACY", "status": "Active", "version": 0}
+    client.portal.call(server.db.parties.insert_one, {**twin, **server.party_match_keys(twin)})
+    response = client.put(f"/api/parties/{party['party_id']}", json={**party_body("27CCCCC0000C1Z5", "Renamed"), "version": party["version"]})
+    assert response.status_code == 200, response.text
+    assert response.json()["party_name"] == "Renamed"
+
+
+def test_party_edit_to_taken_gst_is_rejected(client):
+    first = client.post("/api/parties", json=party_body("27DDDDD0000D1Z5", "First")).json()
+    second = client.post("/api/parties", json=party_body("27EEEEE0000E1Z5", "Second")).json()
+    response = client.put(f"/api/parties/{second['party_id']}", json={**party_body("27DDDDD0000D1Z5", "Second"), "version": second["version"]})
+    assert response.status_code == 400
+    response = client.put(f"/api/parties/{second['party_id']}", json={**party_body("27FFFFF0000F1Z5", "Second"), "version": second["version"]})
+    assert response.status_code == 200
+    assert response.json()["GST_number"] == "27FFFFF0000F1Z5"
+    assert client.get(f"/api/parties/{first['party_id']}").json()["GST_number"] == "27DDDDD0000D1Z5"
+
+
+def test_party_edit_with_stale_version_is_409(client):
+    party = client.post("/api/parties", json=party_body("27GGGGG0000G1Z5", "Stale")).json()
+    body = {**party_body("27GGGGG0000G1Z5", "Stale"), "version": party["version"]}
+    assert client.put(f"/api/parties/{party['party_id']}", json=body).status_code == 200
+    assert client.put(f"/api/parties/{party['party_id']}", json=body).status_code == 409
+    assert client.put("/api/parties/PTY9999", json=body).status_code == 404
+
+
+def test_duplicate_starts_without_the_original_state(client, make_quotation):
+    doc = make_quotation()
+    assert client.post(f"/api/quotations/{doc['quotation_id']}/lock").status_code == 200
+    client.portal.call(server.db.quotations.update_one, {"quotation_id": doc["quotation_id"]},
+                       {"$set": {"email_status": "sent", "status_changed_at": "2026-05-02"}})
+    response = client.post(f"/api/quotations/{doc['quotation_id']}/duplicate")
+    assert response.status_code == 200, response.text
+    copy = client.portal.call(server.db.quotations.find_one, {"quotation_id": response.json()["quotation_id"]})
+    assert copy["is_locked"] is False
+    assert copy["quotation_status"] is None
+    assert not set(server.DUPLICATE_RESET_FIELDS) & set(copy)
+
+
+def stored(client, quotation_id):
+    return client.portal.call(server.db.quotations.find_one, {"quotation_id": quotation_id})
+
+
+def test_single_and_bulk_lock_set_the_same_fields(client, make_quotation):
+    single = make_quotation()["quotation_id"]
+    batch = make_quotation()["quotation_id"]
+    assert client.post(f"/api/quotations/{single}/lock").status_code == 200
+    response = client.post("/api/quotations/bulk-lock", json={"ids": [batch, single, "QTN9999"]})
+    assert response.status_code == 200, response.text
+    outcomes = {result["id"]: result["outcome"] for result in response.json()["results"]}
+    assert outcomes == {batch: "locked", single: "already_locked", "QTN9999": "not_found"}
+    for quotation_id in (single, batch):
+        doc = stored(client, quotation_id)
+        assert doc["is_locked"] is True
+        assert doc["locked_at"]
@@ -0,0 +1,87 @@
+import server
+
+
+def quotation_line(items):
+    return {
+        "item_id": items["meter"], "item_name": "Meter", "item_code": "M1", "UOM": "Nos", "HSN": "9028",
+        "GST_percent": 18, "qty": 1, "rate": 100, "discount_percent": 0, "taxable_amount": 100,
+        "tax_type": "CGST+SGST", "tax_amount": 18, "total_amount": 118
+    }
+
+
+def new_draft(client, **data):
+    response = client.post("/api/drafts", json={"doc_type": "quotation", "data": data})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def test_line_fields_are_saved_without_resending_the_form(client, items):
+    draft = new_draft(client, remarks="first", items=[quotation_line(items)])
+    response = client.patch(f"/api/drafts/{draft['draft_id']}", json={
+        "revision": 1, "set": {"items.0.qty": 5, "items.1": quotation_line(items)}, "unset": ["remarks"]
+    })
+    assert response.status_code == 200, response.text
+    assert response.json()["revision"] == 2
+
+    saved = client.get(f"/api/drafts/{draft['draft_id']}").json()
+    assert [line["qty"] for line in saved["data"]["items"]] == [5, 1]
+    assert "remarks" not in saved["data"]
+    # Summaries leave the lines out
+    [summary] = [d for d in client.get("/api/drafts", params={"doc_type": "quotation"}).json() if d["draft_id"] == draft["draft_id"]]
+    assert "items" not in summary["data"]
+
+
+def test_write_from_a_stale_tab_conflicts(client):
+    draft = new_draft(client)
+    url = f"/api/drafts/{draft['draft_id']}"
+    assert client.patch(url, json={"revision": 1, "set": {"remarks": "tab one"}}).status_code == 200
+    assert client.patch(url, json={"revision": 1, "set": {"remarks": "tab two"}}).status_code == 409
+    assert client.get(url).json()["data"]["remarks"] == "tab one"
+
+
+def test_invalid_paths_are_rejected(client):
+    url = f"/api/drafts/{new_draft(client)['draft_id']}"
+    for path in ("password_hashed", "items.x", "items.0.unknown", "items.5000", "version"):
+        assert client.patch(url, json={"set": {path: 1}}).status_code == 400, path
+    assert client.patch(url, json={"set": {"items": []}, "unset": ["items.0"]}).status_code == 400
+    assert client.post("/api/drafts", json={"doc_type": "invoice", "data": {}}).status_code == 400
+
+
+def test_drafts_are_private(client, sales_user):
+    url = f"/api/drafts/{new_draft(client)['draft_id']}"
+    assert client.get(url, headers=sales_user["headers"]).status_code == 404
+    assert client.delete(url, headers=sales_user["headers"]).status_code == 404
+    assert client.delete(url).status_code == 200
+    assert client.get(url).status_code == 404
+
+
+def test_promote_creates_the_document(client, parties, items):
+    draft = new_draft(client, party_id=parties["home"], date="2026-05-01", items=[quotation_line(items)])
+    response = client.post(f"/api/drafts/{draft['draft_id']}/promote")
+    assert response.status_code == 200, response.text
+    created = client.get(f"/api/quotations/{response.json()['doc_id']}").json()
+    assert created["quotation_no"] == response.json()["doc_no"]
+    assert client.get(f"/api/drafts/{draft['draft_id']}").status_code == 404
+
+
+def test_promote_edits_the_document_it_came_from(client, make_quotation):
+    doc = make_quotation()
+    response = client.post("/api/drafts", json={
+        "doc_type": "quotation", "doc_id": doc["quotation_id"], "base_version": doc["version"], "data": {"remarks": "From draft"}
+    })
+    promoted = client.post(f"/api/drafts/{response.json()['draft_id']}/promote")
+    assert promoted.status_code == 200, promoted.text
+    assert promoted.json()["version"] == doc["version"] + 1
+    assert client.get(f"/api/quotations/{doc['quotation_id']}").json()["remarks"] == "From draft"
+
+
+def test_failed_promote_keeps_the_draft(client, make_quotation):
+    doc = make_quotation()
+    response = client.post("/api/drafts", json={
+        "doc_type": "quotation", "doc_id": doc["quotation_id"], "base_version": doc["version"] - 1, "data": {"remarks": "Stale"}
+    })
+    draft_id = response.json()["draft_id"]
+    assert client.post(f"/api/drafts/{draft_id}/promote").status_code == 409
+    assert client.get(f"/api/drafts/{draft_id}").json()["data"]["remarks"] == "Stale"
+    stored = client.portal.call(server.db.quotations.find_one, {"quotation_id": doc["quotation_id"]})
+    assert stored.get("remarks") != "Stale"
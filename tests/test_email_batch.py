@@ -0,0 +1,48 @@
+import time
+
+import server
+
+from .test_pdf_batch import wait_for_job
+
+
+def wait_for_emails(sent, count):
+    for _ in range(100):
+        if len(sent) >= count:
+            return sent
+        time.sleep(0.02)
+    raise AssertionError(f"only {len(sent)} of {count} emails were delivered")
+
+
+def test_batch_emails_each_document_to_its_party(client, make_quotation, sent_emails):
+    docs = [make_quotation() for _ in range(2)]
+    ids = [doc["quotation_id"] for doc in docs]
+    response = client.post("/api/email/batch", json={"doc_type": "quotation", "ids": ids + ["QTN9999"], "message": "Rates valid till June"})
+    assert response.status_code == 202, response.text
+    assert response.json()["total"] == 2
+
+    job = wait_for_job(client, response.json()["job_id"])
+    assert job["status"] == "completed", job
+    assert job["result"]["queued"] == 2
+
+    wait_for_emails(sent_emails, 2)
+    assert {tuple(message["to"]) for message in sent_emails} == {("home@example.com",)}
+    assert all("Rates valid till June" in message["text"] for message in sent_emails)
+    filenames = sorted(message["attachments"][0]["filename"] for message in sent_emails)
+    assert filenames == sorted(server.pdf_file_name("quotation", doc) for doc in docs)
+
+    for doc in docs:
+        stored = client.portal.call(server.db.quotations.find_one, {"quotation_id": doc["quotation_id"]})
+        assert stored["email_status"] in ("queued", "sent")
+        assert stored["emailed_to"] == ["home@example.com"]
+
+
+def test_documents_without_a_recipient_are_skipped(client, make_quotation, parties, sent_emails):
+    doc = make_quotation()
+    client.portal.call(server.db.parties.update_one, {"party_id": parties["home"]}, {"$set": {"email": ""}})
+    try:
+        job = client.portal.call(server.run_document_email_job, "JOBNOEMAIL", {
+            "doc_type": "quotation", "ids": [doc["quotation_id"]], "message": ""
+        }, "system")
+    finally:
+        client.portal.call(server.db.parties.update_one, {"party_id": parties["home"]}, {"$set": {"email": "home@example.com"}})
+    assert job == {"queued": 0, "skipped": [{"id": doc["quotation_id"], "error": "Party has no email address"}]}
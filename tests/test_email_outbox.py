@@ -0,0 +1,92 @@
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+
+class FailingTransport(server.EmailTransport):
+    name = "failing"
+
+    def send(self, message):
+        raise ConnectionError("provider down")
+
+
+def test_transports_must_implement_send():
+    with pytest.raises(TypeError):
+        server.EmailTransport()
+
+    class Incomplete(server.EmailTransport):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_batch_reports_each_message():
+    class Picky(server.EmailTransport):
+        def send(self, message):
+            if "@" not in message["to"][0]:
+                raise ValueError("bad address")
+
+    assert Picky().send_batch([{"to": ["a@example.com"]}, {"to": ["nobody"]}]) == [None, "bad address"]
+
+
+def outbox_record(client, email_id):
+    return client.portal.call(server.db.email_outbox.find_one, {"email_id": email_id}, {"_id": 0})
+
+
+def wait_for_record(client, email_id, done):
+    for _ in range(100):
+        record = outbox_record(client, email_id)
+        if done(record):
+            return record
+        time.sleep(0.02)
+    raise AssertionError(f"outbox record {email_id} stuck: {record}")
+
+
+async def make_due(email_id):
+    await server.db.email_outbox.update_one({"email_id": email_id}, {"$set": {"next_attempt_at": datetime.now(timezone.utc)}})
+    server._email_outbox_wakeup.set()
+
+
+def test_failed_sends_back_off_then_dead_letter(client, monkeypatch):
+    monkeypatch.setattr(server, "email_transport", FailingTransport())
+    monkeypatch.setattr(server, "EMAIL_MAX_ATTEMPTS", 2)
+    email_id = client.portal.call(server.enqueue_email, ["someone@example.com"], "Hello", "<p>Hi</p>")
+
+    record = wait_for_record(client, email_id, lambda r: r["attempts"] == 1)
+    assert (record["status"], record["last_error"]) == ("pending", "provider down")
+    # mongomock hands back naive UTC datetimes
+    assert record["next_attempt_at"] > datetime.now(timezone.utc).replace(tzinfo=None)
+
+    client.portal.call(make_due, email_id)
+    record = wait_for_record(client, email_id, lambda r: r["status"] == "dead")
+    assert record["attempts"] == 2
+    assert record["expires_at"]
+
+
+def test_admin_retry_delivers_a_dead_letter(client, monkeypatch, sent_emails):
+    email_id = "dead-letter-1"
+    # Inserted directly, so the running sender never sees it before it is dead-lettered
+    client.portal.call(server.db.email_outbox.insert_one, {
+        "email_id": email_id, "to": ["late@example.com"], "subject": "Retry me", "html": "<p>Hi</p>", "text": "",
+        "status": "dead", "attempts": 6, "last_error": "provider down", "next_attempt_at": datetime.now(timezone.utc)
+    })
+
+    response = client.post(f"/api/email-outbox/{email_id}/retry")
+    assert response.status_code == 200
+    record = wait_for_record(client, email_id, lambda r: r["status"] == "sent")
+    assert [message["email_id"] for message in sent_emails] == [email_id]
+    # Delivered bodies are dropped, they can hold reset links
+    assert "html" not in record and "text" not in record
+    assert client.post(f"/api/email-outbox/{email_id}/retry").status_code == 404
+
+
+def test_retry_delay_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(server, "EMAIL_RETRY_BASE_SECONDS", 10)
+    monkeypatch.setattr(server, "EMAIL_RETRY_MAX_SECONDS", 60)
+    assert 8 <= server.email_retry_delay(1) <= 12
+    assert 32 <= server.email_retry_delay(3) <= 48
+    assert server.email_retry_delay(10) <= 72
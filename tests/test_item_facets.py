@@ -0,0 +1,45 @@
+import pytest
+
+import server
+
+
+@pytest.fixture(scope="module")
+def catalogue(client):
+    items = [
+        ("F1", "Havells", "Cable", "Mtr"), ("F2", "Havells", "Cable", "Mtr"), ("F3", "Havells", "Switch", "Nos"),
+        ("F4", "Polycab", "Cable", "Mtr"), ("F5", "Anchor", "Switch", "Nos"),
+    ]
+    for code, brand, category, uom in items:
+        body = {"item_code": code, "item_name": f"Facet {code}", "UOM": uom, "rate": 10, "HSN": "8544",
+                "GST_percent": 18, "brand": brand, "category": category}
+        assert client.post("/api/items", json=body).status_code == 200
+
+
+def counts(facet):
+    return {bucket["value"]: bucket["count"] for bucket in facet if bucket["value"]}
+
+
+def test_each_facet_ignores_its_own_filter(client, catalogue):
+    facets = client.get("/api/items/facets", params={"brand": "Havells"}).json()
+    assert counts(facets["brands"]) == {"Havells": 3, "Polycab": 1, "Anchor": 1}
+    assert counts(facets["categories"]) == {"Cable": 2, "Switch": 1}
+    assert facets["total"] == 3
+
+
+def test_facets_combine_the_other_filters(client, catalogue):
+    facets = client.get("/api/items/facets", params={"brand": "Havells", "category": "Cable"}).json()
+    assert counts(facets["brands"]) == {"Havells": 2, "Polycab": 1}
+    assert counts(facets["categories"]) == {"Cable": 2, "Switch": 1}
+    assert counts(facets["uoms"]) == {"Mtr": 2}
+    assert facets["total"] == 2
+
+
+def test_item_write_invalidates_cached_facets(client, catalogue):
+    params = {"category": "Switch"}
+    before = client.get("/api/items/facets", params=params).json()
+    assert counts(before["brands"]) == {"Havells": 1, "Anchor": 1}
+    # Another worker's write reaches this one through the stamp in Mongo, not its local cache
+    client.portal.call(server.db.counters.update_one, {"_id": server.ITEM_FACET_STAMP_ID}, {"$inc": {"seq": 1}}, True)
+    client.portal.call(server.db.items.insert_one, {"item_id": "ITMFACET", "brand": "Anchor", "category": "Switch", "UOM": "Nos"})
+    after = client.get("/api/items/facets", params=params).json()
+    assert counts(after["brands"]) == {"Havells": 1, "Anchor": 2}
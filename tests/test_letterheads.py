@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import pdf_render
+
+
+@pytest.fixture
+def letterheads(tmp_path):
+    (tmp_path / "letterheads").mkdir()
+    (tmp_path / "default.png").write_bytes(b"default-image")
+    (tmp_path / "letterheads" / "pune.png").write_bytes(b"pune-image")
+    return pdf_render.LetterheadManager(tmp_path / "default.png", tmp_path / "letterheads", check_interval=0)
+
+
+def test_src_names_the_file_and_its_version(letterheads, tmp_path):
+    mtime = (tmp_path / "letterheads" / "pune.png").stat().st_mtime_ns
+    assert letterheads.src_for("pune.png") == f"letterhead:pune.png?v={mtime}"
+    assert letterheads.src_for().startswith("letterhead:default?v=")
+
+
+def test_fetcher_serves_images_from_memory(letterheads):
+    fetched = letterheads.url_fetcher(letterheads.src_for("pune.png"))
+    assert fetched == {"string": b"pune-image", "mime_type": "image/png"}
+    assert letterheads.url_fetcher("letterhead:default")["string"] == b"default-image"
+
+
+def test_missing_branch_letterhead_falls_back_to_default(letterheads):
+    assert letterheads.src_for("gone.png").startswith("letterhead:gone.png?v=")
+    assert letterheads.url_fetcher("letterhead:gone.png")["string"] == b"default-image"
+
+
+def test_changed_file_is_reloaded(letterheads, tmp_path):
+    path = tmp_path / "letterheads" / "pune.png"
+    letterheads.image_cache["decoded"] = object()
+    first = letterheads.src_for("pune.png")
+    path.write_bytes(b"new-pune-image")
+    os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000))
+    assert letterheads.src_for("pune.png") != first
+    assert letterheads.url_fetcher("letterhead:pune.png")["string"] == b"new-pune-image"
+    assert letterheads.image_cache == {}
+
+
+def test_paths_cannot_leave_the_letterheads_directory(letterheads):
+    assert letterheads.url_fetcher("letterhead:../default.png")["string"] == b"default-image"
+
+
+@pytest.mark.parametrize("url", ["file:///etc/passwd", "http://169.254.169.254/", "https://example.com/a.png", "/etc/hosts"])
+def test_other_urls_are_blocked(letterheads, url):
+    with pytest.raises(ValueError):
+        letterheads.url_fetcher(url)
+
+
+def test_data_urls_are_allowed(letterheads, monkeypatch):
+    monkeypatch.setattr(pdf_render, "default_url_fetcher", lambda url, *args, **kwargs: {"string": b"inline"})
+    assert letterheads.url_fetcher("data:image/png;base64,AAAA")["string"] == b"inline"
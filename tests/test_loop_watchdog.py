@@ -0,0 +1,48 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import server
+
+
+def test_blocking_handler_is_reported_by_route():
+    watchdog = server.LoopBlockWatchdog(threshold_ms=30, interval_ms=5)
+
+    async def slow_endpoint():
+        time.sleep(0.15)
+
+    async def main():
+        watchdog.start(asyncio.get_running_loop(), [SimpleNamespace(endpoint=slow_endpoint, path="/api/slow")])
+        await asyncio.sleep(0.05)
+        await slow_endpoint()
+        # Give the watchdog a few beats to see the loop recover and record the stall
+        await asyncio.sleep(0.05)
+        watchdog.stop()
+
+    asyncio.run(main())
+    [offender] = watchdog.report()
+    assert offender["handler"] == "/api/slow"
+    assert offender["count"] == 1
+    assert offender["max_ms"] >= 30
+    assert any("slow_endpoint" in line for line in offender["stack"])
+
+
+def test_stalls_are_aggregated_by_handler_and_site():
+    watchdog = server.LoopBlockWatchdog(threshold_ms=100, interval_ms=20)
+    before = server.EVENT_LOOP_BLOCKS._values.get(("/api/items",), 0)
+    for blocked in (0.2, 0.5):
+        watchdog._record({"handler": "/api/items", "site": "server.py:1 in get_items", "stack": [], "blocked": blocked})
+    watchdog._record({"handler": "/api/parties", "site": "server.py:2 in get_parties", "stack": [], "blocked": 0.9})
+    items, parties = sorted(watchdog.report(), key=lambda offender: offender["handler"])
+    assert (items["count"], items["total_ms"], items["max_ms"]) == (2, 700, 500)
+    assert parties["count"] == 1
+    # Worst total first
+    assert watchdog.report()[0]["handler"] == "/api/parties"
+    assert server.EVENT_LOOP_BLOCKS._values[("/api/items",)] == before + 2
+
+
+def test_report_is_admin_only(client, sales_user):
+    assert client.get("/api/debug/loop-blocking", headers=sales_user["headers"]).status_code == 403
+    response = client.get("/api/debug/loop-blocking")
+    assert response.status_code == 200
+    assert response.json()["enabled"] is server.LOOP_WATCHDOG_ENABLED
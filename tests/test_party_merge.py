@@ -0,0 +1,132 @@
+import time
+
+import server
+from .conftest import HOME_PARTY
+
+
+def new_party(client, gst, name):
+    response = client.post("/api/parties", json={**HOME_PARTY, "GST_number": gst, "party_name": name})
+    assert response.status_code == 200, response.text
+    return response.json()["party_id"]
+
+
+def merge(client, keep, merge_ids):
+    return client.post("/api/parties/merge", json={"keep_party_id": keep, "merge_party_ids": merge_ids})
+
+
+def test_merge_into_merged_party_is_rejected(client):
+    keep = new_party(client, "27KKKKK0000K1Z5", "Keep")
+    absorbed = new_party(client, "27LLLLL0000L1Z5", "Absorbed")
+    other = new_party(client, "27MMMMM0000M1Z5", "Other")
+    # The in-memory test database has no transactions, so record the earlier merge directly
+    client.portal.call(server.db.parties.update_one, {"party_id": absorbed}, {"$set": {"merged_into": keep}})
+    response = merge(client, absorbed, [other])
+    assert response.status_code == 400
+    assert client.get(f"/api/parties/{other}").json()["status"] == "Active"
+
+
+def test_merge_into_inactive_party_is_rejected(client):
+    inactive = new_party(client, "27NNNNN0000N1Z5", "Inactive")
+    other = new_party(client, "27PPPPP0000P1Z5", "Other")
+    assert client.delete(f"/api/parties/{inactive}").status_code == 200
+    assert merge(client, inactive, [other]).status_code == 400
+
+
+def test_merge_with_unknown_party_is_404(client):
+    keep = new_party(client, "27QQQQQ0000Q1Z5", "Keep")
+    assert merge(client, keep, ["PTY9999"]).status_code == 404
+    assert merge(client, "PTY9999", [keep]).status_code == 404
+
+
+def test_gst_and_name_keys_ignore_formatting():
+    assert server.normalize_gst_number(" 27abcde1234f1z5. ") == "27ABCDE1234F1Z5"
+    assert server.normalize_gst_number(None) == ""
+    keys = server.party_match_keys({"party_name": "M/s. Sun & Sons Pvt. Ltd.", "city": " Kolhapur ", "GST_number": "27 ab"})
+    assert keys == {"gst_key": "27AB", "name_key": "sun sons|kolhapur"}
+
+
+def test_clusters_join_same_gst_and_similar_names():
+    parties = [
+        {"party_id": "P1", "party_name": "Sunrise Electricals", "city": "Pune", "GST_number": "", "status": "Active"},
+        {"party_id": "P2", "party_name": "Sunrise Electrical", "city": "Pune", "GST_number": "27AAA", "status": "Active"},
+        {"party_id": "P3", "party_name": "Other Name", "city": "Satara", "GST_number": "27aaa", "status": "Active"},
+        {"party_id": "P4", "party_name": "Sunrise Electricals", "city": "Nashik", "GST_number": "", "status": "Active"},
+    ]
+    clusters = server.find_duplicate_party_clusters(parties)
+    assert len(clusters) == 1
+    assert [p["party_id"] for p in clusters[0]["parties"]] == ["P2", "P3", "P1"]
+    # Active with a GST number is the suggested record to keep
+    assert clusters[0]["suggested_keep_party_id"] == "P2"
+
+
+def wait_for_job(client, job_id):
+    for _ in range(100):
+        job = client.get(f"/api/jobs/{job_id}").json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_duplicate_report_reads_the_stored_scan(client):
+    first = new_party(client, "27RRRRR0000R1Z5", "Dedup Traders")
+    second = new_party(client, "", "Dedup Trader")
+    response = client.post("/api/parties/duplicates/scan", json={})
+    assert response.status_code == 202
+    assert wait_for_job(client, response.json()["job_id"])["status"] == "completed"
+
+    report = client.get("/api/parties/duplicates").json()
+    assert report["job_id"] == response.json()["job_id"]
+    cluster = next(c for c in report["clusters"] if first in {p["party_id"] for p in c["parties"]})
+    assert {p["party_id"] for p in cluster["parties"]} == {first, second}
+
+    # A party merged away after the scan drops out of the stored cluster
+    client.portal.call(server.db.parties.update_one, {"party_id": second}, {"$set": {"merged_into": first}})
+    report = client.get("/api/parties/duplicates").json()
+    assert all(first not in {p["party_id"] for p in c["parties"]} for c in report["clusters"])
+
+
+def test_merge_repoints_hot_and_archived_documents(client, make_quotation):
+    keep = new_party(client, "27SSSSS0000S1Z5", "Merge Keep")
+    absorbed = new_party(client, "27TTTTT0000T1Z5", "Merge Absorbed")
+    hot = make_quotation(party_id=absorbed)["quotation_id"]
+    client.portal.call(server.db.quotations_archive.insert_one, {"quotation_id": "QTNMERGEOLD", "party_id": absorbed})
+
+    # merge_party_records wraps this in a transaction where the deployment has one
+    repointed = client.portal.call(server._apply_party_merge, keep, [absorbed])
+    assert repointed["quotations"] == 1
+    assert repointed["quotations_archive"] == 1
+    assert client.get(f"/api/quotations/{hot}").json()["party_id"] == keep
+    merged = client.portal.call(server.db.parties.find_one, {"party_id": absorbed})
+    assert (merged["status"], merged["merged_into"]) == ("Inactive", keep)
+
+
+def test_large_merge_runs_as_a_job(client, make_quotation, monkeypatch):
+    keep = new_party(client, "27UUUUU0000U1Z5", "Job Keep")
+    absorbed = new_party(client, "27VVVVV0000V1Z5", "Job Absorbed")
+    make_quotation(party_id=absorbed)
+    started = []
+
+    async def record_job(job_type, params, user_id, runner):
+        started.append((job_type, params, runner))
+        return {"job_id": "JOBMERGE", "status": "queued"}
+
+    monkeypatch.setattr(server, "PARTY_MERGE_INLINE_LIMIT", 0)
+    monkeypatch.setattr(server, "start_background_job", record_job)
+    response = merge(client, keep, [absorbed])
+    assert response.status_code == 202
+    assert response.json()["job_id"] == "JOBMERGE"
+    assert started == [("PARTY_MERGE", {"keep_party_id": keep, "merge_party_ids": [absorbed], "document_count": 1},
+                        server.run_party_merge_job)]
+
+
+def test_job_without_a_recent_heartbeat_is_failed(client):
+    old = "2020-01-01T00:00:00+00:00"
+    for job_id, heartbeat in (("JOBSTALE", old), ("JOBALIVE", None)):
+        job = {"job_id": job_id, "job_type": "PARTY_MERGE", "status": "running", "created_by": "system",
+               "updated_at": old, "heartbeat_at": heartbeat or server.datetime.now(server.timezone.utc).isoformat()}
+        client.portal.call(server.db.jobs.insert_one, job)
+    stale = client.get("/api/jobs/JOBSTALE").json()
+    assert stale["status"] == "failed"
+    assert "restart" in stale["error"]
+    assert client.get("/api/jobs/JOBALIVE").json()["status"] == "running"
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+from passlib.context import CryptContext
+
+import server
+
+
+def test_hashing_runs_on_the_bcrypt_threads(monkeypatch):
+    threads = []
+    real_hash = server.pwd_context.hash
+
+    def recording_hash(password):
+        threads.append(threading.current_thread().name)
+        return real_hash(password)
+
+    monkeypatch.setattr(server.pwd_context, "hash", recording_hash)
+
+    async def main():
+        hashed = await server.hash_password("secret123")
+        return await server.verify_and_update_password("secret123", hashed)
+
+    assert asyncio.run(main()) == (True, None)
+    assert threads[0].startswith("bcrypt")
+
+
+def test_wrong_password_is_rejected():
+    async def main():
+        return await server.verify_and_update_password("wrong", await server.hash_password("secret123"))
+
+    assert asyncio.run(main()) == (False, None)
+
+
+def test_outdated_hash_is_upgraded_on_login(client):
+    user = {"name": "Old Hash", "email": "oldhash@example.com", "mobile": "9000000010", "role": "Sales User", "password": "secret123"}
+    user_id = client.post("/api/auth/register", json=user).json()["user_id"]
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=server.BCRYPT_ROUNDS + 1).hash(user["password"])
+    client.portal.call(server.db.users.update_one, {"user_id": user_id}, {"$set": {"password_hashed": old_hash}})
+
+    response = client.post("/api/auth/login", json={"email": user["email"], "password": user["password"]})
+    assert response.status_code == 200
+    stored = client.portal.call(server.db.users.find_one, {"user_id": user_id})
+    assert stored["password_hashed"] != old_hash
+    assert f"${server.BCRYPT_ROUNDS:02d}$" in stored["password_hashed"]
@@ -0,0 +1,76 @@
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "PDF_STORE_DIR", tmp_path)
+    return tmp_path
+
+
+def wait_for_job(client, job_id):
+    for _ in range(100):
+        job = client.get(f"/api/jobs/{job_id}").json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_batch_zips_every_selected_document(client, make_quotation, store):
+    docs = [make_quotation() for _ in range(3)]
+    ids = [doc["quotation_id"] for doc in docs]
+    response = client.post("/api/pdf/batch", json={"doc_type": "quotation", "ids": ids + ["QTN9999"]})
+    assert response.status_code == 202, response.text
+    assert response.json()["total"] == 3
+    job = wait_for_job(client, response.json()["job_id"])
+    assert job["status"] == "completed", job
+    assert job["result"]["rendered"] == 3
+
+    download = client.get(job["result"]["download_url"])
+    assert download.status_code == 200
+    names = zipfile.ZipFile(io.BytesIO(download.content)).namelist()
+    assert sorted(names) == sorted(server.pdf_file_name("quotation", doc) for doc in docs)
+    assert not list((store / "batches").glob("*.part"))
+
+
+def test_failed_batch_leaves_no_file(client, make_quotation, store, monkeypatch):
+    doc_id = make_quotation()["quotation_id"]
+    calls = []
+
+    async def fail_once_rendering(*args):
+        # The first call reports the ids that were not found, before the zip is opened
+        calls.append(args)
+        if len(calls) > 1:
+            raise RuntimeError("progress store down")
+
+    monkeypatch.setattr(server, "update_job_progress", fail_once_rendering)
+    with pytest.raises(RuntimeError):
+        client.portal.call(server.run_pdf_batch_job, "JOBFAILED", {"doc_type": "quotation", "ids": [doc_id]}, "system")
+    assert list((store / "batches").iterdir()) == []
+
+
+def test_expired_batches_are_purged(store, monkeypatch):
+    batches = store / "batches"
+    batches.mkdir()
+    old = time.time() - 2 * 3600
+    for name in ("old.zip", "old.zip.part", "new.zip"):
+        (batches / name).write_bytes(b"PK")
+    for name in ("old.zip", "old.zip.part"):
+        os.utime(batches / name, (old, old))
+    monkeypatch.setattr(server, "PDF_BATCH_RETENTION_HOURS", 1)
+    server._purge_old_pdf_batches()
+    assert [path.name for path in batches.iterdir()] == ["new.zip"]
+
+
+def test_expired_batch_download_is_gone(client, make_quotation, store):
+    response = client.post("/api/pdf/batch", json={"doc_type": "quotation", "ids": [make_quotation()["quotation_id"]]})
+    job = wait_for_job(client, response.json()["job_id"])
+    server.pdf_batch_path(job["job_id"]).unlink()
+    assert client.get(job["result"]["download_url"]).status_code == 410
@@ -0,0 +1,60 @@
+import logging
+
+import pytest
+
+import server
+
+
+def count(metric, **labels):
+    state = metric._values.get(metric._key(labels))
+    return state["count"] if state else 0
+
+
+def test_stages_are_recorded_per_document_type():
+    before = count(server.PDF_STAGE_SECONDS, doc_type="soa", stage="generate_html")
+    with server.pdf_render_trace("soa", "SOA0001") as trace:
+        with server.pdf_stage("generate_html"):
+            pass
+        with server.pdf_stage("generate_html"):
+            pass
+    assert list(trace["stages"]) == ["generate_html"]
+    # Repeated stages are summed into one observation
+    assert count(server.PDF_STAGE_SECONDS, doc_type="soa", stage="generate_html") == before + 1
+
+
+def test_stage_outside_a_trace_is_ignored():
+    with server.pdf_stage("write_pdf"):
+        pass
+
+
+def test_slow_render_is_logged_with_its_breakdown(monkeypatch, caplog):
+    monkeypatch.setattr(server, "PDF_SLOW_RENDER_MS", 0)
+    before = server.PDF_SLOW_RENDERS._values.get(("challan",), 0)
+    with caplog.at_level(logging.WARNING, logger=server.logger.name):
+        with server.pdf_render_trace("challan", "DC0001", source="prerender") as trace:
+            trace["lines"] = 12
+            with server.pdf_stage("write_pdf"):
+                pass
+    assert server.PDF_SLOW_RENDERS._values[("challan",)] == before + 1
+    message = caplog.records[-1].getMessage()
+    assert "challan DC0001 (12 lines, prerender)" in message
+    assert "write_pdf=" in message
+
+
+def test_failed_render_is_not_counted(monkeypatch):
+    monkeypatch.setattr(server, "PDF_SLOW_RENDER_MS", 0)
+    before = count(server.PDF_RENDER_SECONDS, doc_type="quotation", source="failing")
+    with pytest.raises(RuntimeError):
+        with server.pdf_render_trace("quotation", "QTN0001", source="failing"):
+            with server.pdf_stage("fetch_doc"):
+                raise RuntimeError("render failed")
+    assert count(server.PDF_RENDER_SECONDS, doc_type="quotation", source="failing") == before
+    assert count(server.PDF_STAGE_SECONDS, doc_type="quotation", stage="fetch_doc") >= 1
+
+
+def test_document_pdf_request_is_traced(client, make_quotation):
+    before = count(server.PDF_RENDER_SECONDS, doc_type="quotation", source="request")
+    response = client.get(f"/api/quotations/{make_quotation()['quotation_id']}/pdf")
+    assert response.status_code == 200
+    assert count(server.PDF_RENDER_SECONDS, doc_type="quotation", source="request") == before + 1
+    assert count(server.PDF_STAGE_SECONDS, doc_type="quotation", stage="generate_html") >= 1
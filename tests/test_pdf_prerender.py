@@ -0,0 +1,72 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "PDF_STORE_DIR", tmp_path)
+
+
+def stored(client, quotation_id):
+    return client.portal.call(server.db.quotations.find_one, {"quotation_id": quotation_id}, {"_id": 0})
+
+
+def locked_quotation(client, make_quotation, **state):
+    quotation_id = make_quotation()["quotation_id"]
+    client.portal.call(server.db.quotations.update_one, {"quotation_id": quotation_id}, {"$set": {"is_locked": True, **state}})
+    return quotation_id
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    rendered = []
+
+    async def record(doc_kind, doc):
+        rendered.append(doc["quotation_id"])
+
+    monkeypatch.setattr(server, "render_to_pdf_store", record)
+    return rendered
+
+
+def test_lock_renders_the_pdf_in_the_background(client, make_quotation):
+    quotation_id = make_quotation()["quotation_id"]
+    assert client.post(f"/api/quotations/{quotation_id}/lock").json()["pdf_status"] == "pending"
+    for _ in range(100):
+        doc = stored(client, quotation_id)
+        if doc["pdf_status"] not in ("pending", "rendering"):
+            break
+        time.sleep(0.02)
+    assert doc["pdf_status"] == "ready"
+    assert "pdf_lease_expires_at" not in doc
+    assert client.portal.call(server.db.pdf_store.find_one, {"doc_kind": "quotation", "doc_id": quotation_id})
+
+
+def test_document_claimed_by_another_worker_is_skipped(client, make_quotation, renders):
+    lease = datetime.now(timezone.utc) + timedelta(minutes=5)
+    quotation_id = locked_quotation(client, make_quotation, pdf_status="rendering", pdf_lease_expires_at=lease)
+    client.portal.call(server._prerender_document_pdf, "quotation", quotation_id)
+    assert renders == []
+
+
+def test_expired_claim_is_taken_over(client, make_quotation, renders):
+    lease = datetime.now(timezone.utc) - timedelta(seconds=1)
+    quotation_id = locked_quotation(client, make_quotation, pdf_status="rendering", pdf_lease_expires_at=lease)
+    client.portal.call(server._prerender_document_pdf, "quotation", quotation_id)
+    assert renders == [quotation_id]
+
+
+def test_failed_render_is_recorded(client, make_quotation, monkeypatch):
+    quotation_id = locked_quotation(client, make_quotation, pdf_status="pending")
+
+    async def broken(doc_kind, doc):
+        raise RuntimeError("renderer crashed")
+
+    monkeypatch.setattr(server, "render_to_pdf_store", broken)
+    client.portal.call(server._prerender_document_pdf, "quotation", quotation_id)
+    doc = stored(client, quotation_id)
+    assert (doc["pdf_status"], doc["pdf_error"]) == ("failed", "renderer crashed")
+    assert "pdf_lease_expires_at" not in doc
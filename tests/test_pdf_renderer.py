@@ -0,0 +1,52 @@
+import pytest
+
+import pdf_render
+
+
+@pytest.fixture
+def renderer(tmp_path):
+    stylesheet = tmp_path / "documents.css"
+    stylesheet.write_text("body { color: black; }")
+    letterheads = pdf_render.LetterheadManager(tmp_path / "none.png", tmp_path)
+    return pdf_render.PdfRenderer(stylesheet, letterheads)
+
+
+def test_stylesheet_is_parsed_once(renderer, monkeypatch):
+    monkeypatch.setattr(pdf_render, "TEMPLATE_AUTO_RELOAD", False)
+    assert renderer.stylesheet is renderer.stylesheet
+
+
+def test_revision_follows_the_stylesheet_when_reloading(renderer, monkeypatch):
+    monkeypatch.setattr(pdf_render, "TEMPLATE_AUTO_RELOAD", True)
+    first = renderer.revision
+    assert renderer.revision == first
+    renderer.stylesheet_path.write_text("body { color: red; }")
+    assert renderer.revision != first
+
+
+def test_renders_share_fonts_stylesheet_and_image_cache(renderer, monkeypatch):
+    calls = []
+
+    class RecordingHTML:
+        def __init__(self, string, url_fetcher):
+            self.url_fetcher = url_fetcher
+
+        def write_pdf(self, **kwargs):
+            calls.append((self.url_fetcher, kwargs))
+            return b"%PDF-"
+
+    monkeypatch.setattr(pdf_render, "HTML", RecordingHTML)
+    renderer.render("<p>one</p>")
+    renderer.render("<p>two</p>")
+    (fetcher, first), (_, second) = calls
+    assert fetcher == renderer.letterheads.url_fetcher
+    assert first["font_config"] is second["font_config"] is renderer.font_config
+    assert first["stylesheets"][0] is second["stylesheets"][0]
+    assert first["cache"] is renderer.letterheads.image_cache
+
+
+def test_warm_up_renders_a_document(renderer, monkeypatch):
+    rendered = []
+    monkeypatch.setattr(renderer, "render", rendered.append)
+    renderer.warm_up()
+    assert "WARMUP" in rendered[0]
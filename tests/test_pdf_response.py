@@ -0,0 +1,75 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=2-4", (2, 4)),
+    ("bytes=5-", (5, 17)),
+    ("bytes=3-100", (3, 17)),
+    ("bytes=-4", (14, 17)),
+    ("bytes=5-3", None),
+    ("bytes=0-1,3-4", None),
+    ("items=0-1", None),
+    ("bytes=a-b", None),
+])
+def test_parse_byte_range(header, expected):
+    assert server.parse_byte_range(header, 18) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=18-", "bytes=100-200"])
+def test_parse_byte_range_past_the_end_is_416(header):
+    with pytest.raises(HTTPException) as error:
+        server.parse_byte_range(header, 18)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */18"
+
+
+def test_unlocked_pdf_revalidates_without_rendering(client, make_quotation, monkeypatch):
+    doc = make_quotation()
+    renders = []
+    render = server.render_pdf_async
+
+    async def counting_render(html):
+        renders.append(html)
+        return await render(html)
+
+    monkeypatch.setattr(server, "render_pdf_async", counting_render)
+    url = f"/api/quotations/{doc['quotation_id']}/pdf"
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert len(renders) == 1
+
+    client.patch(f"/api/quotations/{doc['quotation_id']}", json={"version": doc["version"], "ops": [
+        {"op": "replace", "path": "/remarks", "value": "Changed"}
+    ]})
+    changed = client.get(url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert len(renders) == 2
+
+
+def test_unlocked_pdf_has_weak_etag_and_no_ranges(client, make_quotation):
+    doc = make_quotation()
+    url = f"/api/quotations/{doc['quotation_id']}/pdf"
+    response = client.get(url, headers={"Range": "bytes=0-3"})
+    assert response.status_code == 200
+    assert response.headers["etag"].startswith('W/"')
+    assert response.headers["accept-ranges"] == "none"
+    assert "content-range" not in response.headers
+
+
+def test_locked_pdf_serves_ranges_under_a_strong_etag(client, make_quotation):
+    doc = make_quotation()
+    assert client.post(f"/api/quotations/{doc['quotation_id']}/lock").status_code == 200
+    url = f"/api/quotations/{doc['quotation_id']}/pdf"
+    full = client.get(url)
+    assert full.headers["etag"].startswith('"')
+    assert full.headers["accept-ranges"] == "bytes"
+    part = client.get(url, headers={"Range": "bytes=0-3", "If-Range": full.headers["etag"]})
+    assert part.status_code == 206
+    assert part.content == full.content[:4]
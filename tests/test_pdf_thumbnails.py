@@ -0,0 +1,61 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+import pdf_render
+import server
+
+
+def page_pdf(text="Quotation") -> bytes:
+    image = Image.new("RGB", (1240, 1754), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((40, 40, 1200, 200), fill=(20, 60, 140))
+    for row in range(60):
+        draw.text((60, 240 + row * 24), f"{text} line {row} " * 6, fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, "PDF", resolution=150)
+    return buffer.getvalue()
+
+
+def test_thumbnail_is_a_small_png_of_the_first_page():
+    png = pdf_render.render_pdf_thumbnail(page_pdf())
+    image = Image.open(io.BytesIO(png))
+    assert image.format == "PNG"
+    assert image.width <= pdf_render.PDF_THUMBNAIL_WIDTH
+    assert len(png) <= pdf_render.PDF_THUMBNAIL_MAX_BYTES
+
+
+@pytest.fixture
+def renders(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "PDF_STORE_DIR", tmp_path)
+    rendered = []
+
+    async def render(html):
+        rendered.append(html)
+        return page_pdf()
+
+    monkeypatch.setattr(server, "render_pdf_async", render)
+    return rendered
+
+
+def test_thumbnail_is_reused_until_the_document_changes(client, make_quotation, renders):
+    doc = make_quotation()
+    url = f"/api/pdf/thumbnail/quotation/{doc['quotation_id']}"
+    first = client.get(url)
+    assert first.status_code == 200
+    assert first.headers["content-type"] == "image/png"
+    assert client.get(url).content == first.content
+    assert len(renders) == 1
+
+    edited = client.patch(f"/api/quotations/{doc['quotation_id']}", json={"version": doc["version"], "ops": [
+        {"op": "replace", "path": "/remarks", "value": "Changed"}
+    ]})
+    assert edited.status_code == 200, edited.text
+    assert client.get(url).status_code == 200
+    assert len(renders) == 2
+
+
+def test_thumbnail_of_unknown_document(client):
+    assert client.get("/api/pdf/thumbnail/quotation/QTN9999").status_code == 404
+    assert client.get("/api/pdf/thumbnail/invoice/QTN0001").status_code == 400
@@ -0,0 +1,71 @@
+import asyncio
+
+import server
+
+
+def take(buckets, key, capacity=2, rate=1.0):
+    return asyncio.run(buckets.take(key, capacity, rate))
+
+
+def test_bucket_allows_a_burst_then_refills(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    buckets = server.MemoryTokenBuckets()
+    assert take(buckets, "a") == take(buckets, "a") == 0
+    assert take(buckets, "a") == 1.0
+    now[0] += 1
+    assert take(buckets, "a") == 0
+    # Keys are limited independently
+    assert take(buckets, "b") == 0
+
+
+def test_least_recently_used_keys_are_evicted():
+    buckets = server.MemoryTokenBuckets(max_keys=2)
+    for key in ("a", "b", "a", "c"):
+        take(buckets, key)
+    assert list(buckets._buckets) == ["a", "c"]
+
+
+def login(client, email, password="wrong", **headers):
+    return client.post("/api/auth/login", json={"email": email, "password": password}, headers=headers)
+
+
+def test_failed_logins_are_limited_per_email(client, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, ("login", "email"), (3, 3 / 300))
+    for _ in range(3):
+        assert login(client, "victim@example.com").status_code == 401
+    response = login(client, "victim@example.com")
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) > 0
+    # Case and whitespace do not give an attacker a fresh bucket
+    assert login(client, "VICTIM@example.com").status_code == 429
+
+
+def test_successful_login_clears_the_email_limit(client, monkeypatch):
+    user = {"name": "Forgetful", "email": "forgetful@example.com", "mobile": "9000000011", "role": "Sales User", "password": "secret123"}
+    client.post("/api/auth/register", json=user)
+    monkeypatch.setitem(server.RATE_LIMITS, ("login", "email"), (2, 2 / 300))
+    assert login(client, user["email"]).status_code == 401
+    assert login(client, user["email"], user["password"]).status_code == 200
+    assert login(client, user["email"]).status_code == 401
+    assert login(client, user["email"]).status_code == 401
+
+
+def test_ip_limit_uses_the_trusted_forwarded_hop(client, monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+    monkeypatch.setitem(server.RATE_LIMITS, ("login", "ip"), (2, 2 / 60))
+    for n in range(2):
+        assert login(client, f"spray{n}@example.com", **{"X-Forwarded-For": "198.51.100.1, 203.0.113.9"}).status_code == 401
+    assert login(client, "spray2@example.com", **{"X-Forwarded-For": "198.51.100.2, 203.0.113.9"}).status_code == 429
+    assert login(client, "spray3@example.com", **{"X-Forwarded-For": "203.0.113.10"}).status_code == 401
+
+
+def test_limiter_outage_falls_back_to_this_worker(client, monkeypatch):
+    class Down:
+        async def take(self, *args):
+            raise ConnectionError("rate limit store down")
+
+    monkeypatch.setattr(server, "rate_limiter", Down())
+    monkeypatch.setitem(server.RATE_LIMITS, ("login", "email"), (1, 1 / 300))
+    assert login(client, "outage@example.com").status_code == 401
+    assert login(client, "outage@example.com").status_code == 429
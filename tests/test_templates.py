@@ -0,0 +1,45 @@
+import pdf_render
+import server
+
+TOTALS = {"subtotal": 1234.5, "tax_total": 222.21, "grand_total": 1456.71, "cgst": 0, "sgst": 0, "igst": 222.21}
+PARTY = {"party_name": "<b>Sun & Sons</b>", "address": "", "city": "", "state": "", "pincode": "",
+         "GST_number": "", "contact_person": "", "mobile": ""}
+
+
+def document_html(**line):
+    item = {"item_id": "ITM0001", "item_name": "Meter", "qty": 1, "rate": 1234.5, "taxable_amount": 1234.5,
+            "tax_type": "IGST", "tax_amount": 222.21, "total_amount": 1456.71, **line}
+    return pdf_render.generate_document_html(
+        doc_type="QUOTATION", doc_no="QTN0001", doc_date="2026-05-01", party=PARTY, items=[item],
+        totals=TOTALS, hsn_summary=[], is_quotation=True
+    )
+
+
+def test_document_fields_are_escaped():
+    html = document_html()
+    assert "&lt;b&gt;Sun &amp; Sons&lt;/b&gt;" in html
+    assert "<b>Sun" not in html
+
+
+def test_money_is_formatted_with_separators():
+    assert "₹1,456.71" in document_html()
+
+
+def test_discount_columns_only_when_a_line_has_discount():
+    assert "List Price" not in document_html()
+    assert "List Price" in document_html(discount_percent=10)
+
+
+def test_lead_pdf_shows_status_class_and_no_render_time(client, monkeypatch):
+    lead = client.post("/api/leads", json={"party_name": "Lead Party", "contact_name": "C", "requirement_summary": "Meters"})
+    assert lead.status_code == 200, lead.text
+    rendered = []
+
+    async def capture(html):
+        rendered.append(html)
+        return b"%PDF-"
+
+    monkeypatch.setattr(server, "render_pdf_async", capture)
+    assert client.get(f"/api/leads/{lead.json()['lead_id']}/pdf").status_code == 200
+    assert 'class="info-value status-open"' in rendered[0]
+    assert "Generated on" not in rendered[0]